@@ -0,0 +1,174 @@
+#async_db_benchmark.py
+# Requests/sec for a mix of webhook writes (POST /patients/call-logs/, what a finished call writes) and
+# dashboard reads (GET /patients/{patient_id}) with the async route handlers, against the same queries
+# run the old way: sync handlers with a blocking Session on FastAPI's threadpool.
+# Each app is served by uvicorn in its own process, the load comes from an httpx client here.
+#
+#     python benchmarks/async_db_benchmark.py --concurrency 50 --seconds 10 --writes 0.3
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+PATIENTS = 200
+
+
+def sync_app():
+    # the handlers as they were before the async engine, kept here as the baseline
+    from fastapi import FastAPI, Depends
+    from sqlalchemy.orm import Session
+    from database import get_db
+    from models import Patient, Prescription, MedicationSchedule, ScheduledCalls, CallLog
+    from routers.routes import CallLogCreate, build_call_log
+
+    app = FastAPI()
+
+    @app.post("/patients/call-logs/")
+    def create_call_log(call_log: CallLogCreate, db: Session = Depends(get_db)):
+        new_call_log = build_call_log(call_log)
+        db.add(new_call_log)
+        db.commit()
+        db.refresh(new_call_log)
+        return new_call_log
+
+    @app.get("/patients/{patient_id}")
+    def get_patient_details(patient_id: int, limit: int = 50, db: Session = Depends(get_db)):
+        return {
+            "patient": db.get(Patient, patient_id),
+            "prescriptions": db.query(Prescription).filter(Prescription.fk_patient_id == patient_id).limit(limit).all(),
+            "medication_schedules": db.query(MedicationSchedule).filter(MedicationSchedule.fk_patient_id == patient_id)
+            .order_by(MedicationSchedule.scheduled_time.desc()).limit(limit).all(),
+            "scheduled_calls": db.query(ScheduledCalls).filter(ScheduledCalls.fk_patient_id == patient_id)
+            .order_by(ScheduledCalls.call_time.desc()).limit(limit).all(),
+            "call_logs": db.query(CallLog).filter(CallLog.fk_patient_id == patient_id)
+            .order_by(CallLog.call_time.desc()).limit(limit).all(),
+        }
+
+    return app
+
+
+def async_app():
+    from fastapi import FastAPI
+    from routers import routes
+
+    app = FastAPI()
+    app.include_router(routes.router)
+    return app
+
+
+def seed():
+    from sqlalchemy import insert
+    from database import engine
+    from migrations import migrate
+    from models import Patient, CallLog
+
+    migrate()
+    start = datetime.datetime(2025, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(Patient), [
+            {"id": i, "first_name": "P", "last_name": str(i), "phone_number": "+10000000000"} for i in range(1, PATIENTS + 1)
+        ])
+        conn.execute(insert(CallLog), [
+            {"fk_patient_id": i % PATIENTS + 1, "call_time": start + datetime.timedelta(hours=i), "summary": "Doing well."}
+            for i in range(PATIENTS * 20)
+        ])
+
+
+def serve(kind: str, port: int):
+    import uvicorn
+
+    app = sync_app() if kind == "sync" else async_app()
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def load(base_url: str, concurrency: int, seconds: float, writes: float) -> dict:
+    import httpx
+
+    timings = {"read": [], "write": []}
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client_loop(client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            patient_id = random.randint(1, PATIENTS)
+            start = time.perf_counter()
+            if random.random() < writes:
+                kind = "write"
+                response = await client.post("/patients/call-logs/", json={"patient_id": patient_id, "summary": "Doing well."})
+            else:
+                kind = "read"
+                response = await client.get(f"/patients/{patient_id}", params={"limit": 20})
+            if response.status_code != 200:
+                errors += 1
+            timings[kind].append((time.perf_counter() - start) * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return {"timings": timings, "errors": errors}
+
+
+def wait_for_server(port: int):
+    import httpx
+
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/patients/1", timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def run(kind: str, port: int, args):
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind, "--port", str(port)],
+                              cwd=os.getcwd(), env=env)
+    try:
+        wait_for_server(port)
+        result = asyncio.run(load(f"http://127.0.0.1:{port}", args.concurrency, args.seconds, args.writes))
+    finally:
+        server.terminate()
+        server.wait()
+    total = sum(len(t) for t in result["timings"].values())
+    line = f"{kind}: {total / args.seconds:.0f} req/s, {result['errors']} error(s)"
+    for name, timings in result["timings"].items():
+        if timings:
+            timings.sort()
+            line += f", {name} p50 {timings[len(timings) // 2]:.1f}ms p95 {timings[int(len(timings) * 0.95)]:.1f}ms"
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writes", type=float, default=0.3, help="share of requests that are webhook writes")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", choices=["sync", "async"])
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        sys.exit(0)
+
+    workdir = tempfile.mkdtemp(prefix="async-db-benchmark-")
+    os.makedirs(os.path.join(workdir, "services", "logs"), exist_ok=True)
+    os.chdir(workdir)
+    try:
+        seed()
+        run("sync", args.port, args)
+        run("async", args.port + 1, args)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir)
@@ -0,0 +1,136 @@
+#dispatcher_harness.py
+# Runs N call dispatcher processes against one SQLite database and checks that every scheduled call is
+# placed exactly once, including rows left behind with an expired lease by a "crashed" dispatcher.
+# Twilio is replaced by a fake place_call that sleeps for --latency seconds and records the placement.
+#
+#     python benchmarks/dispatcher_harness.py --calls 200 --processes 1 2 4
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+
+def seed(calls: int, stale: int):
+    # runs inside the temp dir, so database.py's ./sql.db is the harness database
+    from database import SessionLocal
+    from migrations import migrate
+    from models import Patient, ScheduledCalls
+
+    migrate()
+    db = SessionLocal()
+    db.query(ScheduledCalls).delete()
+    db.query(Patient).delete()
+    patient = Patient(first_name="Load", last_name="Test", phone_number="+10000000000")
+    db.add(patient)
+    db.commit()
+    now = datetime.datetime.utcnow()
+    rows = [{"fk_patient_id": patient.id, "call_time": now - datetime.timedelta(seconds=i)} for i in range(calls)]
+    # claimed by a dispatcher that died: the lease has run out but the call was never placed
+    for row in rows[:stale]:
+        row["claimed_by"] = "crashed-worker"
+        row["lease_expiry"] = now - datetime.timedelta(seconds=1)
+    db.bulk_insert_mappings(ScheduledCalls, rows)
+    db.commit()
+    db.close()
+
+
+def remaining() -> int:
+    from database import SessionLocal
+    from models import ScheduledCalls
+
+    db = SessionLocal()
+    try:
+        return db.query(ScheduledCalls).filter(ScheduledCalls.dispatched_at.is_(None)).count()
+    finally:
+        db.close()
+
+
+def worker(latency: float, out_path: str):
+    from scheduler.dispatcher import CallDispatcher
+
+    with open(out_path, "a") as out:
+        def place_call(patient_data):
+            time.sleep(latency)
+            return f"CA{os.getpid()}{time.monotonic_ns()}"
+
+        dispatcher = CallDispatcher(place_call=place_call, calls_per_second=1000, max_concurrent=4,
+                                    batch_size=4, poll_seconds=0.1)
+        original = dispatcher.dispatch
+
+        def dispatch(scheduled_call_id, *args, **kwargs):
+            out.write(f"{scheduled_call_id} {time.time()}\n")
+            out.flush()
+            original(scheduled_call_id, *args, **kwargs)
+
+        dispatcher.dispatch = dispatch
+        dispatcher.start()
+        while remaining():
+            time.sleep(0.2)
+        dispatcher.stop()
+
+
+def run(processes: int, calls: int, stale: int, latency: float, workdir: str):
+    seed(calls, stale)
+    for path in glob.glob(os.path.join(workdir, "placed-*.txt")):
+        os.remove(path)
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    children = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", "--latency", str(latency),
+             "--out", os.path.join(workdir, f"placed-{i}.txt")],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for i in range(processes)
+    ]
+    for child in children:
+        child.wait()
+
+    placed = []
+    times = []
+    for path in glob.glob(os.path.join(workdir, "placed-*.txt")):
+        with open(path) as f:
+            for line in f:
+                scheduled_call_id, at = line.split()
+                placed.append(int(scheduled_call_id))
+                times.append(float(at))
+    # measured from the first to the last placement, process start-up isn't part of dispatch throughput
+    elapsed = max(times) - min(times) + latency
+    duplicates = len(placed) - len(set(placed))
+    missing = calls - len(set(placed))
+    print(f"{processes} process(es): {len(placed)} placements in {elapsed:.2f}s "
+          f"({len(placed) / elapsed:.0f} calls/s), {duplicates} duplicate(s), {missing} missing")
+    assert duplicates == 0 and missing == 0, "each scheduled call must be placed exactly once"
+    return len(placed) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--stale", type=int, default=20, help="rows left with an expired lease")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake Twilio request")
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--out")
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.latency, args.out)
+        sys.exit(0)
+
+    workdir = tempfile.mkdtemp(prefix="dispatcher-harness-")
+    os.makedirs(os.path.join(workdir, "services", "logs"), exist_ok=True)
+    os.chdir(workdir)
+    throughput = {n: run(n, args.calls, args.stale, args.latency, workdir) for n in args.processes}
+    base = throughput[args.processes[0]]
+    for n, rate in throughput.items():
+        print(f"{n} process(es): {rate / base:.2f}x the throughput of {args.processes[0]}")
+    os.chdir(ROOT)
+    shutil.rmtree(workdir)
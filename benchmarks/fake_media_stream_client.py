@@ -0,0 +1,140 @@
+#fake_media_stream_client.py
+# Plays the Twilio side of a streaming-mode call (CALL_MODE=stream) against /media_stream and reports
+# time to first audio for every utterance.
+#
+# Against a running server, for a call that already has a session:
+#     python benchmarks/fake_media_stream_client.py --url ws://localhost:8000/media_stream --call-sid CA... \
+#         --say "Hi, I'm doing well" --say "Yes I took my levothyroxine" --say "Goodbye"
+#
+# Or let the script start main:app itself with a stubbed Twilio client and silent TTS. It runs in a temp
+# directory with its own migrated SQLite database, so the repo's sql.db and logs are left alone:
+#     STREAM_STT=none STREAM_TTS=fake python benchmarks/fake_media_stream_client.py --serve --say "Hello"
+#
+# --audio sends a recorded raw 8kHz mu-law file as media frames before the text utterances.
+import argparse
+import asyncio
+import atexit
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+FRAME_BYTES = 160
+QUIET_SECONDS = 1.5
+
+
+async def wait_for_reply(ws, sent_at):
+    # collect frames until the server has been quiet for QUIET_SECONDS, echoing marks like Twilio does
+    first_audio = None
+    frames = 0
+    while True:
+        try:
+            message = json.loads(await asyncio.wait_for(ws.recv(), QUIET_SECONDS))
+        except asyncio.TimeoutError:
+            return first_audio, frames
+        except websockets.ConnectionClosed:
+            return first_audio, frames
+        if message["event"] == "media":
+            frames += 1
+            if first_audio is None and sent_at is not None:
+                first_audio = time.perf_counter() - sent_at
+        elif message["event"] == "mark":
+            await ws.send(json.dumps({"event": "mark", "streamSid": message["streamSid"], "mark": message["mark"]}))
+
+
+async def run_call(url, call_sid, utterances, audio_path=None):
+    stream_sid = f"MZ{call_sid}"
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"event": "connected", "protocol": "Call", "version": "1.0.0"}))
+        await ws.send(json.dumps({
+            "event": "start",
+            "start": {"streamSid": stream_sid, "callSid": call_sid, "customParameters": {"callSid": call_sid}},
+        }))
+        _, greeting_frames = await wait_for_reply(ws, None)
+        print(f"greeting: {greeting_frames} frames")
+
+        if audio_path:
+            with open(audio_path, "rb") as f:
+                audio = f.read()
+            for i in range(0, len(audio), FRAME_BYTES):
+                payload = base64.b64encode(audio[i:i + FRAME_BYTES]).decode()
+                await ws.send(json.dumps({"event": "media", "streamSid": stream_sid, "media": {"payload": payload}}))
+                await asyncio.sleep(0.02)
+            first_audio, frames = await wait_for_reply(ws, time.perf_counter())
+            print(f"audio file: first audio after end of audio {first_audio}, {frames} frames")
+
+        for text in utterances:
+            sent_at = time.perf_counter()
+            await ws.send(json.dumps({"event": "text", "streamSid": stream_sid, "text": text}))
+            first_audio, frames = await wait_for_reply(ws, sent_at)
+            if first_audio is None:
+                print(f"{text!r}: no audio")
+            else:
+                print(f"{text!r}: first audio after {first_audio * 1000:.0f}ms, {frames} frames")
+
+        try:
+            await ws.send(json.dumps({"event": "stop", "streamSid": stream_sid}))
+        except websockets.ConnectionClosed:
+            pass
+
+
+def serve(port):
+    # start main:app in this process with Twilio stubbed out and return the CallSid of a placed call
+    workdir = tempfile.mkdtemp(prefix="media-stream-")
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, "services", "logs"), exist_ok=True)
+    os.chdir(workdir)
+    # read when database.py is imported, so set before main is
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'sql.db')}"
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+
+    import uvicorn
+    import requests
+    import main
+    from migrations import migrate
+    from services import twiliogpt
+
+    migrate()
+
+    fake_twilio = types.SimpleNamespace(
+        calls=types.SimpleNamespace(create=lambda **kwargs: types.SimpleNamespace(sid="CAfakemediastream"))
+    )
+    twiliogpt.twilio_client = lambda: fake_twilio
+    server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    requests.post(f"http://127.0.0.1:{port}/make_call", json={
+        "first_name": "John", "last_name": "Doe", "follow_up_topics": "", "phone_number": "+10000000000",
+        "caregiver_number": "", "prescriptions": {"names": ["levothyroxine"]}, "bio": "", "hour": "9", "minute": "0",
+    })
+    return "CAfakemediastream"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/media_stream")
+    parser.add_argument("--call-sid")
+    parser.add_argument("--say", action="append", default=[])
+    parser.add_argument("--audio")
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    call_sid = args.call_sid
+    url = args.url
+    if args.serve:
+        call_sid = serve(args.port)
+        url = f"ws://127.0.0.1:{args.port}/media_stream"
+    if not call_sid:
+        parser.error("--call-sid is required unless --serve is used")
+    asyncio.run(run_call(url, call_sid, args.say, args.audio))
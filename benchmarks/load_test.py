@@ -0,0 +1,303 @@
+#load_test.py
+# Simulates N concurrent check-in calls against main:app, offline. The script starts the OpenAI stub
+# (stub_openai.py) and the Twilio stub (stub_twilio.py) in-process, runs `uvicorn main:app` in a temp
+# directory with its own SQLite database, and then plays Twilio for every synthetic patient:
+# /make_call -> /answer -> (/process_speech -> /answer) x --turns -> /call_ended. Speech is posted to the
+# <Gather action> URL of the last /answer, as Twilio does, so each turn carries its own seq and a repeated
+# utterance is a new turn rather than a webhook retry answered from the replay cache.
+#
+#     python benchmarks/load_test.py --calls 200 --turns 4 --openai-latency-ms 300
+#
+# Reported: turn latency percentiles (one /process_speech round trip), throughput, errors, and
+# cross-call leakage. Every patient is named with its own marker (LT00042) and says it on every turn; the
+# OpenAI stub echoes every marker in the prompt, so a reply or a stored transcript that carries
+# another patient's marker means state crossed between calls. Exits 1 on errors or leakage, so it
+# can gate CI. Everything is seeded and only talks to 127.0.0.1.
+import argparse
+import asyncio
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+import httpx
+import uvicorn
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_openai
+import stub_twilio
+
+MARKER = re.compile(r"\bLT\d{5}\b")
+UTTERANCES = [
+    "Hi, it's {marker}. I'm doing pretty well today, thanks for asking.",
+    "{marker} here, I went for a walk with my neighbor this morning.",
+    "My back has been a little sore but {marker} is managing fine.",
+    "Yes, {marker} took the morning pills with breakfast.",
+    "I talked to my nephew yesterday, this is {marker} by the way.",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def seed_patients(calls: int) -> list:
+    # runs inside the temp dir, so database.py's ./sql.db is the load test database
+    from database import SessionLocal
+    from migrations import migrate
+    from models import Patient
+
+    migrate()
+    db = SessionLocal()
+    try:
+        patients = [Patient(first_name=f"LT{i:05d}", last_name="Load", phone_number=f"+1555{i:07d}") for i in range(calls)]
+        db.add_all(patients)
+        db.commit()
+        return [(patient.id, patient.first_name, patient.phone_number) for patient in patients]
+    finally:
+        db.close()
+
+
+def call_logs() -> list:
+    from database import SessionLocal
+    from models import CallLog
+
+    db = SessionLocal()
+    try:
+        return db.query(CallLog.fk_patient_id, CallLog.transcription).all()
+    finally:
+        db.close()
+
+
+def said(twiml: str) -> str:
+    return " ".join(element.text or "" for element in ET.fromstring(twiml).iter("Say"))
+
+
+def gather_action(twiml: str) -> str:
+    # where Twilio posts the speech the <Gather> collected, relative to the app
+    gather = ET.fromstring(twiml).find(".//Gather")
+    if gather is None or not gather.get("action"):
+        raise RuntimeError("no <Gather action> in the TwiML")
+    action = urlsplit(gather.get("action"))
+    return f"{action.path}?{action.query}" if action.query else action.path
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+class Results:
+    def __init__(self):
+        self.turn_latencies = []
+        self.errors = []
+        self.leaks = []
+        self.completed_calls = 0
+
+    def check(self, marker: str, text: str, where: str):
+        others = set(MARKER.findall(text)) - {marker}
+        if others:
+            self.leaks.append(f"{marker} {where}: {sorted(others)}")
+
+
+async def run_call(client: httpx.AsyncClient, twilio: stub_twilio.StubTwilio, patient: tuple, args,
+                   rng: random.Random, results: Results):
+    patient_id, marker, phone = patient
+    # each call draws its schedule up front, so the run doesn't depend on task interleaving
+    start_delay = rng.uniform(0, args.ramp_seconds)
+    think = [rng.uniform(0, 2 * args.think_ms) / 1000 for _ in range(args.turns)]
+    utterances = [rng.choice(UTTERANCES).format(marker=marker) for _ in range(args.turns)]
+    await asyncio.sleep(start_delay)
+    try:
+        response = await client.post("/make_call", json={
+            "first_name": marker, "last_name": "Load", "follow_up_topics": "", "phone_number": phone,
+            "caregiver_number": "+15550000000", "prescriptions": {"names": ["levothyroxine"]}, "bio": "",
+            "hour": "9", "minute": "0", "patient_id": patient_id,
+        })
+        response.raise_for_status()
+        call_sid = twilio.call_sid(phone)
+        if call_sid is None:
+            raise RuntimeError("no call reached the Twilio stub")
+
+        response = await client.post("/answer", data={"CallSid": call_sid})
+        response.raise_for_status()
+        results.check(marker, said(response.text), "greeting")
+        action = gather_action(response.text)
+        for turn in range(args.turns):
+            await asyncio.sleep(think[turn])
+            sent_at = time.perf_counter()
+            response = await client.post(action, data={"CallSid": call_sid, "SpeechResult": utterances[turn]})
+            response.raise_for_status()
+            results.turn_latencies.append(time.perf_counter() - sent_at)
+            reply = said(response.text)
+            results.check(marker, reply, f"turn {turn}")
+            if "software issue" in reply:
+                raise RuntimeError(f"turn {turn} answered with the error message")
+            # Twilio follows the <Redirect> back to /answer for the next <Gather>
+            response = await client.post("/answer", data={"CallSid": call_sid})
+            response.raise_for_status()
+            action = gather_action(response.text)
+
+        response = await client.post("/call_ended", data={"CallSid": call_sid, "CallStatus": "completed"})
+        response.raise_for_status()
+        results.completed_calls += 1
+    except Exception as e:
+        results.errors.append(f"{marker}: {e!r}")
+
+
+async def drive(app_url: str, twilio: stub_twilio.StubTwilio, patients: list, args) -> tuple:
+    rng = random.Random(args.seed)
+    results = Results()
+    limits = httpx.Limits(max_connections=args.calls, max_keepalive_connections=args.calls)
+    async with httpx.AsyncClient(base_url=app_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[run_call(client, twilio, patient, args, rng, results) for patient in patients])
+        elapsed = time.perf_counter() - started
+        metrics = (await client.get("/metrics")).text
+    return results, elapsed, metrics
+
+
+def wait_for_app(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"main:app exited with {process.returncode}")
+        try:
+            if httpx.get(url + "/").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("main:app did not start")
+
+
+def report(results: Results, elapsed: float, patients: list, stored: list, args) -> bool:
+    turns = len(results.turn_latencies)
+    print(f"{len(patients)} calls x {args.turns} turns, {args.workers} worker(s), "
+          f"OpenAI {args.openai_latency_ms:.0f}ms + {args.tokens_per_second:.0f} tok/s, Twilio {args.twilio_latency_ms:.0f}ms")
+    if turns:
+        p50, p95, p99 = (percentile(results.turn_latencies, p) * 1000 for p in (0.5, 0.95, 0.99))
+        print(f"turn latency: p50 {p50:.0f}ms  p95 {p95:.0f}ms  p99 {p99:.0f}ms  max {max(results.turn_latencies) * 1000:.0f}ms")
+    print(f"throughput: {turns / elapsed:.1f} turns/s, {results.completed_calls / elapsed:.2f} calls/s over {elapsed:.1f}s")
+    print(f"completed calls: {results.completed_calls}/{len(patients)}, call logs written: {len(stored)}")
+
+    # the post-call summary and transcript must belong to the patient the call log is filed under
+    markers = {patient_id: marker for patient_id, marker, _ in patients}
+    for patient_id, transcription in stored:
+        if patient_id in markers:
+            results.check(markers[patient_id], transcription or "", "call log")
+    print(f"errors: {len(results.errors)}, cross-call leaks: {len(results.leaks)}")
+    for line in (results.errors + results.leaks)[:10]:
+        print(f"  {line}")
+    return not results.errors and not results.leaks and len(stored) == results.completed_calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100, help="concurrent synthetic patients")
+    parser.add_argument("--turns", type=int, default=4, help="patient utterances per call")
+    parser.add_argument("--ramp-seconds", type=float, default=2, help="calls start spread over this window")
+    parser.add_argument("--think-ms", type=float, default=500, help="mean pause before each utterance")
+    parser.add_argument("--openai-latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--twilio-latency-ms", type=float, default=150)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for main:app")
+    parser.add_argument("--drain-seconds", type=float, default=60, help="how long to wait for the post-call jobs")
+    parser.add_argument("--timeout", type=float, default=60, help="per-request timeout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the temp dir with the database and app log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    os.makedirs(os.path.join(workdir, "services", "logs"), exist_ok=True)
+    os.chdir(workdir)
+    patients = seed_patients(args.calls)
+
+    openai_port, twilio_port, app_port = free_port(), free_port(), free_port()
+    serve_in_thread(stub_openai.create_app(stub_openai.StubSettings(args.openai_latency_ms, args.tokens_per_second,
+                                                                    seed=args.seed)), openai_port)
+    twilio = stub_twilio.StubTwilio(args.twilio_latency_ms)
+    serve_in_thread(stub_twilio.create_app(twilio), twilio_port)
+
+    app_url = f"http://127.0.0.1:{app_port}"
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "OPENAI_API_KEY": "load-test",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "TWILIO_ACCOUNT_SID": "ACloadtest",
+        "TWILIO_AUTH_TOKEN": "load-test",
+        "TWILIO_PHONE_NUMBER": "+15550000001",
+        "TWILIO_API_BASE_URL": f"http://127.0.0.1:{twilio_port}",
+        "AI_VOICE": "alice",
+        "NGROK_URL": app_url,
+        "PATIENT_PHONE_NUMBER": "",
+        "CALL_MODE": "gather",
+        "ALERT_SENDER": "fake",
+        "DISPATCHER_ENABLED": "0",
+        "DATABASE_URL": "sqlite:///./sql.db",
+        "JOB_POLL_SECONDS": "0.2",
+        # migrated by seed_patients, the workers must not race on it
+        "MIGRATE_ON_STARTUP": "0",
+        # sessions have to be shared once there is more than one worker
+        "SESSION_BACKEND": "sqlite" if args.workers > 1 else "memory",
+        "SESSION_DB_PATH": os.path.join(workdir, "sessions.db"),
+    }
+    env.pop("ASYNC_DATABASE_URL", None)
+    with open(os.path.join(workdir, "app.log"), "w") as log:
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        wait_for_app(app_url, app)
+        results, elapsed, metrics = asyncio.run(drive(app_url, twilio, patients, args))
+        deadline = time.time() + args.drain_seconds
+        stored = call_logs()
+        while len(stored) < results.completed_calls and time.time() < deadline:
+            time.sleep(0.5)
+            stored = call_logs()
+        ok = report(results, elapsed, patients, stored, args)
+        server_turns = [line for line in metrics.splitlines()
+                        if line.startswith("hackmt_span_seconds_recent") and 'stage="turn"' in line]
+        if server_turns:
+            print("server-side turn spans (first worker scraped):")
+            for line in server_turns:
+                print(f"  {line}")
+        # each turn posts to its own <Gather action>, so nothing should come back from the replay cache
+        replays = [line for line in metrics.splitlines() if line.startswith("hackmt_webhook_replays_total{")]
+        if replays:
+            print("webhook replays, turn latencies above include cached answers:")
+            for line in replays:
+                print(f"  {line}")
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+        os.chdir(ROOT)
+        if args.keep:
+            print(f"kept {workdir}")
+        else:
+            shutil.rmtree(workdir)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,120 @@
+#lookup_benchmark.py
+# Cost of the per-patient lookups behind GET /patients/{patient_id} with the foreign key indexes and
+# without them (as sql.db was before they existed), at --rows rows per child table.
+#
+#     python benchmarks/lookup_benchmark.py --rows 1000000 --patients 10000
+import argparse
+import datetime
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+CHUNK = 50000
+
+
+def seed(engine, rows: int, patients: int):
+    from sqlalchemy import insert
+    from models import Patient, Prescription, MedicationSchedule, ScheduledCalls, CallLog
+
+    start = datetime.datetime(2025, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(Patient), [
+            {"id": i, "first_name": "P", "last_name": str(i), "phone_number": "+10000000000"} for i in range(1, patients + 1)
+        ])
+        conn.execute(insert(Prescription), [
+            {"id": i, "name": "levothyroxine", "fk_patient_id": i, "method": "oral", "dosage": 50, "units": "mcg",
+             "frequency": 1, "start_date": start} for i in range(1, patients + 1)
+        ])
+    for table, time_column, extra in [
+        (MedicationSchedule, "scheduled_time", lambda i: {"fk_prescription_id": i % patients + 1}),
+        (ScheduledCalls, "call_time", lambda i: {}),
+        (CallLog, "call_time", lambda i: {"summary": "Patient is doing well.", "follow_up": "garden"}),
+    ]:
+        for offset in range(0, rows, CHUNK):
+            batch = [
+                {"fk_patient_id": i % patients + 1, time_column: start + datetime.timedelta(minutes=i), **extra(i)}
+                for i in range(offset, min(offset + CHUNK, rows))
+            ]
+            with engine.begin() as conn:
+                conn.execute(insert(table), batch)
+
+
+def lookup(db, patient_id: int):
+    from models import Patient, Prescription, MedicationSchedule, ScheduledCalls, CallLog
+
+    db.query(Patient).filter(Patient.id == patient_id).first()
+    db.query(Prescription).filter(Prescription.fk_patient_id == patient_id).all()
+    db.query(MedicationSchedule).filter(MedicationSchedule.fk_patient_id == patient_id).all()
+    db.query(ScheduledCalls).filter(ScheduledCalls.fk_patient_id == patient_id).all()
+    db.query(CallLog).filter(CallLog.fk_patient_id == patient_id).order_by(CallLog.call_time.desc()).all()
+
+
+def measure(label: str, lookups: int, patients: int):
+    from database import SessionLocal
+
+    db = SessionLocal()
+    timings = []
+    for _ in range(lookups):
+        patient_id = random.randint(1, patients)
+        start = time.perf_counter()
+        lookup(db, patient_id)
+        timings.append((time.perf_counter() - start) * 1000)
+        db.expunge_all()
+    db.close()
+    timings.sort()
+    print(f"{label}: mean {statistics.mean(timings):.2f}ms, p50 {timings[len(timings) // 2]:.2f}ms, "
+          f"p95 {timings[int(len(timings) * 0.95)]:.2f}ms over {lookups} lookups")
+
+
+def explain(engine):
+    from sqlalchemy import text
+
+    with engine.connect() as conn:
+        plan = conn.execute(text("EXPLAIN QUERY PLAN SELECT * FROM call_logs WHERE fk_patient_id = 1 ORDER BY call_time DESC")).all()
+    print("  call_logs plan: " + "; ".join(row[-1] for row in plan))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000, help="rows in each of call_logs, scheduled_calls, medication_schedules")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="lookup-benchmark-")
+    os.makedirs(os.path.join(workdir, "services", "logs"), exist_ok=True)
+    os.chdir(workdir)
+    try:
+        from sqlalchemy import text
+        from database import engine
+        from migrations import migrate
+        import models
+
+        migrate()
+        start = time.perf_counter()
+        seed(engine, args.rows, args.patients)
+        print(f"seeded {args.rows} rows per table for {args.patients} patients in {time.perf_counter() - start:.0f}s")
+
+        explain(engine)
+        measure("with indexes", args.lookups, args.patients)
+
+        with engine.begin() as conn:
+            for table in models.Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    if any(column.name.startswith("fk_") for column in index.columns):
+                        conn.execute(text(f"DROP INDEX {index.name}"))
+        # pooled connections keep prepared statements planned against the old indexes
+        engine.dispose()
+        explain(engine)
+        # full scans are slow, a handful of lookups is enough to see it
+        measure("without indexes", max(5, args.lookups // 20), args.patients)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir)
@@ -0,0 +1,118 @@
+#startup_time.py
+# Cold-start cost of one worker: how long `import main` takes, and how long from spawning
+# `uvicorn main:app` until GET / answers (import + lifespan: migrations, clients, background threads).
+# Each run is a fresh interpreter in an empty temp directory with no API keys in the environment, and
+# importing main must leave that directory empty.
+#
+#     python benchmarks/startup_time.py --runs 5 --target-ms 2500
+#
+# Exits 1 when the median time to ready is over --target-ms, or when the import wrote anything.
+# --top lists the slowest imports (python -X importtime) to see where the time goes.
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+IMPORT_MAIN = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def clean_env() -> dict:
+    env = {key: value for key, value in os.environ.items()
+           if not key.startswith(("OPENAI_", "TWILIO_", "DATABASE_URL", "ASYNC_DATABASE_URL"))}
+    return {**env, "PYTHONPATH": ROOT, "PYTHONDONTWRITEBYTECODE": "1", "DISPATCHER_ENABLED": "0"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_time(workdir: str) -> tuple:
+    result = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=workdir, env=clean_env(),
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), sorted(os.listdir(workdir))
+
+
+def time_to_ready(workdir: str, timeout: float = 60) -> float:
+    port = free_port()
+    # a single worker migrating its own fresh database, so the cold start includes creating the schema
+    env = {**clean_env(), "OPENAI_API_KEY": "startup", "TWILIO_ACCOUNT_SID": "ACstartup", "TWILIO_AUTH_TOKEN": "startup",
+           "MIGRATE_ON_STARTUP": "1"}
+    # one client for all the polls, building one per request costs more than the poll interval
+    client = httpx.Client(timeout=1)
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {server.returncode}")
+            try:
+                if client.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                time.sleep(0.02)
+        raise RuntimeError("main:app did not start")
+    finally:
+        client.close()
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def slowest_imports(workdir: str, top: int) -> list:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir, env=clean_env(),
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # the modules main imports directly, deeper ones are already counted in their parent's cumulative time
+        if len(name) - len(name.lstrip()) == 3:
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target-ms", type=float, default=2500, help="median time to ready per worker")
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports")
+    args = parser.parse_args()
+
+    imports = []
+    readies = []
+    side_effects = set()
+    for _ in range(args.runs):
+        workdir = tempfile.mkdtemp(prefix="startup-time-")
+        try:
+            seconds, files = import_time(workdir)
+            imports.append(seconds)
+            side_effects.update(files)
+            readies.append(time_to_ready(workdir))
+        finally:
+            shutil.rmtree(workdir)
+
+    print(f"import main: median {statistics.median(imports) * 1000:.0f}ms, max {max(imports) * 1000:.0f}ms")
+    print(f"spawn to ready: median {statistics.median(readies) * 1000:.0f}ms, max {max(readies) * 1000:.0f}ms "
+          f"(target {args.target_ms:.0f}ms)")
+    if side_effects:
+        print(f"importing main wrote: {', '.join(sorted(side_effects))}")
+    if args.top:
+        workdir = tempfile.mkdtemp(prefix="startup-time-")
+        try:
+            for cumulative, name in slowest_imports(workdir, args.top):
+                print(f"  {cumulative / 1000:7.0f}ms  {name}")
+        finally:
+            shutil.rmtree(workdir)
+    ok = not side_effects and statistics.median(readies) * 1000 <= args.target_ms
+    sys.exit(0 if ok else 1)
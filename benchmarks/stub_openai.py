@@ -0,0 +1,130 @@
+#stub_openai.py
+# OpenAI-compatible chat completions server for load tests, no network or API key needed. Point the
+# backend at it with OPENAI_BASE_URL=http://127.0.0.1:8101/v1.
+#
+#     python benchmarks/stub_openai.py --port 8101 --latency-ms 300 --tokens-per-second 50
+#
+# Each request waits --latency-ms (time to first token) plus completion tokens / --tokens-per-second,
+# with +-jitter drawn from a seeded RNG. Structured outputs (response_format json_schema) get an object
+# with empty/false values for every property. Plain replies echo every load-test marker (LT00042...)
+# found in the prompt, so the driver can tell if one call's state showed up in another call's prompt.
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MARKER = re.compile(r"\bLT\d{5}\b")
+
+
+class StubSettings:
+    def __init__(self, latency_ms: float = 300, tokens_per_second: float = 50, jitter: float = 0.2, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def delay(self, base_seconds: float) -> float:
+        return max(0.0, base_seconds * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+
+def schema_value(schema: dict, defs: dict):
+    # the emptiest value that still validates against the schema
+    if "$ref" in schema:
+        return schema_value(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        return schema_value(schema["anyOf"][0], defs)
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: schema_value(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    return {"boolean": False, "integer": 0, "number": 0, "array": [], "null": None}.get(kind, "")
+
+
+def completion_text(body: dict) -> str:
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        return json.dumps(schema_value(schema, schema.get("$defs", {})))
+    prompt = " ".join(str(message.get("content") or "") for message in body.get("messages", []))
+    markers = sorted(set(MARKER.findall(prompt)))
+    return f"Thanks for telling me, {' '.join(markers) or 'friend'}. How are you feeling today?"
+
+
+def count_tokens(text: str) -> int:
+    # close enough to tiktoken for latency modelling
+    return max(1, len(text) // 4)
+
+
+def create_app(settings: StubSettings) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        settings.requests += 1
+        text = completion_text(body)
+        prompt_tokens = count_tokens(json.dumps(body.get("messages", [])))
+        completion_tokens = count_tokens(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "stub")
+        first_token = settings.delay(settings.latency_ms / 1000)
+        per_token = settings.delay(1 / settings.tokens_per_second) if settings.tokens_per_second > 0 else 0
+
+        if not body.get("stream"):
+            await asyncio.sleep(first_token + per_token * completion_tokens)
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text, "refusal": None}}],
+                "usage": usage,
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        async def stream():
+            await asyncio.sleep(first_token)
+            words = re.findall(r"\S+\s*", text)
+            for word in words:
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(per_token * count_tokens(word))
+            done = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            if include_usage:
+                final = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [], "usage": usage}
+                yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def stats():
+        return {"requests": settings.requests}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--latency-ms", type=float, default=300, help="time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--jitter", type=float, default=0.2, help="+- fraction applied to every delay")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(StubSettings(args.latency_ms, args.tokens_per_second, args.jitter, args.seed)),
+                host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,69 @@
+#stub_twilio.py
+# Stand-in for the Twilio REST API (calls.create and messages.create) for load tests. Point the backend
+# at it with TWILIO_API_BASE_URL=http://127.0.0.1:8102.
+#
+#     python benchmarks/stub_twilio.py --port 8102 --latency-ms 150
+#
+# Calls placed are kept by their To number, so a driver running in the same process can find the
+# CallSid of the call it is about to play (see load_test.py).
+import argparse
+import asyncio
+import itertools
+import threading
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class StubTwilio:
+    def __init__(self, latency_ms: float = 150):
+        self.latency_ms = latency_ms
+        self.calls = {}
+        self.messages = []
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+
+    def call_sid(self, to: str):
+        with self.lock:
+            return self.calls.get(to, {}).get("sid")
+
+
+def create_app(stub: StubTwilio) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/2010-04-01/Accounts/{account_sid}/Calls.json")
+    async def create_call(account_sid: str, request: Request):
+        form = await request.form()
+        await asyncio.sleep(stub.latency_ms / 1000)
+        call = {"sid": f"CA{next(stub.sequence):032d}", "account_sid": account_sid, "to": form.get("To"),
+                "from": form.get("From"), "status": "queued", "url": form.get("Url"),
+                "status_callback": form.get("StatusCallback")}
+        with stub.lock:
+            stub.calls[call["to"]] = call
+        return JSONResponse(call, status_code=201)
+
+    @app.post("/2010-04-01/Accounts/{account_sid}/Messages.json")
+    async def create_message(account_sid: str, request: Request):
+        form = await request.form()
+        await asyncio.sleep(stub.latency_ms / 1000)
+        message = {"sid": f"SM{next(stub.sequence):032d}", "account_sid": account_sid, "to": form.get("To"),
+                   "from": form.get("From"), "body": form.get("Body"), "status": "queued"}
+        with stub.lock:
+            stub.messages.append(message)
+        return JSONResponse(message, status_code=201)
+
+    @app.get("/stats")
+    def stats():
+        return {"calls": len(stub.calls), "messages": len(stub.messages)}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8102)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    args = parser.parse_args()
+    uvicorn.run(create_app(StubTwilio(args.latency_ms)), host="127.0.0.1", port=args.port, log_level="warning")
@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
 import os
 
 DEBUG_MODE = True
@@ -13,16 +15,120 @@ db_file = './sql.db'
 #     os.remove(db_file)
 #     print(f"Deleted existing database: {db_file}")
 
-DATABASE_URL = "sqlite:///./sql.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Storage profile, picked from the DATABASE_URL scheme.
+# SQLite: WAL so readers don't block the writer, synchronous=NORMAL (safe under WAL, no fsync per commit),
+# memory-mapped reads, a busy timeout, and foreign keys enforced (SQLite leaves them off per connection).
+# SQLite allows one writer at a time, so every write goes through
+# a single dedicated writer connection and waits for it in the pool instead of racing for the file lock
+# (one per engine, the sync and async writers and other processes fall back on the busy timeout).
+# Server databases (Postgres): a sized pool, pre-ping to drop dead connections and a statement timeout.
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# how long a write waits for the writer connection before giving up
+SQLITE_WRITER_TIMEOUT = float(os.getenv("SQLITE_WRITER_TIMEOUT", "30"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL is stored in the file; switching needs a lock, so only do it when it isn't set yet
+    cursor.execute("PRAGMA journal_mode")
+    if cursor.fetchone()[0] != "wal":
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}} if "aiosqlite" not in url else {}
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+    if url.startswith("postgresql+asyncpg"):
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+    elif url.startswith("postgresql"):
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+def build_engine(url: str, create=create_engine, writer: bool = False):
+    options = engine_options(url)
+    if writer:
+        options.update(pool_size=1, max_overflow=0, pool_timeout=SQLITE_WRITER_TIMEOUT)
+    new_engine = create(url, **options)
+    if url.startswith("sqlite"):
+        sync_engine = getattr(new_engine, "sync_engine", new_engine)
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    return new_engine
+
+
+class RoutingSession(Session):
+    # sends flushes and INSERT/UPDATE/DELETE statements to info["writer"] when the profile has one;
+    # once a transaction has written, its reads go there too so they see their own writes
+    def get_bind(self, mapper=None, clause=None, **kw):
+        writer = self.info.get("writer")
+        if writer is not None and (self._flushing or isinstance(clause, UpdateBase) or self.info.get("wrote")):
+            self.info["wrote"] = True
+            return writer
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def reset_writer_flag(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("wrote", None)
+
+
+engine = build_engine(DATABASE_URL)
+writer_engine = build_engine(DATABASE_URL, writer=True) if IS_SQLITE else None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=RoutingSession,
+                            info={"writer": writer_engine})
 Base = declarative_base()
 
+# Async engine for the route handlers, so dashboard and webhook requests don't queue for FastAPI's
+# threadpool. Same database through aiosqlite; point ASYNC_DATABASE_URL at postgresql+asyncpg://...
+# for Postgres. The job workers, dispatcher and create_all keep using the sync engine above.
+def async_url(url: str) -> str:
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:"):
+        return url.replace("postgresql:", "postgresql+asyncpg:", 1)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_url(DATABASE_URL))
+
+async_engine = build_engine(ASYNC_DATABASE_URL, create=create_async_engine)
+async_writer_engine = build_engine(ASYNC_DATABASE_URL, create=create_async_engine, writer=True) if IS_SQLITE else None
+# objects stay readable after commit, refreshing them would need another await
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False, sync_session_class=RoutingSession,
+    info={"writer": async_writer_engine.sync_engine if async_writer_engine is not None else None},
+)
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
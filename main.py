@@ -1,20 +1,71 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from contextlib import asynccontextmanager
 from services.twiliogpt import router as twiliogpt_router
+from services.media_stream import router as media_stream_router
+from services.events import router as events_router, event_bus
+from services.emergency import alert_dispatcher
+from services.model_router import model_router
+from services.audio_cache import audio_cache, router as audio_router
+from services.jobs import JobWorkerPool
+import services.post_call  # registers the post_call job handler
+from scheduler.dispatcher import CallDispatcher
+from scheduler.materializer import ScheduleMaterializer
+from services.metrics import http_request_seconds, instrument_engine, render, call_timeline
+from services.clients import open_clients, close_clients
+from migrations import migrate, MIGRATE_ON_STARTUP
+from database import engine, writer_engine, async_engine, async_writer_engine
 from loguru import logger
 from datetime import datetime
+import time
 import os
 from fastapi.middleware.cors import CORSMiddleware
 
 from routers import routes
 
-# FastAPI app initialization
-app = FastAPI()
-# logger config. To use just run logger.info("message")
+# Importing this module has no side effects beyond building the app: log files, the schema, API
+# clients and the background threads are all set up in lifespan(), once per worker after it has
+# been forked, and torn down in reverse order on shutdown.
+
+def add_log_sinks() -> list:
+    # logger config. To use just run logger.info("message")
+    log_dir = "logs"
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"log_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log")
+    return [
+        logger.add(log_file, format="{time} {level} {message}", level="INFO"),
+        logger.add(f"./services/logs/twiliogpt_{datetime.now().strftime('%Y-%m-%d_%H_%M')}.log", rotation="10MB"),
+    ]
+
+def build_workers() -> list:
+    # background threads, started in this order and stopped in reverse. The dispatcher's lease owner id
+    # includes the pid, so it has to be built in the worker process, not at import
+    workers = [event_bus, model_router, audio_cache, alert_dispatcher, JobWorkerPool()]
+    # set DISPATCHER_ENABLED=0 when the dispatcher and materializer run on their own (scheduler/backgroundScheduler.py)
+    if os.getenv("DISPATCHER_ENABLED", "1") == "1":
+        workers += [CallDispatcher(), ScheduleMaterializer()]
+    return workers
 
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"log_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log")
-logger.add(log_file, format="{time} {level} {message}", level="INFO")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sinks = add_log_sinks()
+    if MIGRATE_ON_STARTUP:
+        migrate()
+    open_clients()
+    workers = build_workers()
+    for worker in workers:
+        worker.start()
+    try:
+        yield
+    finally:
+        for worker in reversed(workers):
+            worker.stop()
+        await close_clients()
+        for sink in sinks:
+            logger.remove(sink)
+
+# FastAPI app initialization
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,10 +75,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# time every request by its route template, so /patients/1 and /patients/2 land in one series
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start_time = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        route = request.scope.get("route")
+        http_request_seconds.observe(time.perf_counter() - start_time, method=request.method,
+                                     route=route.path if route is not None else "unmatched")
+
+# the writer engines only exist on SQLite
+for db_engine in [engine, writer_engine, async_engine, async_writer_engine]:
+    if db_engine is not None:
+        instrument_engine(getattr(db_engine, "sync_engine", db_engine))
+
 # Include the Caregiver router
 app.include_router(routes.router)
 app.include_router(twiliogpt_router)
+app.include_router(media_stream_router)
+app.include_router(events_router)
+app.include_router(audio_router)
 
 @app.get("/")
 async def root():
     return {"message": "FastAPI is running!"}
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/calls/{call_sid}")
+def call_metrics(call_sid: str):
+    # the latest spans of one call, oldest first
+    return {"call_sid": call_sid, "spans": call_timeline(call_sid)}
@@ -0,0 +1,163 @@
+#migrations.py
+# Brings an existing sql.db up to date with models.py. create_all only creates missing tables, so
+# columns, foreign keys and indexes added to existing tables are applied here.
+#
+# Importing models doesn't touch the database. Run the migration once before starting the workers:
+#
+#     pyapi/bin/python migrations.py
+#
+# and again after pulling changes to models.py. With MIGRATE_ON_STARTUP=1 the app also runs it at
+# startup, which is only safe with a single worker; it is off by default, since several workers booting
+# at once would race on the schema.
+from datetime import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint
+from loguru import logger
+import enum
+import os
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "0") == "1"
+
+
+def _default_literal(column):
+    # SQL literal for the column's scalar default, used to fill the new column on existing rows
+    default = column.default
+    if default is None or not default.is_scalar:
+        return None
+    value = default.arg
+    if isinstance(value, enum.Enum):
+        # SQLAlchemy stores enums by name
+        value = value.name
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def retire_unscheduled_calls(conn):
+    # scheduled_calls rows from before the dispatcher were never dialed by anything, and would all come
+    # out pending and due. The ones whose time has passed are closed as missed; later ones stay booked
+    result = conn.execute(
+        text("UPDATE scheduled_calls SET status = 'missed', dispatched_at = call_time "
+             "WHERE dispatched_at IS NULL AND call_time <= :now"),
+        {"now": datetime.utcnow()},
+    )
+    logger.info(f"Marked {result.rowcount} scheduled calls from before the dispatcher as missed")
+
+
+# (table, column) -> data step run once the column has been added to an existing table
+BACKFILLS = {
+    ("scheduled_calls", "dispatched_at"): retire_unscheduled_calls,
+}
+
+
+def add_missing_columns(engine, metadata):
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            backfills = [BACKFILLS[(table.name, c.name)] for c in table.columns
+                         if c.name not in existing and (table.name, c.name) in BACKFILLS]
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                default = _default_literal(column)
+                if default is not None:
+                    ddl += f" DEFAULT {default}"
+                if not column.nullable and default is not None:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                logger.info(f"Added column {table.name}.{column.name}")
+            # after all of the table's columns, a step may set more than the column it is keyed on
+            for backfill in backfills:
+                backfill(conn)
+
+
+def _rebuild_sqlite_table(conn, inspector, table):
+    # SQLite can't add a constraint to an existing table: move it aside, recreate it from the model,
+    # copy the rows over and drop the old copy
+    existing = {c["name"] for c in inspector.get_columns(table.name)}
+    for index in inspector.get_indexes(table.name):
+        conn.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}__old"))
+    table.create(conn)
+    columns = ", ".join(c.name for c in table.columns if c.name in existing)
+    conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}__old"))
+    conn.execute(text(f"DROP TABLE {table.name}__old"))
+
+
+def add_missing_foreign_keys(engine, metadata):
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    sqlite = engine.dialect.name == "sqlite"
+    with engine.connect() as conn:
+        if sqlite:
+            # SQLite's recipe for rebuilding a table: foreign keys off while it is moved aside (the pragma
+            # can't change inside a transaction), and other tables' references kept on the table name
+            conn.execute(text("PRAGMA foreign_keys=OFF"))
+            conn.execute(text("PRAGMA legacy_alter_table=ON"))
+            conn.commit()
+        try:
+            with conn.begin():
+                # parents come first, so a rebuilt table never has children pointing at its old copy
+                for table in metadata.sorted_tables:
+                    if table.name not in existing_tables:
+                        continue
+                    existing = {
+                        (fk["constrained_columns"][0], fk["referred_table"])
+                        for fk in inspector.get_foreign_keys(table.name)
+                    }
+                    missing = [fk for fk in table.foreign_keys if (fk.parent.name, fk.column.table.name) not in existing]
+                    if not missing:
+                        continue
+                    if sqlite:
+                        _rebuild_sqlite_table(conn, inspector, table)
+                    else:
+                        for fk in missing:
+                            conn.execute(AddConstraint(fk.constraint))
+                    logger.info(f"Added foreign keys to {table.name}: {', '.join(fk.parent.name for fk in missing)}")
+                if sqlite:
+                    # rows copied over as they were, orphans from before the constraints are only reported
+                    orphans = conn.execute(text("PRAGMA foreign_key_check")).all()
+                    if orphans:
+                        tables = sorted({row[0] for row in orphans})
+                        logger.warning(f"{len(orphans)} rows reference missing parents in {', '.join(tables)}")
+        finally:
+            if sqlite:
+                conn.execute(text("PRAGMA legacy_alter_table=OFF"))
+                conn.execute(text("PRAGMA foreign_keys=ON"))
+                conn.commit()
+
+
+def create_missing_indexes(engine, metadata):
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def upgrade_schema(engine, metadata):
+    add_missing_columns(engine, metadata)
+    add_missing_foreign_keys(engine, metadata)
+    create_missing_indexes(engine, metadata)
+
+
+def migrate(engine=None):
+    from database import engine as default_engine
+    from models import Base
+
+    engine = engine or default_engine
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine, Base.metadata)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    migrate()
+    logger.info("Schema is up to date")
@@ -1,8 +1,8 @@
 from database import Base, engine
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Enum, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Date, Text, Enum, Float, Index, UniqueConstraint, event, update
 import datetime
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, Session
 from sqlalchemy.ext.declarative import declarative_base
 import enum
 
@@ -26,6 +26,12 @@ class MedicationLogStatus(enum.Enum):
     skipped = "skipped"
     delayed = "delayed"
 
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
 # ---------------------------
 # Caregiver Model
 # ---------------------------
@@ -38,7 +44,9 @@ class Caregiver(Base):
     phone_number = Column(String(20), nullable=False)
     email = Column(String(255), unique=True, nullable=False)
     password = Column(String(255), nullable=False)
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
+
+    patient = relationship("Patient", back_populates="caregivers")
 
 # ---------------------------
 # Patient Model
@@ -51,6 +59,14 @@ class Patient(Base):
     last_name = Column(String(100), nullable=False)
     phone_number = Column(String(20), nullable=False)
     bio = Column(Text, nullable=True)
+    # bumped whenever the patient or any of their rows change, used as the ETag of GET /patients/{id}
+    version = Column(Integer, default=0, nullable=False)
+
+    caregivers = relationship("Caregiver", back_populates="patient")
+    prescriptions = relationship("Prescription", back_populates="patient")
+    medication_schedules = relationship("MedicationSchedule", back_populates="patient")
+    scheduled_calls = relationship("ScheduledCalls", back_populates="patient")
+    call_logs = relationship("CallLog", back_populates="patient")
 
 # ---------------------------
 # Prescription Model
@@ -61,7 +77,7 @@ class Prescription(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
     nick = Column(String(100), nullable=True)
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
     method = Column(String(100), nullable=False)
     dosage = Column(Float, nullable=False)
     units = Column(String(50), nullable=False)
@@ -69,6 +85,11 @@ class Prescription(Base):
     start_date = Column(DateTime, nullable=False)
     end_date = Column(DateTime, nullable=True)
     instructions = Column(Text, nullable=True)
+    # medication_schedules rows exist up to here (scheduler/materializer.py)
+    materialized_until = Column(DateTime, nullable=True)
+
+    patient = relationship("Patient", back_populates="prescriptions")
+    medication_schedules = relationship("MedicationSchedule", back_populates="prescription")
 
 # ---------------------------
 # MedicationSchedule Model
@@ -77,11 +98,17 @@ class MedicationSchedule(Base):
     __tablename__ = "medication_schedules"
 
     id = Column(Integer, primary_key=True)
-    fk_prescription_id = Column(Integer)  # ForeignKey placeholder
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
+    fk_prescription_id = Column(Integer, ForeignKey("prescriptions.id"), index=True)
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"))
     scheduled_time = Column(DateTime, nullable=False)
     status = Column(Enum(MedicationScheduleStatus), default=MedicationScheduleStatus.active, nullable=False)
 
+    patient = relationship("Patient", back_populates="medication_schedules")
+    prescription = relationship("Prescription", back_populates="medication_schedules")
+    medication_logs = relationship("MedicationLog", back_populates="medication_schedule")
+
+    __table_args__ = (Index("ix_medication_schedules_patient_scheduled_time", "fk_patient_id", "scheduled_time"),)
+
 # ---------------------------
 # MedicationLog Model
 # ---------------------------
@@ -89,11 +116,14 @@ class MedicationLog(Base):
     __tablename__ = "medication_logs"
 
     id = Column(Integer, primary_key=True)
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
-    fk_medication_schedule_id = Column(Integer)  # ForeignKey placeholder
-    fk_call_log_id = Column(Integer)  # ForeignKey placeholder
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
+    fk_medication_schedule_id = Column(Integer, ForeignKey("medication_schedules.id"), index=True)
+    fk_call_log_id = Column(Integer, ForeignKey("call_logs.id"), index=True)
     status = Column(Enum(MedicationLogStatus), default=MedicationLogStatus.taken, nullable=False)
 
+    medication_schedule = relationship("MedicationSchedule", back_populates="medication_logs")
+    call_log = relationship("CallLog", back_populates="medication_logs")
+
 # ---------------------------
 # Scheduled Calls Model
 # ---------------------------
@@ -101,8 +131,29 @@ class ScheduledCalls(Base):
     __tablename__ = "scheduled_calls"
 
     id = Column(Integer, primary_key=True)
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"))
     call_time = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    status = Column(Enum(CallScheduleStatus), default=CallScheduleStatus.pending, nullable=False)
+    # set once the dispatcher (scheduler/dispatcher.py) has placed the call
+    dispatched_at = Column(DateTime, nullable=True)
+    call_sid = Column(String(64), nullable=True)
+    # lease held by the dispatcher placing the call, an expired lease can be claimed by another one
+    claimed_by = Column(String(100), nullable=True)
+    lease_expiry = Column(DateTime, nullable=True)
+    # failed tries to place the call, a transient failure holds the lease until the next try is due
+    dispatch_attempts = Column(Integer, default=0, nullable=False)
+    # 1 for the booked call, n for the (n-1)th retry of an unanswered one (scheduler/retry_policy.py)
+    attempt = Column(Integer, default=1, nullable=False)
+    # CallOutcome value from the call's status callback
+    outcome = Column(String(20), nullable=True)
+
+    patient = relationship("Patient", back_populates="scheduled_calls")
+
+    __table_args__ = (
+        Index("ix_scheduled_calls_patient_call_time", "fk_patient_id", "call_time"),
+        # the dispatcher scans undispatched rows in call_time order
+        Index("ix_scheduled_calls_dispatched_at_call_time", "dispatched_at", "call_time"),
+    )
 
 # ---------------------------
 # CallLog Model
@@ -111,12 +162,112 @@ class CallLog(Base):
     __tablename__ = "call_logs"
 
     id = Column(Integer, primary_key=True)
-    fk_patient_id = Column(Integer)  # ForeignKey placeholder
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"))
     call_time = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
     call_status = Column(Enum(CallScheduleStatus), default=CallScheduleStatus.pending, nullable=False)
+    # Twilio CallSid, at most one log per call even if /call_ended runs twice
+    call_sid = Column(String(64), nullable=True)
     transcription = Column(Text, nullable=True)
     summary = Column(Text, nullable=True)
     alert = Column(Text, nullable=True)
     follow_up = Column(Text, nullable=True)
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    patient = relationship("Patient", back_populates="call_logs")
+    medication_logs = relationship("MedicationLog", back_populates="call_log")
+
+    __table_args__ = (
+        Index("ix_call_logs_patient_call_time", "fk_patient_id", "call_time"),
+        Index("uq_call_logs_call_sid", "call_sid", unique=True),
+    )
+
+# ---------------------------
+# Job Model (durable background work, see services/jobs.py)
+# ---------------------------
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON
+    status = Column(Enum(JobStatus), default=JobStatus.queued, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_run_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    locked_until = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (Index("ix_jobs_status_next_run_at", "status", "next_run_at"),)
+
+# ---------------------------
+# Event Model (live call events for EVENTS_BACKEND=db, see services/events.py)
+# ---------------------------
+class Event(Base):
+    __tablename__ = "events"
+
+    id = Column(Integer, primary_key=True)
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    kind = Column(String(50), nullable=False)
+    data = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+# ---------------------------
+# LLM usage (one row per OpenAI request, see services/model_router.py)
+# ---------------------------
+class LlmUsage(Base):
+    __tablename__ = "llm_usage"
+
+    id = Column(Integer, primary_key=True)
+    call_sid = Column(String(64), nullable=True)
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), nullable=True)
+    # number of patient utterances so far, None for requests made outside a turn (post-call summary)
+    turn = Column(Integer, nullable=True)
+    task = Column(String(30), nullable=False)
+    model = Column(String(50), nullable=False)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+    latency_ms = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    __table_args__ = (Index("ix_llm_usage_call_sid", "call_sid"),)
+
+# ---------------------------
+# Adherence rollups (daily dose counts per patient and prescription, see services/adherence.py)
+# ---------------------------
+class AdherenceDaily(Base):
+    __tablename__ = "adherence_daily"
+
+    id = Column(Integer, primary_key=True)
+    fk_patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    fk_prescription_id = Column(Integer, ForeignKey("prescriptions.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    taken = Column(Integer, default=0, nullable=False)
+    skipped = Column(Integer, default=0, nullable=False)
+    delayed = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("fk_patient_id", "fk_prescription_id", "day", name="uq_adherence_daily_patient_prescription_day"),
+        Index("ix_adherence_daily_patient_day", "fk_patient_id", "day"),
+    )
+
+# ---------------------------
+# Patient versioning
+# ---------------------------
+def bump_patient_versions(connection, patient_ids, context: bool = True):
+    # call this after writes that bypass the ORM (bulk inserts), ORM flushes are handled below.
+    # The ids are also noted on the connection, services/patient_context.py drops them from its cache on commit.
+    # context=False is for rows the call context doesn't read (scheduled_calls), its cache entry is kept
+    patient_ids = {i for i in patient_ids if i is not None}
+    if patient_ids:
+        connection.execute(update(Patient).where(Patient.id.in_(patient_ids)).values(version=Patient.version + 1))
+        if context:
+            connection.info.setdefault("changed_patients", set()).update(patient_ids)
+
+@event.listens_for(Session, "after_flush")
+def bump_versions_on_flush(session, flush_context):
+    patient_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Patient):
+            patient_ids.add(obj.id)
+        elif hasattr(obj, "fk_patient_id") and not isinstance(obj, Caregiver):
+            patient_ids.add(obj.fk_patient_id)
+    bump_patient_versions(session.connection(), patient_ids)
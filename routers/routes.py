@@ -1,11 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from sqlalchemy import select, insert, or_, and_, DateTime
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from database import get_db
-from datetime import datetime
-from models import MedicationSchedule, Prescription, MedicationScheduleStatus, Patient, ScheduledCalls, Caregiver, CallScheduleStatus, CallLog, MedicationSchedule
-from typing import Optional
+from database import get_async_db
+from datetime import datetime, timedelta
+from models import MedicationSchedule, Prescription, MedicationScheduleStatus, Patient, ScheduledCalls, Caregiver, CallScheduleStatus, CallLog, MedicationSchedule, bump_patient_versions
+from scheduler.materializer import materialize_prescription, regenerate_prescription, MATERIALIZE_HORIZON_DAYS
+from services.adherence import adherence_query, adherence_summary
+from services.model_router import call_usage_query, call_usage, usage_summary_query, usage_summary
+from typing import List, Optional
+import hashlib
+import base64
 import random
+import json
 
 router = APIRouter()
 
@@ -43,6 +50,17 @@ class PrescriptionCreate(BaseModel):
     end_date: Optional[datetime] = None
     instructions: Optional[str] = None
 
+class PrescriptionUpdate(BaseModel):
+    name: Optional[str] = None
+    nick: Optional[str] = None
+    method: Optional[str] = None
+    dosage: Optional[float] = None
+    units: Optional[str] = None
+    frequency: Optional[int] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    instructions: Optional[str] = None
+
 # Medication Scheduling stuff
 class MedicationScheduleCreate(BaseModel):
     prescription_id: int
@@ -67,6 +85,7 @@ class CallLogCreate(BaseModel):
     patient_id: int
     call_time: Optional[datetime] = None
     call_status: CallScheduleStatus = CallScheduleStatus.pending
+    call_sid: Optional[str] = None
     transcription: Optional[str] = None
     summary: Optional[str] = None
     alert: Optional[str] = None
@@ -74,10 +93,10 @@ class CallLogCreate(BaseModel):
 
 # Register Caregiver
 @router.post("/register/")
-def register_caregiver(caregiver: CaregiverCreate, db: Session = Depends(get_db)):
+async def register_caregiver(caregiver: CaregiverCreate, db: AsyncSession = Depends(get_async_db)):
     if caregiver.password != caregiver.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match.")
-    if db.query(Caregiver).filter(Caregiver.email == caregiver.email).first():
+    if (await db.execute(select(Caregiver.id).where(Caregiver.email == caregiver.email))).first():
         raise HTTPException(status_code=400, detail="Email already exists.")
     # Create patient (DB assigns unique ID)
     new_patient = Patient(
@@ -87,8 +106,8 @@ def register_caregiver(caregiver: CaregiverCreate, db: Session = Depends(get_db)
         bio=caregiver.patient.bio
     )
     db.add(new_patient)
-    db.commit()
-    db.refresh(new_patient)
+    await db.commit()
+    await db.refresh(new_patient)
     # Create caregiver linked to patient via fk_patient_id
     new_caregiver = Caregiver(
         first_name=caregiver.first_name,
@@ -99,25 +118,66 @@ def register_caregiver(caregiver: CaregiverCreate, db: Session = Depends(get_db)
         fk_patient_id=new_patient.id
     )
     db.add(new_caregiver)
-    db.commit()
-    db.refresh(new_caregiver)
+    await db.commit()
+    await db.refresh(new_caregiver)
     return new_caregiver
 
 @router.post("/patients/", response_model=PatientCreate)
-def create_patient(patient: PatientCreate, db: Session = Depends(get_db)):
+async def create_patient(patient: PatientCreate, db: AsyncSession = Depends(get_async_db)):
     db_patient = Patient(
         first_name=patient.first_name,
         last_name=patient.last_name,
         phone_number=patient.phone_number
     )
     db.add(db_patient)
-    db.commit()
-    db.refresh(db_patient)
+    await db.commit()
+    await db.refresh(db_patient)
     return db_patient
 
 @router.post("/patients/prescriptions/")
-def create_prescription(prescription: PrescriptionCreate, db: Session = Depends(get_db)):
-    db_prescription = Prescription(
+async def create_prescription(prescription: PrescriptionCreate, db: AsyncSession = Depends(get_async_db)):
+    db_prescription = build_prescription(prescription)
+    db.add(db_prescription)
+    await db.flush()
+    # the first horizon of dose slots goes in with the prescription
+    until = datetime.utcnow() + timedelta(days=MATERIALIZE_HORIZON_DAYS)
+    await db.run_sync(lambda session: materialize_prescription(session, db_prescription, until))
+    await db.commit()
+    await db.refresh(db_prescription)
+    return db_prescription
+
+@router.post("/patients/prescriptions/bulk/")
+async def create_prescriptions(prescriptions: List[PrescriptionCreate], db: AsyncSession = Depends(get_async_db)):
+    db_prescriptions = [build_prescription(prescription) for prescription in prescriptions]
+    db.add_all(db_prescriptions)
+    await db.flush()
+    until = datetime.utcnow() + timedelta(days=MATERIALIZE_HORIZON_DAYS)
+
+    def materialize_all(session):
+        return sum(materialize_prescription(session, prescription, until) for prescription in db_prescriptions)
+
+    slots = await db.run_sync(materialize_all)
+    await db.commit()
+    return {"prescription_ids": [prescription.id for prescription in db_prescriptions], "medication_schedules": slots}
+
+@router.patch("/patients/prescriptions/{prescription_id}")
+async def update_prescription(prescription_id: int, changes: PrescriptionUpdate, db: AsyncSession = Depends(get_async_db)):
+    db_prescription = await db.get(Prescription, prescription_id)
+    if not db_prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    values = changes.model_dump(exclude_unset=True)
+    for key, value in values.items():
+        setattr(db_prescription, key, value)
+    await db.flush()
+    # only this prescription's future slots are rebuilt, and only when the timing changed
+    if values.keys() & {"frequency", "start_date", "end_date"}:
+        await db.run_sync(lambda session: regenerate_prescription(session, prescription_id))
+    await db.commit()
+    await db.refresh(db_prescription)
+    return db_prescription
+
+def build_prescription(prescription: PrescriptionCreate) -> Prescription:
+    return Prescription(
         name=prescription.name,
         nick=prescription.nick,
         fk_patient_id=prescription.patient_id,
@@ -129,15 +189,11 @@ def create_prescription(prescription: PrescriptionCreate, db: Session = Depends(
         end_date=prescription.end_date,
         instructions=prescription.instructions
     )
-    db.add(db_prescription)
-    db.commit()
-    db.refresh(db_prescription)
-    return db_prescription
 
 @router.post("/medication-schedules/")
-def create_medication_schedule(schedule: MedicationScheduleCreate, db: Session = Depends(get_db)):
+async def create_medication_schedule(schedule: MedicationScheduleCreate, db: AsyncSession = Depends(get_async_db)):
     # Fetch prescription and extract its fk_patient_id
-    prescription = db.query(Prescription).filter(Prescription.id == schedule.prescription_id).first()
+    prescription = await db.get(Prescription, schedule.prescription_id)
     if not prescription:
         raise HTTPException(status_code=404, detail="Prescription not found")
     patient_id_value = getattr(prescription, "fk_patient_id", None)
@@ -151,40 +207,68 @@ def create_medication_schedule(schedule: MedicationScheduleCreate, db: Session =
         fk_patient_id=patient_id_value
     )
     db.add(new_schedule)
-    db.commit()
-    db.refresh(new_schedule)
+    await db.commit()
+    await db.refresh(new_schedule)
     return new_schedule
 
+@router.post("/medication-schedules/bulk/")
+async def create_medication_schedules(schedules: List[MedicationScheduleCreate], db: AsyncSession = Depends(get_async_db)):
+    # one lookup for every prescription in the request and one multi-row insert
+    prescription_ids = {schedule.prescription_id for schedule in schedules}
+    patient_ids = dict((await db.execute(
+        select(Prescription.id, Prescription.fk_patient_id).where(Prescription.id.in_(prescription_ids))
+    )).all())
+    missing = prescription_ids - patient_ids.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Prescriptions not found: {sorted(missing)}")
+    rows = [
+        {"fk_prescription_id": schedule.prescription_id, "fk_patient_id": patient_ids[schedule.prescription_id],
+         "scheduled_time": schedule.scheduled_time, "status": schedule.status}
+        for schedule in schedules
+    ]
+    if rows:
+        await db.execute(insert(MedicationSchedule), rows)
+        await db.run_sync(lambda session: bump_patient_versions(session.connection(), patient_ids.values()))
+    await db.commit()
+    return {"medication_schedules": len(rows)}
+
 @router.post("/patients/scheduled-calls/")
-def create_scheduled_call(scheduled_calls: CreateScheduledCall, db: Session = Depends(get_db)):
+async def create_scheduled_call(scheduled_calls: CreateScheduledCall, db: AsyncSession = Depends(get_async_db)):
     new_schedule = ScheduledCalls(
         fk_patient_id=scheduled_calls.patient_id,
         call_time=scheduled_calls.call_time
     )
     db.add(new_schedule)
-    db.commit()
-    db.refresh(new_schedule)
+    await db.commit()
+    await db.refresh(new_schedule)
     return new_schedule
 
-@router.post("/patients/call-logs/")
-def create_call_log(call_log: CallLogCreate, db: Session = Depends(get_db)):
-    new_call_log = CallLog(
+# shared with the post_call job, which writes through a sync session
+def build_call_log(call_log: CallLogCreate) -> CallLog:
+    return CallLog(
         fk_patient_id=call_log.patient_id,
         call_time=call_log.call_time or datetime.utcnow(),
         call_status=call_log.call_status,
+        call_sid=call_log.call_sid,
         transcription=call_log.transcription,
         summary=call_log.summary,
         alert=call_log.alert,
         follow_up=call_log.follow_up
     )
+
+@router.post("/patients/call-logs/")
+async def create_call_log(call_log: CallLogCreate, db: AsyncSession = Depends(get_async_db)):
+    if call_log.call_sid and (await db.execute(select(CallLog.id).where(CallLog.call_sid == call_log.call_sid))).first():
+        raise HTTPException(status_code=400, detail="This call already has a call log.")
+    new_call_log = build_call_log(call_log)
     db.add(new_call_log)
-    db.commit()
-    db.refresh(new_call_log)
+    await db.commit()
+    await db.refresh(new_call_log)
     return new_call_log
 
 @router.post("/login/")
-def login_caregiver(caregiver: CaregiverLogin, db: Session = Depends(get_db)):
-    db_caregiver = db.query(Caregiver).filter(Caregiver.email == caregiver.email).first()
+async def login_caregiver(caregiver: CaregiverLogin, db: AsyncSession = Depends(get_async_db)):
+    db_caregiver = (await db.execute(select(Caregiver).where(Caregiver.email == caregiver.email))).scalars().first()
     if not db_caregiver or db_caregiver.password != caregiver.password:
         raise HTTPException(status_code=401, detail="Invalid credentials.")
     return {
@@ -195,19 +279,126 @@ def login_caregiver(caregiver: CaregiverLogin, db: Session = Depends(get_db)):
         "patient_id": db_caregiver.fk_patient_id
     }
 
+@router.get("/patients/{patient_id}/adherence")
+async def get_patient_adherence(patient_id: int, db: AsyncSession = Depends(get_async_db)):
+    # taken/skipped/delayed over the last 7/30/90 days, per patient and per prescription, from the daily rollups
+    if (await db.execute(select(Patient.id).where(Patient.id == patient_id))).first() is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    rows = (await db.execute(adherence_query(patient_id, datetime.utcnow().date()))).all()
+    return adherence_summary(patient_id, rows)
+
+# LLM tokens, cost and latency (services/model_router.py)
+@router.get("/usage/calls/{call_sid}")
+async def get_call_usage(call_sid: str, db: AsyncSession = Depends(get_async_db)):
+    rows = (await db.execute(call_usage_query(call_sid))).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="No usage recorded for this call")
+    return call_usage(call_sid, rows)
+
+@router.get("/usage/summary")
+async def get_usage_summary(hours: int = Query(24, ge=1, le=24 * 90), db: AsyncSession = Depends(get_async_db)):
+    rows = (await db.execute(usage_summary_query(datetime.utcnow() - timedelta(hours=hours)))).all()
+    return {"hours": hours, "routes": usage_summary(rows)}
+
+# Patient details: each collection is paginated with an opaque cursor and can be projected with
+# fields=collection.column,... (id is always returned). The ETag changes with Patient.version, so
+# repeat polls with If-None-Match get a 304 after a single primary key lookup.
+PATIENT_COLLECTIONS = {
+    # name: (model, sort column, newest first)
+    "prescriptions": (Prescription, Prescription.id, False),
+    "medication_schedules": (MedicationSchedule, MedicationSchedule.scheduled_time, True),
+    "scheduled_calls": (ScheduledCalls, ScheduledCalls.call_time, True),
+    "call_logs": (CallLog, CallLog.call_time, True),
+}
+
+def encode_cursor(sort_value, row_id: int) -> str:
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode()
+
+def decode_cursor(cursor: str, sort_column):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(sort_column.type, DateTime):
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_fields(fields: Optional[str]) -> dict:
+    # "call_logs.id,call_logs.call_time,patient.first_name" -> {"call_logs": ["id", "call_time"], ...}
+    projection = {}
+    for field in (fields or "").split(","):
+        if not field.strip():
+            continue
+        collection, _, column = field.strip().partition(".")
+        model = Patient if collection == "patient" else PATIENT_COLLECTIONS.get(collection, (None,))[0]
+        if model is None or column not in model.__table__.columns:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        projection.setdefault(collection, ["id"])
+        if column not in projection[collection]:
+            projection[collection].append(column)
+    return projection
+
+def selected_columns(model, names: Optional[list]) -> list:
+    table = model.__table__
+    return [table.c[name] for name in names] if names else list(table.c)
+
+async def fetch_page(db: AsyncSession, name: str, patient_id: int, columns: list, cursor: Optional[str], limit: int):
+    model, sort_column, newest_first = PATIENT_COLLECTIONS[name]
+    query = select(*columns, sort_column.label("_sort"), model.id.label("_id")).where(model.fk_patient_id == patient_id)
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor, sort_column)
+        if newest_first:
+            query = query.where(or_(sort_column < sort_value, and_(sort_column == sort_value, model.id < row_id)))
+        else:
+            query = query.where(or_(sort_column > sort_value, and_(sort_column == sort_value, model.id > row_id)))
+    if newest_first:
+        query = query.order_by(sort_column.desc(), model.id.desc())
+    else:
+        query = query.order_by(sort_column, model.id)
+    # one extra row tells us whether there is a next page
+    rows = (await db.execute(query.limit(limit + 1))).mappings().all()
+    next_cursor = encode_cursor(rows[limit - 1]["_sort"], rows[limit - 1]["_id"]) if len(rows) > limit else None
+    items = [{column.name: row[column.name] for column in columns} for row in rows[:limit]]
+    return items, next_cursor
+
 @router.get("/patients/{patient_id}")
-def get_patient_details(patient_id: int, db: Session = Depends(get_db)):
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
-    if not patient:
+async def get_patient_details(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    fields: Optional[str] = None,
+    prescriptions_cursor: Optional[str] = None,
+    medication_schedules_cursor: Optional[str] = None,
+    scheduled_calls_cursor: Optional[str] = None,
+    call_logs_cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    version = (await db.execute(select(Patient.version).where(Patient.id == patient_id))).scalar()
+    if version is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    prescriptions = db.query(Prescription).filter(Prescription.fk_patient_id == patient_id).all()
-    medication_schedules = db.query(MedicationSchedule).filter(MedicationSchedule.fk_patient_id == patient_id).all()
-    scheduled_calls = db.query(ScheduledCalls).filter(ScheduledCalls.fk_patient_id == patient_id).all()
-    call_logs = db.query(CallLog).filter(CallLog.fk_patient_id == patient_id).all()
-    return {
-        "patient": patient,
-        "prescriptions": prescriptions,
-        "medication_schedules": medication_schedules,
-        "scheduled_calls": scheduled_calls,
-        "call_logs": call_logs,
+    # the same patient version renders differently per page/projection, so the query string is part of the tag
+    query_hash = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode()).hexdigest()[:12]
+    etag = f'W/"{patient_id}-{version}-{query_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    projection = parse_fields(fields)
+    cursors = {
+        "prescriptions": prescriptions_cursor,
+        "medication_schedules": medication_schedules_cursor,
+        "scheduled_calls": scheduled_calls_cursor,
+        "call_logs": call_logs_cursor,
     }
+    patient = (await db.execute(select(*selected_columns(Patient, projection.get("patient"))).where(Patient.id == patient_id))).mappings().first()
+    result = {"patient": dict(patient)}
+    next_cursors = {}
+    for name, (model, _, _) in PATIENT_COLLECTIONS.items():
+        columns = selected_columns(model, projection.get(name))
+        result[name], next_cursors[name] = await fetch_page(db, name, patient_id, columns, cursors[name], limit)
+    result["next_cursors"] = next_cursors
+    return result
@@ -1,48 +1,39 @@
-from apscheduler.schedulers.background import BackgroundScheduler
+# Runs the call dispatcher (scheduler/dispatcher.py) and the medication schedule materializer
+# (scheduler/materializer.py) as their own process, for deployments that keep them out of the web
+# workers. Start the web app with DISPATCHER_ENABLED=0 in that case.
+#
+#     pyapi/bin/python -m scheduler.backgroundScheduler
+#
+# Placing a call saves its session here, and the web workers answer the call's webhooks, so both sides
+# need the same shared session store (SESSION_BACKEND=sqlite with the same SESSION_DB_PATH). With the
+# in-memory store /answer would never find the session, and this process refuses to start.
+from dotenv import load_dotenv
+from loguru import logger
 import time
-import requests
-from pydantic import BaseModel
-
-
-class CallRequest(BaseModel):
-    first_name: str
-    last_name: str
-    follow_up_topics: str
-    phone_number: str
-    caregiver_number: str
-    prescriptions: dict
-    bio: str
-    hour: str
-    minute: str
-
-def bot_request(call_schedule: CallRequest):
-    # Call API to schedule call
-    url = "http://127.0.0.1:8000/make_call"
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=call_schedule.model_dump_json())
-    
-
-def schedule_call(call_schedule: CallRequest):
-    hour, minute = call_schedule.hour, call_schedule.minute
-    
-    scheduler = BackgroundScheduler()
-
-    scheduler.add_job(bot_request, 'cron', hour=hour, minute=minute, args=[call_schedule])
-    scheduler.start()
-
-
-dummy_data = CallRequest(
-    first_name="John",
-    last_name="Doe",
-    follow_up_topics="Nephew's piano concert, back pain, medication refills",
-    phone_number="+16159240230",
-    caregiver_number="drewh6472@gmail.com",
-    prescriptions={"levothyroxine": "taken", "ibuprofen": "not", "amlodipine" : "delayed"},
-    bio="John is a 65 year old man who loves football. He has diabetes and high blood pressure.",
-    hour="4",
-    minute="6",
-)
-schedule_call(dummy_data)
-
-while True:
-    time.sleep(1)
+import sys
+import os
+
+load_dotenv()
+
+from scheduler.dispatcher import CallDispatcher
+from scheduler.materializer import ScheduleMaterializer
+from migrations import migrate, MIGRATE_ON_STARTUP
+
+
+if __name__ == "__main__":
+    if os.getenv("SESSION_BACKEND", "memory") == "memory":
+        logger.error("The standalone dispatcher needs a session store shared with the web workers, "
+                     "set SESSION_BACKEND=sqlite and the same SESSION_DB_PATH for both")
+        sys.exit(1)
+    if MIGRATE_ON_STARTUP:
+        migrate()
+    dispatcher = CallDispatcher()
+    materializer = ScheduleMaterializer()
+    dispatcher.start()
+    materializer.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        dispatcher.stop()
+        materializer.stop()
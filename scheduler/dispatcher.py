@@ -0,0 +1,308 @@
+#dispatcher.py
+# Places the calls booked in the scheduled_calls table. One dispatcher per process scans for due rows
+# (dispatched_at IS NULL AND call_time <= now, through ix_scheduled_calls_dispatched_at_call_time),
+# claims a batch and places the calls directly through services.twiliogpt.place_call. A thread pool caps
+# how many Twilio requests are in flight and a token bucket keeps them under Twilio's calls-per-second
+# limit for the account.
+#
+# Any number of dispatchers can share one database. A row is claimed by an UPDATE ... WHERE that only
+# matches rows nobody holds a live lease on, so each due row goes to exactly one dispatcher; if that
+# dispatcher dies before placing the call, its lease expires and another one picks the row up.
+# Twilio's calls-per-second limit is per account, so with N dispatchers set DISPATCH_CALLS_PER_SECOND
+# to the account limit divided by N.
+#
+# A placement that fails for a reason that may go away (Twilio 429 or 5xx, a connection error, the
+# database) keeps its lease for DISPATCH_RETRY_SECONDS, doubling per try, and is then claimed again. It is
+# marked missed after DISPATCH_MAX_ATTEMPTS tries, or straight away for an unknown patient or a call
+# Twilio rejects.
+#
+# A row more than DISPATCH_MAX_LATENESS_SECONDS past its call time (the dispatcher was down, or the row
+# was booked in the past) is marked missed instead of dialed, nobody wants a check-in call hours late.
+#
+# Every poll also loads the patient context (services/patient_context.py) of everybody due within the
+# next DISPATCH_PREWARM_SECONDS into the cache, so placing a call doesn't wait on the database.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from loguru import logger
+import threading
+import socket
+import uuid
+import time
+import os
+
+from database import SessionLocal
+from models import ScheduledCalls, CallScheduleStatus, bump_patient_versions
+from services.patient_context import patient_contexts, call_request
+from services.metrics import scheduler_lag_seconds, scheduler_last_lag_seconds
+
+# Twilio's default outbound limit is 1 call per second per account, raise it here if yours is higher
+DISPATCH_CALLS_PER_SECOND = float(os.getenv("DISPATCH_CALLS_PER_SECOND", "1"))
+DISPATCH_MAX_CONCURRENT = int(os.getenv("DISPATCH_MAX_CONCURRENT", "8"))
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "50"))
+DISPATCH_POLL_SECONDS = float(os.getenv("DISPATCH_POLL_SECONDS", "5"))
+# must cover the wait for a rate limiter slot plus the Twilio request
+DISPATCH_LEASE_SECONDS = int(os.getenv("DISPATCH_LEASE_SECONDS", "120"))
+DISPATCH_PREWARM_SECONDS = int(os.getenv("DISPATCH_PREWARM_SECONDS", "300"))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "5"))
+DISPATCH_RETRY_SECONDS = float(os.getenv("DISPATCH_RETRY_SECONDS", "30"))
+# 0 dials due rows however late they are
+DISPATCH_MAX_LATENESS_SECONDS = int(os.getenv("DISPATCH_MAX_LATENESS_SECONDS", "3600"))
+# kept under the patient context cache size and SQLite's bound parameter limit
+DISPATCH_PREWARM_MAX_PATIENTS = int(os.getenv("DISPATCH_PREWARM_MAX_PATIENTS", "1000"))
+
+
+class RateLimiter:
+    # token bucket, acquire() blocks until a call may be placed
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient(error: Exception) -> bool:
+    # worth another try: Twilio throttling or server errors, a connection that never reached Twilio,
+    # or the database. A read timeout is not, the call may have been created
+    from requests.exceptions import ConnectionError
+    from twilio.base.exceptions import TwilioRestException
+
+    if isinstance(error, TwilioRestException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (ConnectionError, SQLAlchemyError))
+
+
+def build_call_request(db, patient_id: int, call_time: datetime) -> dict:
+    # the same fields the dashboard posts to /make_call, from the patient context cache
+    context = patient_contexts.load(db, [patient_id]).get(patient_id)
+    if context is None:
+        raise ValueError(f"Patient {patient_id} not found")
+    return call_request(context, call_time)
+
+
+class CallDispatcher:
+    def __init__(self, place_call=None, calls_per_second: float = DISPATCH_CALLS_PER_SECOND,
+                 max_concurrent: int = DISPATCH_MAX_CONCURRENT, batch_size: int = DISPATCH_BATCH_SIZE,
+                 poll_seconds: float = DISPATCH_POLL_SECONDS, lease_seconds: int = DISPATCH_LEASE_SECONDS,
+                 prewarm_seconds: int = DISPATCH_PREWARM_SECONDS,
+                 max_lateness_seconds: int = DISPATCH_MAX_LATENESS_SECONDS,
+                 max_attempts: int = DISPATCH_MAX_ATTEMPTS, retry_seconds: float = DISPATCH_RETRY_SECONDS):
+        if place_call is None:
+            from services.twiliogpt import place_call
+        self.place_call = place_call
+        self.limiter = RateLimiter(calls_per_second)
+        self.max_concurrent = max_concurrent
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.prewarm_seconds = prewarm_seconds
+        self.max_lateness_seconds = max_lateness_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.next_prewarm = 0.0
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="dispatch")
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        # set when a placement finishes or on stop, so a full dispatcher rechecks as soon as a slot frees up
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="call-dispatcher", daemon=True)
+        self._thread.start()
+        logger.info(f"Call dispatcher {self.worker_id} started ({self.max_concurrent} concurrent, {self.limiter.rate} calls/s)")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.executor.shutdown(wait=True)
+
+    def expire_stale(self, db, now: datetime) -> int:
+        # marks the rows too late to dial as missed, unless a dispatcher is placing them right now
+        if not self.max_lateness_seconds:
+            return 0
+        expirable = (
+            ScheduledCalls.dispatched_at.is_(None),
+            ScheduledCalls.status == CallScheduleStatus.pending,
+            ScheduledCalls.call_time < now - timedelta(seconds=self.max_lateness_seconds),
+            or_(ScheduledCalls.claimed_by.is_(None), ScheduledCalls.lease_expiry < now),
+        )
+        rows = db.execute(select(ScheduledCalls.id, ScheduledCalls.fk_patient_id).where(*expirable)).all()
+        if not rows:
+            return 0
+        # rechecked on the UPDATE, a row claimed in between is left alone
+        stale = db.execute(
+            update(ScheduledCalls)
+            .where(ScheduledCalls.id.in_([row.id for row in rows]), *expirable)
+            .values(status=CallScheduleStatus.missed, dispatched_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        bump_patient_versions(db.connection(), [row.fk_patient_id for row in rows], context=False)
+        if stale:
+            logger.warning(f"Marked {stale} scheduled calls missed, more than {self.max_lateness_seconds}s past their call time")
+        return stale
+
+    def claim_due(self, db, limit: int) -> list:
+        # returns [(id, fk_patient_id, call_time, dispatch_attempts)] for the rows this dispatcher now holds a lease on
+        now = datetime.utcnow()
+        lease_expiry = now + timedelta(seconds=self.lease_seconds)
+        self.expire_stale(db, now)
+        claimable = (
+            ScheduledCalls.dispatched_at.is_(None),
+            ScheduledCalls.status == CallScheduleStatus.pending,
+            ScheduledCalls.call_time <= now,
+            or_(ScheduledCalls.claimed_by.is_(None), ScheduledCalls.lease_expiry < now),
+        )
+        due = select(ScheduledCalls.id).where(*claimable).order_by(ScheduledCalls.call_time).limit(limit)
+        # the conditions are repeated on the UPDATE itself, so a row another dispatcher claimed
+        # in the meantime no longer matches and is skipped
+        claimed = db.execute(
+            update(ScheduledCalls)
+            .where(ScheduledCalls.id.in_(due.scalar_subquery()), *claimable)
+            .values(claimed_by=self.worker_id, lease_expiry=lease_expiry)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            db.commit()
+            return []
+        rows = db.execute(
+            select(ScheduledCalls.id, ScheduledCalls.fk_patient_id, ScheduledCalls.call_time,
+                   ScheduledCalls.dispatch_attempts)
+            .where(
+                ScheduledCalls.claimed_by == self.worker_id,
+                ScheduledCalls.lease_expiry == lease_expiry,
+                ScheduledCalls.dispatched_at.is_(None),
+            )
+            .order_by(ScheduledCalls.call_time)
+        ).all()
+        # the claim shows in GET /patients/{id}, its ETag must change
+        bump_patient_versions(db.connection(), [row.fk_patient_id for row in rows], context=False)
+        db.commit()
+        return rows
+
+    def prewarm(self, db) -> int:
+        # caches the context of every patient due within prewarm_seconds, only uncached ones are read
+        horizon = datetime.utcnow() + timedelta(seconds=self.prewarm_seconds)
+        patient_ids = db.execute(
+            select(ScheduledCalls.fk_patient_id)
+            .where(
+                ScheduledCalls.dispatched_at.is_(None),
+                ScheduledCalls.status == CallScheduleStatus.pending,
+                ScheduledCalls.call_time <= horizon,
+            )
+            .group_by(ScheduledCalls.fk_patient_id)
+            .order_by(func.min(ScheduledCalls.call_time))
+            .limit(DISPATCH_PREWARM_MAX_PATIENTS)
+        ).scalars().all()
+        return len(patient_contexts.load(db, patient_ids))
+
+    def tick(self) -> int:
+        if time.monotonic() >= self.next_prewarm:
+            self.next_prewarm = time.monotonic() + self.poll_seconds
+            db = SessionLocal()
+            try:
+                self.prewarm(db)
+            finally:
+                db.close()
+        with self.lock:
+            free = self.max_concurrent - self.in_flight
+        if free <= 0:
+            return 0
+        db = SessionLocal()
+        try:
+            rows = self.claim_due(db, min(free, self.batch_size))
+        finally:
+            db.close()
+        for row in rows:
+            with self.lock:
+                self.in_flight += 1
+            self.executor.submit(self.dispatch, row.id, row.fk_patient_id, row.call_time, row.dispatch_attempts)
+        return len(rows)
+
+    def failed(self, attempts: int, error: Exception) -> dict:
+        # the row's new values after a failed try, attempts counts the earlier ones
+        attempts += 1
+        if is_transient(error) and attempts < self.max_attempts:
+            retry_at = datetime.utcnow() + timedelta(seconds=self.retry_seconds * 2 ** (attempts - 1))
+            return {"dispatch_attempts": attempts, "lease_expiry": retry_at}
+        return {"dispatch_attempts": attempts, "status": CallScheduleStatus.missed, "dispatched_at": datetime.utcnow()}
+
+    def dispatch(self, scheduled_call_id: int, patient_id: int, call_time: datetime, attempts: int = 0):
+        db = SessionLocal()
+        call_sid = None
+        try:
+            patient_data = build_call_request(db, patient_id, call_time)
+            self.limiter.acquire()
+            lag = (datetime.utcnow() - call_time).total_seconds()
+            scheduler_lag_seconds.observe(lag)
+            scheduler_last_lag_seconds.set(lag)
+            call_sid = self.place_call(patient_data)
+            db.execute(
+                update(ScheduledCalls)
+                .where(ScheduledCalls.id == scheduled_call_id)
+                .values(call_sid=call_sid, dispatched_at=datetime.utcnow())
+            )
+            bump_patient_versions(db.connection(), [patient_id], context=False)
+            db.commit()
+            logger.info(f"Scheduled call {scheduled_call_id} placed as {call_sid}, {lag:.1f}s after its call time")
+        except Exception as e:
+            db.rollback()
+            if call_sid is not None:
+                # the call went out and only recording it failed, it must not be placed again
+                values = {"call_sid": call_sid, "dispatched_at": datetime.utcnow()}
+                logger.error(f"Scheduled call {scheduled_call_id} placed as {call_sid}, but not recorded: {e!r}")
+            else:
+                values = self.failed(attempts, e)
+                if "status" in values:
+                    logger.error(f"Scheduled call {scheduled_call_id} could not be placed, marked missed: {e!r}")
+                else:
+                    logger.warning(f"Scheduled call {scheduled_call_id} could not be placed, retrying at "
+                                   f"{values['lease_expiry']}: {e!r}")
+            try:
+                db.execute(
+                    update(ScheduledCalls)
+                    .where(ScheduledCalls.id == scheduled_call_id, ScheduledCalls.claimed_by == self.worker_id)
+                    .values(**values)
+                )
+                bump_patient_versions(db.connection(), [patient_id], context=False)
+                db.commit()
+            except Exception as e:
+                # the lease runs out and another try picks the row up
+                db.rollback()
+                logger.error(f"Could not record the failure of scheduled call {scheduled_call_id}: {e!r}")
+        finally:
+            db.close()
+            with self.lock:
+                self.in_flight -= 1
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.tick()
+            except Exception as e:
+                logger.error(f"Dispatcher error: {e!r}")
+                claimed = 0
+            # after claiming something there may be more due rows, go again without waiting
+            if claimed == 0:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
@@ -0,0 +1,169 @@
+#materializer.py
+# Expands prescriptions into medication_schedules rows (one per dose) over a rolling horizon.
+# Prescription.frequency is doses per day, spaced evenly from the time of day of start_date.
+# Prescription.materialized_until records how far a prescription has been expanded, so extending the
+# horizon only inserts the slots after it instead of regenerating everything. Each pass runs in one
+# transaction with bulk inserts. When a prescription changes, regenerate_prescription replaces only its
+# future slots.
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, update, delete, or_
+from sqlalchemy.orm import Session
+from loguru import logger
+import threading
+import math
+import os
+
+from database import SessionLocal
+from models import Prescription, MedicationSchedule, MedicationLog, MedicationScheduleStatus, bump_patient_versions
+
+MATERIALIZE_HORIZON_DAYS = int(os.getenv("MATERIALIZE_HORIZON_DAYS", "14"))
+MATERIALIZE_INTERVAL_SECONDS = float(os.getenv("MATERIALIZE_INTERVAL_SECONDS", "3600"))
+
+
+def dose_times(prescription, start: datetime, end: datetime) -> list:
+    # dose slots in [start, end), clipped to the prescription's end_date
+    if not prescription.frequency or prescription.frequency <= 0:
+        return []
+    interval = timedelta(days=1) / prescription.frequency
+    stop = min(end, prescription.end_date) if prescription.end_date else end
+    first = prescription.start_date
+    if start > first:
+        first += interval * math.ceil((start - first) / interval)
+    times = []
+    while first < stop:
+        times.append(first)
+        first += interval
+    return times
+
+
+def materialize_prescription(db: Session, prescription, until: datetime, now: datetime = None) -> int:
+    # inserts the slots between materialized_until and until. Prescriptions never expanded before start
+    # at today's midnight rather than back at start_date
+    now = now or datetime.utcnow()
+    previous = prescription.materialized_until
+    start = previous or max(prescription.start_date, now.replace(hour=0, minute=0, second=0, microsecond=0))
+    if start >= until:
+        return 0
+    # compare-and-set on materialized_until, so two materializers never expand the same range
+    claimed = db.execute(
+        update(Prescription)
+        .where(Prescription.id == prescription.id,
+               Prescription.materialized_until.is_(None) if previous is None else Prescription.materialized_until == previous)
+        .values(materialized_until=until)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        return 0
+    rows = [
+        {"fk_prescription_id": prescription.id, "fk_patient_id": prescription.fk_patient_id,
+         "scheduled_time": time, "status": MedicationScheduleStatus.active}
+        for time in dose_times(prescription, start, until)
+    ]
+    if rows:
+        db.execute(insert(MedicationSchedule), rows)
+    return len(rows)
+
+
+def extend_horizon(db: Session, horizon_days: int = MATERIALIZE_HORIZON_DAYS, now: datetime = None) -> int:
+    now = now or datetime.utcnow()
+    until = now + timedelta(days=horizon_days)
+    prescriptions = db.execute(
+        select(Prescription.id, Prescription.fk_patient_id, Prescription.frequency, Prescription.start_date,
+               Prescription.end_date, Prescription.materialized_until)
+        .where(
+            or_(Prescription.materialized_until.is_(None), Prescription.materialized_until < until),
+            # finished prescriptions that are already expanded to their end have nothing left to add
+            or_(Prescription.end_date.is_(None), Prescription.materialized_until.is_(None),
+                Prescription.end_date > Prescription.materialized_until),
+        )
+    ).all()
+    inserted = 0
+    patient_ids = set()
+    for prescription in prescriptions:
+        count = materialize_prescription(db, prescription, until, now)
+        if count:
+            inserted += count
+            patient_ids.add(prescription.fk_patient_id)
+    if patient_ids:
+        bump_patient_versions(db.connection(), patient_ids)
+    db.commit()
+    if inserted:
+        logger.info(f"Materialized {inserted} medication slots for {len(patient_ids)} patients up to {until}")
+    return inserted
+
+
+def regenerate_prescription(db: Session, prescription_id: int, horizon_days: int = MATERIALIZE_HORIZON_DAYS,
+                            now: datetime = None) -> int:
+    # drops the future slots of one prescription and expands it again from now. Slots that already have
+    # a medication log are kept. Does not commit, so it can share the caller's transaction
+    now = now or datetime.utcnow()
+    logged = select(MedicationLog.fk_medication_schedule_id).where(MedicationLog.fk_medication_schedule_id.is_not(None))
+    db.execute(
+        delete(MedicationSchedule)
+        .where(MedicationSchedule.fk_prescription_id == prescription_id,
+               MedicationSchedule.scheduled_time >= now,
+               MedicationSchedule.id.not_in(logged))
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        update(Prescription)
+        .where(Prescription.id == prescription_id)
+        .values(materialized_until=now)
+        .execution_options(synchronize_session=False)
+    )
+    prescription = db.execute(
+        select(Prescription.id, Prescription.fk_patient_id, Prescription.frequency, Prescription.start_date,
+               Prescription.end_date, Prescription.materialized_until)
+        .where(Prescription.id == prescription_id)
+    ).first()
+    if prescription is None:
+        return 0
+    kept = set(db.execute(
+        select(MedicationSchedule.scheduled_time)
+        .where(MedicationSchedule.fk_prescription_id == prescription_id, MedicationSchedule.scheduled_time >= now)
+    ).scalars())
+    until = now + timedelta(days=horizon_days)
+    rows = [
+        {"fk_prescription_id": prescription_id, "fk_patient_id": prescription.fk_patient_id,
+         "scheduled_time": time, "status": MedicationScheduleStatus.active}
+        for time in dose_times(prescription, now, until) if time not in kept
+    ]
+    if rows:
+        db.execute(insert(MedicationSchedule), rows)
+    db.execute(
+        update(Prescription)
+        .where(Prescription.id == prescription_id)
+        .values(materialized_until=until)
+        .execution_options(synchronize_session=False)
+    )
+    bump_patient_versions(db.connection(), [prescription.fk_patient_id])
+    return len(rows)
+
+
+class ScheduleMaterializer:
+    # keeps the horizon rolling: extends it at start-up and then every MATERIALIZE_INTERVAL_SECONDS
+    def __init__(self, interval_seconds: float = MATERIALIZE_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="schedule-materializer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                extend_horizon(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Materializer error: {e!r}")
+            finally:
+                db.close()
+            self._stop.wait(self.interval_seconds)
@@ -0,0 +1,176 @@
+#retry_policy.py
+# What happened on a call and whether to call again. /call_ended turns Twilio's CallStatus and
+# AnsweredBy (answering machine detection, see place_call) into a CallOutcome. Calls nobody answered
+# skip the summary, are logged as missed, and book a retry here as a new pending row in scheduled_calls,
+# so the dispatcher places it like any other scheduled call.
+#
+# Retries back off per patient: attempt n waits RETRY_BACKOFF_SECONDS * 2^(n-1), capped at
+# RETRY_BACKOFF_MAX_SECONDS, give or take RETRY_JITTER of it. That way the calls a morning wave
+# missed don't all come back at the same minute. A retry that would land in the quiet hours
+# (RETRY_QUIET_HOURS, local to RETRY_TIMEZONE) moves to a random time in the first
+# RETRY_QUIET_SPREAD_SECONDS after they end. Patients have no timezone on file, so quiet hours only
+# apply once RETRY_TIMEZONE names the one they live in (e.g. America/Chicago); UTC hours would push
+# US retries into the middle of the night. No retry is booked after RETRY_MAX_ATTEMPTS attempts, or
+# when the patient already has a call scheduled before, or within RETRY_BACKOFF_SECONDS of, the retry.
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from sqlalchemy import select, insert, update, func
+from loguru import logger
+from typing import Optional
+import random
+import enum
+import os
+
+from models import ScheduledCalls, CallScheduleStatus, bump_patient_versions
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", "900"))
+RETRY_BACKOFF_MAX_SECONDS = float(os.getenv("RETRY_BACKOFF_MAX_SECONDS", "14400"))
+RETRY_JITTER = float(os.getenv("RETRY_JITTER", "0.25"))
+# "start-end" in local hours, wraps past midnight; empty disables quiet hours
+RETRY_QUIET_HOURS = os.getenv("RETRY_QUIET_HOURS", "21-8")
+RETRY_QUIET_SPREAD_SECONDS = float(os.getenv("RETRY_QUIET_SPREAD_SECONDS", "1800"))
+# IANA name, empty (the default) disables quiet hours
+RETRY_TIMEZONE = os.getenv("RETRY_TIMEZONE", "")
+
+
+class CallOutcome(str, enum.Enum):
+    answered = "answered"
+    no_answer = "no_answer"
+    busy = "busy"
+    voicemail = "voicemail"
+    # picked up, but the patient never said anything
+    no_response = "no_response"
+    failed = "failed"
+    canceled = "canceled"
+
+
+# outcomes worth calling again for, failed (bad number, carrier error) and canceled are not
+RETRYABLE = {CallOutcome.no_answer, CallOutcome.busy, CallOutcome.voicemail, CallOutcome.no_response}
+
+
+def call_outcome(call_status: Optional[str], answered_by: Optional[str], patient_spoke: bool) -> CallOutcome:
+    # call_status is Twilio's CallStatus on the final status callback, answered_by its AnsweredBy
+    # (human, machine_start, machine_end_beep, fax, unknown, ...), both may be missing
+    call_status = (call_status or "completed").lower()
+    answered_by = (answered_by or "").lower()
+    if call_status == "no-answer":
+        return CallOutcome.no_answer
+    if call_status == "busy":
+        return CallOutcome.busy
+    if call_status == "failed":
+        return CallOutcome.failed
+    if call_status == "canceled":
+        return CallOutcome.canceled
+    if answered_by.startswith("machine") or answered_by == "fax":
+        return CallOutcome.voicemail
+    return CallOutcome.answered if patient_spoke else CallOutcome.no_response
+
+
+def _quiet_hours(spec: str) -> Optional[tuple]:
+    if not spec:
+        return None
+    start, end = (int(hour) for hour in spec.split("-"))
+    return start, end
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, backoff_seconds: float = RETRY_BACKOFF_SECONDS,
+                 backoff_max_seconds: float = RETRY_BACKOFF_MAX_SECONDS, jitter: float = RETRY_JITTER,
+                 quiet_hours: str = RETRY_QUIET_HOURS, quiet_spread_seconds: float = RETRY_QUIET_SPREAD_SECONDS,
+                 tz: str = RETRY_TIMEZONE, rng: random.Random = None):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.jitter = jitter
+        self.tz = ZoneInfo(tz) if tz else None
+        self.quiet_hours = _quiet_hours(quiet_hours) if self.tz else None
+        self.quiet_spread_seconds = quiet_spread_seconds
+        self.rng = rng or random.Random()
+
+    def in_quiet_hours(self, when: datetime) -> bool:
+        if self.quiet_hours is None:
+            return False
+        start, end = self.quiet_hours
+        hour = self.local(when).hour
+        return start <= hour < end if start < end else hour >= start or hour < end
+
+    def local(self, when: datetime) -> datetime:
+        # call times are naive UTC
+        return when.replace(tzinfo=timezone.utc).astimezone(self.tz)
+
+    def after_quiet_hours(self, when: datetime) -> datetime:
+        # the end of the quiet hours when falls in, plus a random spread
+        local = self.local(when)
+        end = local.replace(hour=self.quiet_hours[1], minute=0, second=0, microsecond=0)
+        if end <= local:
+            end += timedelta(days=1)
+        end += timedelta(seconds=self.rng.uniform(0, self.quiet_spread_seconds))
+        return end.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def next_attempt_at(self, attempt: int, now: datetime) -> Optional[datetime]:
+        # when to place attempt + 1 after attempt went unanswered, None once attempts run out
+        if attempt >= self.max_attempts:
+            return None
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * 2 ** (attempt - 1))
+        delay *= self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        when = now + timedelta(seconds=delay)
+        if self.in_quiet_hours(when):
+            when = self.after_quiet_hours(when)
+        return when
+
+    def record_outcome(self, db, patient_id: Optional[int], call_sid: str, outcome: CallOutcome,
+                       now: datetime = None) -> Optional[datetime]:
+        # marks the call's scheduled_calls row (if the dispatcher placed it) and books a retry for
+        # unanswered calls, in db's transaction. Returns the retry's call time, if one was booked
+        now = now or datetime.utcnow()
+        row = db.execute(
+            select(ScheduledCalls.id, ScheduledCalls.fk_patient_id, ScheduledCalls.attempt, ScheduledCalls.status)
+            .where(ScheduledCalls.call_sid == call_sid)
+        ).first()
+        if row is not None and row.status != CallScheduleStatus.pending:
+            # already recorded, this is a repeated status callback or a retried job
+            return None
+        attempt = row.attempt if row is not None else 1
+        retry_at = None
+        if outcome in RETRYABLE and patient_id is not None:
+            retry_at = self.next_attempt_at(attempt, now)
+        if retry_at is not None:
+            next_call = db.execute(
+                select(func.min(ScheduledCalls.call_time))
+                .where(ScheduledCalls.fk_patient_id == patient_id,
+                       ScheduledCalls.status == CallScheduleStatus.pending,
+                       ScheduledCalls.dispatched_at.is_(None))
+            ).scalar()
+            if next_call is not None and next_call <= retry_at + timedelta(seconds=self.backoff_seconds):
+                logger.info(f"Not retrying call {call_sid}, patient {patient_id} has a call at {next_call}")
+                retry_at = None
+
+        if outcome == CallOutcome.answered:
+            status = CallScheduleStatus.confirmed
+        elif retry_at is not None:
+            status = CallScheduleStatus.rescheduled
+        else:
+            status = CallScheduleStatus.missed
+        # scheduled_calls is part of GET /patients/{id}, its ETag must change
+        changed = set()
+        if row is not None:
+            db.execute(
+                update(ScheduledCalls)
+                .where(ScheduledCalls.id == row.id)
+                .values(status=status, outcome=outcome.value)
+            )
+            changed.add(row.fk_patient_id)
+        if retry_at is not None:
+            db.execute(insert(ScheduledCalls).values(
+                fk_patient_id=patient_id, call_time=retry_at, status=CallScheduleStatus.pending, attempt=attempt + 1,
+            ))
+            changed.add(patient_id)
+            logger.info(f"Call {call_sid} was {outcome.value}, attempt {attempt + 1} for patient {patient_id} at {retry_at}")
+        elif outcome != CallOutcome.answered:
+            logger.info(f"Call {call_sid} was {outcome.value}, no retry after attempt {attempt}")
+        bump_patient_versions(db.connection(), changed, context=False)
+        return retry_at
+
+
+retry_policy = RetryPolicy()
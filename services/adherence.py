@@ -0,0 +1,136 @@
+#adherence.py
+# Daily adherence rollups. adherence_daily keeps taken/skipped/delayed counts per patient, prescription
+# and day (the day the dose was scheduled for), so the caregiver stats read at most 90 days of rows per
+# prescription instead of scanning medication_logs. record_call_adherence adds one call's logs in the
+# same transaction that writes them, backfill rebuilds the table from the full history:
+#
+#     pyapi/bin/python -m services.adherence --backfill [--patient 12]
+from datetime import date, datetime, timedelta
+from sqlalchemy import select, delete, insert, func, case
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from typing import Optional
+from loguru import logger
+
+from models import AdherenceDaily, MedicationLog, MedicationLogStatus, MedicationSchedule, Prescription
+
+WINDOWS = (7, 30, 90)
+COUNTS = [status.name for status in MedicationLogStatus]
+BACKFILL_CHUNK = 5000
+
+
+def log_counts(*where):
+    # medication_logs grouped into rollup rows: patient, prescription, day, taken, skipped, delayed
+    day = func.date(MedicationSchedule.scheduled_time)
+    return (
+        select(
+            MedicationLog.fk_patient_id,
+            MedicationSchedule.fk_prescription_id,
+            day.label("day"),
+            *[func.sum(case((MedicationLog.status == status, 1), else_=0)).label(status.name) for status in MedicationLogStatus],
+        )
+        .join(MedicationSchedule, MedicationSchedule.id == MedicationLog.fk_medication_schedule_id)
+        .where(*where)
+        .group_by(MedicationLog.fk_patient_id, MedicationSchedule.fk_prescription_id, day)
+    )
+
+
+def rollup_rows(result) -> list:
+    # func.date gives a string on SQLite and a date on Postgres
+    return [
+        {
+            "fk_patient_id": row.fk_patient_id,
+            "fk_prescription_id": row.fk_prescription_id,
+            "day": row.day if isinstance(row.day, date) else date.fromisoformat(str(row.day)),
+            **{name: getattr(row, name) or 0 for name in COUNTS},
+        }
+        for row in result
+    ]
+
+
+def record_call_adherence(db: Session, call_log_id: int) -> int:
+    # adds the call's MedicationLog rows to the rollups; call it after inserting them, before the commit
+    rows = rollup_rows(db.execute(log_counts(MedicationLog.fk_call_log_id == call_log_id)))
+    if not rows:
+        return 0
+    dialect = db.get_bind().dialect.name
+    statement = (postgresql_insert if dialect == "postgresql" else sqlite_insert)(AdherenceDaily).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=["fk_patient_id", "fk_prescription_id", "day"],
+        set_={name: getattr(AdherenceDaily, name) + getattr(statement.excluded, name) for name in COUNTS},
+    )
+    db.execute(statement)
+    return len(rows)
+
+
+def backfill(db: Session, patient_id: Optional[int] = None) -> int:
+    # rebuilds the rollups from medication_logs, for one patient or everybody, in one transaction
+    logs = [MedicationLog.fk_patient_id == patient_id] if patient_id is not None else []
+    rollups = [AdherenceDaily.fk_patient_id == patient_id] if patient_id is not None else []
+    db.execute(delete(AdherenceDaily).where(*rollups))
+    rows = rollup_rows(db.execute(log_counts(*logs)))
+    for offset in range(0, len(rows), BACKFILL_CHUNK):
+        db.execute(insert(AdherenceDaily), rows[offset:offset + BACKFILL_CHUNK])
+    db.commit()
+    return len(rows)
+
+
+def adherence_query(patient_id: int, today: date):
+    # one row per prescription with every window's counts, read from at most max(WINDOWS) days of rollups
+    since = {days: today - timedelta(days=days - 1) for days in WINDOWS}
+    columns = [
+        func.sum(case((AdherenceDaily.day >= since[days], getattr(AdherenceDaily, name)), else_=0)).label(f"{name}_{days}")
+        for days in WINDOWS for name in COUNTS
+    ]
+    return (
+        select(AdherenceDaily.fk_prescription_id, Prescription.name, Prescription.nick, *columns)
+        .join(Prescription, Prescription.id == AdherenceDaily.fk_prescription_id)
+        .where(AdherenceDaily.fk_patient_id == patient_id, AdherenceDaily.day >= since[max(WINDOWS)])
+        .group_by(AdherenceDaily.fk_prescription_id, Prescription.name, Prescription.nick)
+    )
+
+
+def window_stats(counts: dict) -> dict:
+    total = sum(counts.values())
+    return {**counts, "total": total, "adherence_rate": round(counts["taken"] / total, 3) if total else None}
+
+
+def adherence_summary(patient_id: int, rows) -> dict:
+    patient_totals = {days: dict.fromkeys(COUNTS, 0) for days in WINDOWS}
+    prescriptions = []
+    for row in rows:
+        windows = {}
+        for days in WINDOWS:
+            counts = {name: getattr(row, f"{name}_{days}") or 0 for name in COUNTS}
+            for name, value in counts.items():
+                patient_totals[days][name] += value
+            windows[f"{days}d"] = window_stats(counts)
+        prescriptions.append({"prescription_id": row.fk_prescription_id, "name": row.name, "nick": row.nick, "windows": windows})
+    return {
+        "patient_id": patient_id,
+        "windows": {f"{days}d": window_stats(counts) for days, counts in patient_totals.items()},
+        "prescriptions": prescriptions,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal
+    from migrations import migrate
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill", action="store_true", help="rebuild adherence_daily from medication_logs")
+    parser.add_argument("--patient", type=int, help="only this patient")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.error("nothing to do, pass --backfill")
+    # adherence_daily may not exist yet on a database from before it was added
+    migrate()
+    db = SessionLocal()
+    try:
+        start = datetime.utcnow()
+        count = backfill(db, args.patient)
+        logger.info(f"Backfilled {count} adherence rows in {(datetime.utcnow() - start).total_seconds():.1f}s")
+    finally:
+        db.close()
@@ -0,0 +1,203 @@
+#audio_cache.py
+# Pre-rendered audio for the fixed and templated lines of a call (the greeting, "Goodbye", the error
+# line), so answering doesn't wait on Twilio's <Say> TTS. Lines are synthesized ahead of time by the
+# AUDIO_TTS backend (services/tts.py: azure, or fake for local runs; none, the default, turns the
+# cache off). The files are written to AUDIO_CACHE_DIR as WAV, named by the hash of the backend, voice
+# and text. GET /audio/{name} serves them with immutable cache headers. say_or_play() puts a <Play>
+# in the TwiML when the line is on disk, and otherwise falls back to <Say> and queues the line so the
+# next call gets the audio.
+#
+# Fixed lines are rendered at startup. A patient's greeting is queued when their call is placed, and it
+# is ready by the time they pick up. The directory is kept under AUDIO_CACHE_MAX_BYTES by evicting the
+# least recently used files. Workers share the directory, and each one bounds what it has seen.
+from collections import OrderedDict
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from loguru import logger
+import threading
+import asyncio
+import hashlib
+import struct
+import re
+import os
+
+from services.tts import create_synthesizer
+from services.metrics import audio_cache_lookups_total
+
+AUDIO_TTS = os.getenv("AUDIO_TTS", "none")
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "./audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+router = APIRouter()
+
+AUDIO_NAME = re.compile(r"^[0-9a-f]{64}\.wav$")
+
+
+def mulaw_wav(audio: bytes) -> bytes:
+    # 8kHz mono mu-law in a WAV container (format 7 needs the extended fmt chunk and a fact chunk)
+    fmt = struct.pack("<HHIIHHH", 7, 1, 8000, 8000, 1, 8, 0)
+    fact = struct.pack("<I", len(audio))
+    body = (b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"fact" + struct.pack("<I", len(fact)) + fact
+            + b"data" + struct.pack("<I", len(audio)) + audio + (b"\x00" if len(audio) % 2 else b""))
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+class AudioCache:
+    def __init__(self, backend: str = AUDIO_TTS, directory: str = AUDIO_CACHE_DIR, max_bytes: int = AUDIO_CACHE_MAX_BYTES):
+        self.backend = backend
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = backend != "none"
+        self.synthesizer = None
+        # name -> size in bytes, least recently used first
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # lines rendered at start, and names queued or being rendered
+        self._fixed = []
+        self._pending = set()
+        self._loop = None
+        self._thread = None
+
+    def name(self, text: str) -> str:
+        voice = self.synthesizer.voice if self.synthesizer else self.backend
+        return hashlib.sha256(f"{self.backend}|{voice}|{text}".encode()).hexdigest() + ".wav"
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def url(self, text: str) -> str:
+        # relative <Play> URL of the rendered line, or None (and the line is queued) when it isn't on disk yet
+        if not self.enabled or self._loop is None:
+            return None
+        name = self.name(text)
+        with self._lock:
+            found = name in self._files
+            if found:
+                self._files.move_to_end(name)
+        if not found and os.path.exists(self.path(name)):
+            # rendered by another worker
+            self._remember(name, os.path.getsize(self.path(name)))
+            found = True
+        audio_cache_lookups_total.inc(result="hit" if found else "miss")
+        if not found:
+            self.prepare(text)
+            return None
+        return f"/audio/{name}"
+
+    def preload(self, *texts: str):
+        # fixed lines, rendered at start when missing
+        self._fixed.extend(texts)
+        for text in texts:
+            self.prepare(text)
+
+    def prepare(self, text: str):
+        # queue text for rendering unless it is on disk or already queued, safe to call from any thread
+        if not self.enabled or self._loop is None:
+            return
+        name = self.name(text)
+        with self._lock:
+            if name in self._files or name in self._pending:
+                return
+            self._pending.add(name)
+        asyncio.run_coroutine_threadsafe(self._render(name, text), self._loop)
+
+    async def _render(self, name: str, text: str):
+        try:
+            if os.path.exists(self.path(name)):
+                self._remember(name, os.path.getsize(self.path(name)))
+                return
+            audio = await self.synthesizer.synthesize(text)
+            if not audio:
+                # an empty file would be served as immutable, leave the line to <Say> and try again next time
+                logger.warning(f"No audio rendered for {text!r}, not caching it")
+                return
+            data = mulaw_wav(audio)
+            # written aside and renamed, so a file is never served half written
+            tmp = f"{self.path(name)}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.path(name))
+            self._remember(name, len(data))
+            logger.info(f"Rendered audio for {text!r} ({len(data)} bytes)")
+        except Exception as e:
+            logger.warning(f"Could not render audio for {text!r}: {e!r}")
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _remember(self, name: str, size: int):
+        evicted = []
+        with self._lock:
+            self._bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, old_size = self._files.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        # what is already on disk, oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if AUDIO_NAME.match(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._remember(name, size)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.synthesizer = create_synthesizer(self.backend)
+        self._load()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="audio-cache", daemon=True)
+        self._thread.start()
+        for text in self._fixed:
+            self.prepare(text)
+        logger.info(f"Audio cache in {self.directory}: {len(self._files)} files, {self._bytes} bytes")
+
+    async def _drain(self):
+        # let the renders already started finish
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        if self._loop is None:
+            return
+        loop, self._loop = self._loop, None
+        try:
+            asyncio.run_coroutine_threadsafe(self._drain(), loop).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"Audio renders still running at shutdown: {e!r}")
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=10)
+        loop.close()
+
+
+audio_cache = AudioCache()
+
+
+def say_or_play(response, text: str, voice: str = None):
+    # <Play> the pre-rendered line when there is one, <Say> it otherwise
+    url = audio_cache.url(text)
+    if url:
+        response.play(url)
+    else:
+        response.say(text, voice=voice)
+
+
+@router.get("/audio/{name}")
+def get_audio(name: str):
+    if not AUDIO_NAME.match(name) or not os.path.exists(audio_cache.path(name)):
+        raise HTTPException(status_code=404, detail="Audio not found")
+    # the name is derived from the content, so it never changes and can be cached for good
+    return FileResponse(audio_cache.path(name), media_type="audio/wav",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
@@ -0,0 +1,73 @@
+#clients.py
+# OpenAI and Twilio clients. Nothing is imported or built when the module loads. Each client is created
+# on first use, or by open_clients() from the app lifespan (main.py), so it is created after uvicorn
+# or gunicorn has forked the worker. close_clients() releases their connection pools on shutdown.
+#
+# OPENAI_BASE_URL (read by the OpenAI SDK) and TWILIO_API_BASE_URL can point them at the stubs in
+# benchmarks/.
+import threading
+import os
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _client(name: str, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _openai():
+    import openai
+
+    return openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+def _async_openai():
+    import openai
+
+    return openai.AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+def _twilio():
+    from twilio.rest import Client
+
+    client = Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"])
+    if os.getenv("TWILIO_API_BASE_URL"):
+        client.api.base_url = os.getenv("TWILIO_API_BASE_URL")
+    return client
+
+
+def openai_client():
+    # sync client, for the job workers
+    return _client("openai", _openai)
+
+
+def async_openai_client():
+    # used inside the call so it doesn't block the event loop
+    return _client("async_openai", _async_openai)
+
+
+def twilio_client():
+    return _client("twilio", _twilio)
+
+
+def open_clients():
+    openai_client()
+    async_openai_client()
+    twilio_client()
+
+
+async def close_clients():
+    with _lock:
+        clients = dict(_clients)
+        _clients.clear()
+    if "openai" in clients:
+        clients["openai"].close()
+    if "async_openai" in clients:
+        await clients["async_openai"].close()
@@ -0,0 +1,85 @@
+#context.py
+# Bounded prompt context for a call. The prompt is the system prompt, a rolling summary of the older
+# turns and the most recent turns verbatim, kept under CONTEXT_TOKEN_BUDGET. Older turns are folded
+# into the summary a few at a time, so each turn's prompt stays the same size however long the call runs.
+#
+# The session keeps the full conversation (conversation[0] is the system prompt); session.summarized_count
+# is how many messages after it are already covered by session.summary.
+from loguru import logger
+import time
+import os
+
+from services.model_router import model_router, attribution
+
+# messages (user + assistant) kept verbatim before they get folded into the summary
+CONTEXT_RECENT_MESSAGES = int(os.getenv("CONTEXT_RECENT_MESSAGES", "6"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+
+
+def estimate_tokens(text: str) -> int:
+    # about 4 characters per token for English, close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def recent_messages(session) -> list:
+    return session.conversation[1 + session.summarized_count:]
+
+
+def context_messages(session) -> list:
+    # messages to send for the next reply
+    messages = [session.conversation[0]]
+    if session.summary:
+        messages.append({"role": "system", "content": "Summary of the call so far: " + session.summary})
+    recent = recent_messages(session)
+    used = sum(estimate_tokens(m["content"]) for m in messages)
+    # if the recent turns alone blow the budget, drop the oldest of them (always keep the last two)
+    while len(recent) > 2 and used + sum(estimate_tokens(m["content"]) for m in recent) > CONTEXT_TOKEN_BUDGET:
+        recent = recent[1:]
+    return messages + recent
+
+
+def render_transcript(messages: list) -> str:
+    speakers = {"user": "Patient", "assistant": "Assistant"}
+    return "\n".join(f"{speakers[m['role']]}: {m['content']}" for m in messages if m["role"] in speakers)
+
+
+def context_transcript(session) -> str:
+    # summary plus recent turns as plain text, for prompts that read the call rather than continue it
+    transcript = render_transcript(recent_messages(session))
+    if session.summary:
+        return "Summary of the earlier part of the call: " + session.summary + "\n" + transcript
+    return transcript
+
+
+def needs_summary(session) -> bool:
+    return len(recent_messages(session)) > CONTEXT_RECENT_MESSAGES
+
+
+async def summarize_older_turns(session, client, model: str = None):
+    # fold the messages that fell out of the verbatim window into session.summary
+    recent = recent_messages(session)
+    folded = recent[:len(recent) - CONTEXT_RECENT_MESSAGES]
+    if not folded:
+        return
+    prompt = f"""
+    You are keeping running notes on a check-in phone call between a medical assistant and an elderly patient.
+    Update the notes with the new lines below. Keep every medication status, health concern and personal
+    topic mentioned, drop small talk, and keep the notes under 150 words.
+
+    Current notes:
+    {session.summary or "(none yet)"}
+
+    New lines:
+    {render_transcript(folded)}
+    """
+    model = model or model_router.choose("running_summary", session.call_sid)
+    tags = attribution(session)
+    start = time.perf_counter()
+    gpt_response = await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+    )
+    model_router.record("running_summary", model, gpt_response.usage, time.perf_counter() - start, **tags)
+    session.summary = gpt_response.choices[0].message.content.strip()
+    session.summarized_count += len(folded)
+    logger.info(f"Folded {len(folded)} messages into the summary for {session.call_sid}")
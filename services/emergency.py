@@ -0,0 +1,193 @@
+#emergency.py
+# In-call emergency detection. Every patient utterance goes through a local phrase screen first, and
+# utterances with no hit cost nothing. Every hit, severe ("chest pain", "can't breathe", "call 911") or
+# softer ("I fell", "really dizzy"), is confirmed by GPT before alerting, since the phrase alone can't tell
+# "I have chest pain" from "no chest pain today" or "my friend had a stroke". When the check itself
+# fails the alert goes out anyway.
+#
+# Alerts go on a priority queue served by a dedicated sender thread, so an in-call emergency never
+# waits behind routine notices. ALERT_SENDER picks how they are delivered: twilio (SMS to the caregiver)
+# or fake (kept in memory and logged, for local runs). The time from the utterance to the sender
+# returning is logged and kept in alert_stats.
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional
+from loguru import logger
+import threading
+import queue
+import time
+import re
+import os
+
+from services.events import publish
+from services.metrics import record_twilio_call
+from services.model_router import model_router, attribution
+from services.clients import twilio_client
+
+ALERT_SENDER = os.getenv("ALERT_SENDER", "twilio")
+# in-call emergencies jump ahead of everything else on the queue
+PRIORITY_EMERGENCY = 0
+PRIORITY_NOTICE = 1
+# after everything already queued, so stop() doesn't drop pending alerts
+PRIORITY_STOP = 2
+
+SEVERE = re.compile(
+    r"\b(chest pains?|heart attack|can'?t breathe|cannot breathe|trouble breathing|stroke|call (9-?1-?1|an ambulance)|"
+    r"kill myself|end my life|suicid\w*|overdos\w*|took too many|bleeding (a lot|badly|heavily)|passed out|unconscious)\b"
+)
+POSSIBLE = re.compile(
+    r"\b(fell|fallen|fall|dizzy|faint\w*|pain|hurts?|hurting|bleeding|numb|confused|can'?t (get up|move|stand)|"
+    r"emergency|ambulance|hospital|help me|scared)\b"
+)
+
+alert_stats = {"screened": 0, "escalated": 0, "alerts": 0, "latencies_ms": []}
+_stats_lock = threading.Lock()
+
+
+class EmergencyCheck(BaseModel):
+    is_emergency: bool
+    reason: str
+
+
+def screen(utterance: str) -> Optional[str]:
+    # "severe", "possible" or None
+    text = (utterance or "").lower()
+    if SEVERE.search(text):
+        return "severe"
+    if POSSIBLE.search(text):
+        return "possible"
+    return None
+
+
+async def confirm_emergency(utterance: str, recent: str, client, session=None) -> EmergencyCheck:
+    prompt = f"""
+    An elderly patient said the following during a check-in call. Decide whether it is an emergency that
+    their caregiver must hear about right now (a fall, severe pain, trouble breathing, self-harm, taking
+    the wrong amount of medication, etc.) and give a short reason a caregiver can read in an SMS.
+    It is not an emergency when the patient says they don't have the symptom, or talks about someone
+    else or something that happened long ago.
+    Recent conversation:
+    {recent}
+    Patient just said: {utterance}
+    """
+    tags = attribution(session)
+    model = model_router.choose("emergency", tags.get("call_sid"))
+    start = time.perf_counter()
+    response = await client.beta.chat.completions.parse(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format=EmergencyCheck
+    )
+    model_router.record("emergency", model, response.usage, time.perf_counter() - start, **tags)
+    return response.choices[0].message.parsed
+
+
+async def check_emergency(session, utterance: str, heard_at: float, client, recent: str = "") -> Optional[dict]:
+    # runs alongside the classifier and reply for each turn, returns the alert when one was raised
+    with _stats_lock:
+        alert_stats["screened"] += 1
+    # one alert per call, the post-call summary covers anything said after it
+    if session.alerts:
+        return None
+    level = screen(utterance)
+    if level is None:
+        return None
+    with _stats_lock:
+        alert_stats["escalated"] += 1
+    try:
+        check = await confirm_emergency(utterance, recent, client, session)
+    except Exception as e:
+        # an unconfirmed emergency is still worth a message
+        logger.warning(f"Emergency check failed for {session.call_sid} ({level} hit), alerting anyway: {e!r}")
+        check = EmergencyCheck(is_emergency=True, reason=f'Patient said: "{utterance}"')
+    if not check.is_emergency:
+        logger.info(f"{level.capitalize()} hit on call {session.call_sid} not confirmed: {check.reason}")
+        return None
+    reason = check.reason
+    alert = {
+        "call_sid": session.call_sid,
+        "patient_id": session.patient_data.get("patient_id"),
+        "to": session.patient_data.get("caregiver_number") or "",
+        "body": f"Blue Buddy alert for {session.patient_data.get('first_name', 'your patient')}: {reason}",
+        "reason": reason,
+        "at": datetime.utcnow().isoformat(),
+    }
+    session.alerts.append(alert)
+    alert_dispatcher.submit(alert, heard_at, PRIORITY_EMERGENCY)
+    publish(alert["patient_id"], "alert", call_sid=session.call_sid, reason=reason)
+    return alert
+
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, to: str, body: str):
+        self.sent.append({"to": to, "body": body})
+        logger.warning(f"[fake alert to {to or 'no caregiver number'}] {body}")
+
+
+class TwilioSmsSender:
+    def __init__(self):
+        self.client = twilio_client()
+        self.from_number = os.getenv("TWILIO_PHONE_NUMBER")
+
+    def send(self, to: str, body: str):
+        if not to:
+            logger.warning(f"No caregiver number, alert not sent: {body}")
+            return
+        self.client.messages.create(to=to, from_=self.from_number, body=body)
+        record_twilio_call("messages.create")
+
+
+def create_alert_sender():
+    if ALERT_SENDER == "fake":
+        return FakeSender()
+    return TwilioSmsSender()
+
+
+class AlertDispatcher:
+    def __init__(self, sender=None):
+        self.sender = sender
+        self.queue = queue.PriorityQueue()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, alert: dict, heard_at: float = None, priority: int = PRIORITY_NOTICE):
+        with self.lock:
+            # the sequence keeps equal priorities in arrival order
+            self.sequence += 1
+            sequence = self.sequence
+        self.queue.put((priority, sequence, alert, heard_at or time.perf_counter()))
+
+    def start(self):
+        if self.sender is None:
+            self.sender = create_alert_sender()
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.queue.put((PRIORITY_STOP, 0, None, 0))
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        while True:
+            priority, _, alert, heard_at = self.queue.get()
+            if alert is None:
+                return
+            try:
+                self.sender.send(alert["to"], alert["body"])
+            except Exception as e:
+                logger.error(f"Alert for call {alert['call_sid']} could not be sent: {e!r}")
+                continue
+            latency_ms = (time.perf_counter() - heard_at) * 1000
+            with _stats_lock:
+                alert_stats["alerts"] += 1
+                # the last 100 are enough for the percentiles on /alert_stats
+                alert_stats["latencies_ms"] = (alert_stats["latencies_ms"] + [round(latency_ms, 1)])[-100:]
+            logger.warning(f"Alert for call {alert['call_sid']} sent {latency_ms:.0f}ms after the utterance: {alert['reason']}")
+
+
+alert_dispatcher = AlertDispatcher()
@@ -0,0 +1,210 @@
+#events.py
+# Live call events for the caregiver dashboard (call placed/answered/turns/ended/summarized), pushed over
+# server-sent events from GET /patients/{patient_id}/events instead of polling GET /patients/{patient_id}.
+#
+# publish() can be called from anywhere (async handlers, the dispatcher and job worker threads). Each SSE
+# connection gets its own bounded queue; a subscriber that stops reading loses its oldest events instead
+# of growing without limit.
+#
+# EVENTS_BACKEND=memory (default) only reaches subscribers in the same process. With several uvicorn
+# workers use EVENTS_BACKEND=db: events are written to the events table in batches and every worker polls
+# it and fans new rows out to its own subscribers.
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, insert, func
+from loguru import logger
+import threading
+import asyncio
+import queue
+import json
+import os
+
+from database import SessionLocal
+from models import Event
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory")
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "100"))
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "0.5"))
+EVENTS_RETENTION_SECONDS = int(os.getenv("EVENTS_RETENTION_SECONDS", "3600"))
+# comment lines keep idle connections from being closed by proxies
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+
+router = APIRouter()
+
+
+class Subscriber:
+    def __init__(self, patient_id: int, loop, size: int = EVENT_BUFFER_SIZE):
+        self.patient_id = patient_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.dropped = 0
+
+    def put(self, event: dict):
+        # runs on the subscriber's loop; a full buffer drops the oldest event
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class EventBus:
+    # in-process fan-out, patient_id -> subscribers
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def subscribe(self, patient_id: int) -> Subscriber:
+        subscriber = Subscriber(patient_id, asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers.setdefault(patient_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.patient_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.patient_id, None)
+
+    def deliver(self, event: dict):
+        with self.lock:
+            subscribers = list(self.subscribers.get(event["patient_id"], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.put, event)
+            except RuntimeError:
+                # the subscriber's loop is already closed
+                self.unsubscribe(subscriber)
+
+    def publish(self, patient_id: int, kind: str, data: dict):
+        with self.lock:
+            self.next_id += 1
+            event_id = self.next_id
+        self.deliver({"id": event_id, "patient_id": patient_id, "kind": kind, "data": data,
+                      "at": datetime.utcnow().isoformat()})
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class DatabaseEventBus(EventBus):
+    # publish() queues the event for a writer thread that inserts in batches; a poller thread reads rows
+    # written by any worker and delivers them to this worker's subscribers
+    def __init__(self, poll_seconds: float = EVENTS_POLL_SECONDS):
+        super().__init__()
+        self.poll_seconds = poll_seconds
+        self.pending = queue.Queue()
+        self.last_id = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def publish(self, patient_id: int, kind: str, data: dict):
+        self.pending.put({"fk_patient_id": patient_id, "kind": kind, "data": json.dumps(data, default=str),
+                          "created_at": datetime.utcnow()})
+
+    def start(self):
+        db = SessionLocal()
+        try:
+            # only events published from now on
+            self.last_id = db.execute(select(func.max(Event.id))).scalar() or 0
+        finally:
+            db.close()
+        for target, name in [(self._write, "event-writer"), (self._poll, "event-poller")]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self.pending.put(None)
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+    def _write(self):
+        while not self._stop.is_set():
+            batch = [self.pending.get()]
+            while not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            batch = [row for row in batch if row is not None]
+            if not batch:
+                continue
+            db = SessionLocal()
+            try:
+                db.execute(insert(Event), batch)
+                db.commit()
+            except Exception as e:
+                logger.error(f"Could not write {len(batch)} events: {e!r}")
+            finally:
+                db.close()
+
+    def _poll(self):
+        last_cleanup = datetime.utcnow()
+        while not self._stop.wait(self.poll_seconds):
+            db = SessionLocal()
+            try:
+                rows = db.execute(select(Event).where(Event.id > self.last_id).order_by(Event.id)).scalars().all()
+                for row in rows:
+                    self.last_id = row.id
+                    self.deliver({"id": row.id, "patient_id": row.fk_patient_id, "kind": row.kind,
+                                  "data": json.loads(row.data), "at": row.created_at.isoformat()})
+                if datetime.utcnow() - last_cleanup > timedelta(seconds=EVENTS_RETENTION_SECONDS / 10):
+                    cutoff = datetime.utcnow() - timedelta(seconds=EVENTS_RETENTION_SECONDS)
+                    db.execute(delete(Event).where(Event.created_at < cutoff))
+                    db.commit()
+                    last_cleanup = datetime.utcnow()
+            except Exception as e:
+                logger.error(f"Event poller error: {e!r}")
+            finally:
+                db.close()
+
+
+def create_event_bus() -> EventBus:
+    if EVENTS_BACKEND == "db":
+        return DatabaseEventBus()
+    return EventBus()
+
+
+event_bus = create_event_bus()
+
+
+def publish(patient_id, kind: str, **data):
+    # calls placed from the dashboard without a patient_id have nobody to notify
+    if patient_id is None:
+        return
+    try:
+        event_bus.publish(int(patient_id), kind, data)
+    except Exception as e:
+        logger.warning(f"Could not publish {kind} event: {e!r}")
+
+
+def format_event(event: dict) -> str:
+    payload = json.dumps({"patient_id": event["patient_id"], "at": event["at"], **event["data"]}, default=str)
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {payload}\n\n"
+
+
+@router.get("/patients/{patient_id}/events")
+async def patient_events(patient_id: int, request: Request):
+    subscriber = event_bus.subscribe(patient_id)
+
+    async def stream():
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            event_bus.unsubscribe(subscriber)
+            if subscriber.dropped:
+                logger.info(f"Events subscriber for patient {patient_id} dropped {subscriber.dropped} events")
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
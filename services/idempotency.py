@@ -0,0 +1,76 @@
+#idempotency.py
+# Twilio retries a webhook that times out or fails, so the same turn can reach /process_speech twice,
+# sometimes while the first request is still waiting on GPT. ReplayCache.run runs the handler once
+# per key and hands every repeat the first result. A repeat that arrives while the handler is running
+# waits for it. One that arrives later, within WEBHOOK_REPLAY_TTL_SECONDS, gets the stored result.
+#
+# The cache is per process. The session also keeps the last turn's TwiML (see twiliogpt.process_speech),
+# which covers a retry that lands on another worker after the turn finished.
+from collections import OrderedDict
+import hashlib
+import asyncio
+import time
+import os
+
+from services.metrics import webhook_replays_total
+
+WEBHOOK_REPLAY_TTL_SECONDS = int(os.getenv("WEBHOOK_REPLAY_TTL_SECONDS", "120"))
+WEBHOOK_REPLAY_MAX_ENTRIES = int(os.getenv("WEBHOOK_REPLAY_MAX_ENTRIES", "5000"))
+
+
+def turn_key(call_sid: str, seq, speech_result: str) -> str:
+    # seq is the turn number put in the <Gather> action URL, the speech hash tells apart requests
+    # from TwiML rendered before seq existed
+    digest = hashlib.sha256((speech_result or "").encode()).hexdigest()[:16]
+    return f"{call_sid}:{'' if seq is None else seq}:{digest}"
+
+
+class ReplayCache:
+    def __init__(self, name: str, ttl_seconds: int = WEBHOOK_REPLAY_TTL_SECONDS,
+                 max_entries: int = WEBHOOK_REPLAY_MAX_ENTRIES):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (expires_at, result), oldest first
+        self._results = OrderedDict()
+        # key -> future of the running handler
+        self._in_flight = {}
+
+    def get(self, key: str):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._results[key]
+            return None
+        return entry[1]
+
+    async def run(self, key: str, handler):
+        # handler is a coroutine function, returns (result, replayed). Everything runs on the event
+        # loop, so no lock is needed between the checks and the bookkeeping
+        result = self.get(key)
+        if result is not None:
+            webhook_replays_total.inc(webhook=self.name, source="cache")
+            return result, True
+        running = self._in_flight.get(key)
+        if running is not None:
+            webhook_replays_total.inc(webhook=self.name, source="in_flight")
+            return await asyncio.shield(running), True
+        running = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await handler()
+        except BaseException as e:
+            # repeats waiting on this one fail too, Twilio will retry them
+            if isinstance(e, asyncio.CancelledError):
+                running.cancel()
+            else:
+                running.set_exception(e)
+                running.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+        running.set_result(result)
+        self._results[key] = (time.time() + self.ttl_seconds, result)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return result, False
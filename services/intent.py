@@ -0,0 +1,117 @@
+#intent.py
+# Local fast path for the per-turn classifier (hang_up / medication / status).
+# Obvious utterances ("goodbye", "yes I took my levothyroxine", "I'm doing fine today") are answered here;
+# anything ambiguous returns None and the caller falls back to the GPT classifier.
+from difflib import SequenceMatcher
+from typing import Optional
+import threading
+import re
+
+# "hits" were answered locally, "misses" fell back to GPT
+intent_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+FUZZY_THRESHOLD = 0.8
+# a goodbye buried in a long utterance may come with something else that needs an answer
+MAX_GOODBYE_WORDS = 10
+
+GOODBYE = re.compile(r"\b(good ?bye|bye|bye bye|talk to you (later|tomorrow|soon)|hang up)\b")
+# only a goodbye when they end the turn: "okay, I have to go" is, "I have to go to the doctor tomorrow"
+# and "that's all I took today" are not
+CLOSING = re.compile(
+    r"\b(i )?(gotta go|got to go|have to go|need to go|that'?s all|that is all)( for (now|today))?( now)?[.!]*$"
+)
+# words that could mean the caller wants to end the call or is talking about a medication,
+# an utterance with none of these is safe to classify as "keep talking, no medication update"
+SUSPICIOUS = re.compile(
+    r"\b(go|going|done|end|later|call|stop|leave|busy|bye|pill|pills|medication|medications|medicine|"
+    r"meds|dose|prescription|took|take|taken|taking|refill|forgot|skip|skipped)\b"
+)
+NEGATION = re.compile(r"\b(not|never|no|didn'?t|don'?t|haven'?t|won'?t|can'?t|forgot)\b")
+# next to a goodbye these usually mean the caller wants to keep talking ("wait, don't hang up", "not bye yet")
+GOODBYE_HOLD = re.compile(r"\b(wait|yet|hold on|hang on|one more|before you go|actually|but)\b")
+# checked in order, the first status that matches wins
+STATUS_PATTERNS = [
+    ("not taking", re.compile(r"\b(didn'?t|did not|haven'?t|have not|not|never|forgot to|stopped)\b.*\b(take|took|taken|taking)\b")),
+    ("need refill", re.compile(r"\b(refill|ran out|run out|running low|out of)\b")),
+    ("taking later", re.compile(r"\b(later|tonight|this evening|after (dinner|lunch|breakfast)|will take|going to take|gonna take)\b")),
+    ("delayed", re.compile(r"\b(late|delayed|a little while ago|just now)\b")),
+    ("taken", re.compile(r"\b(took|taken|take it every|already did)\b")),
+]
+
+
+def medication_names(patient_data: dict) -> list:
+    # patient_data["prescriptions"] is either {"names": [...], ...} from the dashboard or {name: status}
+    prescriptions = patient_data.get("prescriptions") or {}
+    if isinstance(prescriptions.get("names"), list):
+        names = prescriptions["names"]
+    else:
+        names = list(prescriptions.keys())
+    return [str(n).lower() for n in names if n]
+
+
+def _match_score(words: list, name: str) -> float:
+    # fuzzy match so speech recognition spellings ("levothyroxin", "met formin") still hit
+    best = 0.0
+    size = len(name.split())
+    for n in (size, size + 1):
+        for i in range(len(words) - n + 1):
+            candidate = " ".join(words[i:i + n])
+            best = max(best, SequenceMatcher(None, candidate.replace(" ", ""), name.replace(" ", "")).ratio())
+    return best
+
+
+def match_medication(words: list, names: list) -> Optional[str]:
+    best, best_score = None, 0.0
+    for name in names:
+        score = _match_score(words, name)
+        if score > best_score:
+            best, best_score = name, score
+    return best if best_score >= FUZZY_THRESHOLD else None
+
+
+def mentioned_medications(words: list, names: list) -> list:
+    # every name (or nickname) the utterance mentions
+    return [name for name in names if _match_score(words, name) >= FUZZY_THRESHOLD]
+
+
+def _record(hit: bool):
+    with _stats_lock:
+        intent_stats["hits" if hit else "misses"] += 1
+
+
+def detect_intent(utterance: str, names: list, last_prompt: str = "") -> Optional[dict]:
+    # returns {"hang_up", "medication", "status"} when confident, None to fall back to GPT.
+    # last_prompt is what the assistant said before this utterance.
+    text = (utterance or "").lower()
+    words = re.findall(r"[a-z0-9']+", text)
+    result = None
+
+    prompt = (last_prompt or "").lower()
+    asked_about_medication = bool(SUSPICIOUS.search(prompt)) or (
+        bool(names) and match_medication(re.findall(r"[a-z0-9']+", prompt), names) is not None
+    )
+
+    mentioned = mentioned_medications(words, names) if names else []
+    if len(mentioned) > 1:
+        # "I haven't taken my metformin but I took levothyroxine": which status goes with which drug is for GPT
+        _record(False)
+        return None
+    medication = mentioned[0] if mentioned else None
+    is_goodbye = bool(GOODBYE.search(text) or CLOSING.search(text.strip()))
+
+    if is_goodbye and not medication and len(words) <= MAX_GOODBYE_WORDS:
+        # a negated or held-off goodbye is for GPT to untangle, hanging up on the patient is not undoable
+        if not NEGATION.search(text) and not GOODBYE_HOLD.search(text):
+            result = {"hang_up": True, "medication": "", "status": ""}
+    elif medication and not is_goodbye:
+        statuses = [status for status, pattern in STATUS_PATTERNS if pattern.search(text)]
+        # a negation next to anything but "not taking" ("I won't need a refill") is for GPT to untangle
+        if statuses and (statuses[0] == "not taking" or not NEGATION.search(text)):
+            result = {"hang_up": False, "medication": medication, "status": statuses[0]}
+    elif not medication and not is_goodbye and not SUSPICIOUS.search(text) and not asked_about_medication:
+        # "yes I did" only means something next to the question it answers
+        result = {"hang_up": False, "medication": "", "status": ""}
+
+    _record(result is not None)
+    return result
@@ -0,0 +1,135 @@
+#jobs.py
+# Durable job queue backed by the jobs table. Webhooks enqueue work and return right away; a pool of
+# worker threads claims due jobs, runs the registered handler and retries failures with exponential
+# backoff. Jobs live in the database, so anything queued or mid-flight when the process stops is
+# picked up again after a restart (a running job whose lock expired is claimed again).
+from datetime import datetime, timedelta
+from sqlalchemy import update, select, or_, and_
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from loguru import logger
+import threading
+import random
+import json
+import os
+
+from database import SessionLocal
+from models import Job, JobStatus
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_SECONDS = float(os.getenv("JOB_BACKOFF_SECONDS", "5"))
+# how long a claimed job may run before another worker assumes its worker died
+JOB_LOCK_SECONDS = int(os.getenv("JOB_LOCK_SECONDS", "300"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+# kind -> handler(payload: dict). Handlers may update payload in place to checkpoint progress,
+# the updated payload is saved when the job fails so the retry can skip finished steps.
+handlers = {}
+
+_wakeup = threading.Event()
+
+
+def register_handler(kind: str, handler):
+    handlers[kind] = handler
+
+
+def enqueue_job(db: Session, kind: str, payload: dict) -> Job:
+    job = Job(kind=kind, payload=json.dumps(payload, default=str), next_run_at=datetime.utcnow())
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    _wakeup.set()
+    logger.info(f"Queued {kind} job {job.id}")
+    return job
+
+
+async def enqueue_job_async(db: AsyncSession, kind: str, payload: dict) -> Job:
+    # same as enqueue_job, for webhooks running on the async engine
+    job = Job(kind=kind, payload=json.dumps(payload, default=str), next_run_at=datetime.utcnow())
+    db.add(job)
+    await db.commit()
+    _wakeup.set()
+    logger.info(f"Queued {kind} job {job.id}")
+    return job
+
+
+def claim_job(db: Session):
+    now = datetime.utcnow()
+    due = or_(
+        and_(Job.status == JobStatus.queued, Job.next_run_at <= now),
+        and_(Job.status == JobStatus.running, Job.locked_until < now),
+    )
+    job_id = db.execute(select(Job.id).where(due).order_by(Job.next_run_at).limit(1)).scalar()
+    if job_id is None:
+        return None
+    # the status/lock check in the WHERE makes the claim atomic between workers
+    claimed = db.execute(
+        update(Job)
+        .where(Job.id == job_id, due)
+        .values(status=JobStatus.running, locked_until=now + timedelta(seconds=JOB_LOCK_SECONDS))
+    ).rowcount
+    db.commit()
+    if not claimed:
+        return None
+    return db.get(Job, job_id)
+
+
+def run_job(db: Session, job: Job):
+    payload = json.loads(job.payload)
+    try:
+        handlers[job.kind](payload)
+    except Exception as e:
+        job.attempts += 1
+        job.last_error = repr(e)
+        job.payload = json.dumps(payload, default=str)
+        job.locked_until = None
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = JobStatus.failed
+            logger.error(f"{job.kind} job {job.id} failed for good after {job.attempts} attempts: {e!r}")
+        else:
+            delay = JOB_BACKOFF_SECONDS * 2 ** (job.attempts - 1) * random.uniform(0.8, 1.2)
+            job.status = JobStatus.queued
+            job.next_run_at = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"{job.kind} job {job.id} failed (attempt {job.attempts}), retrying in {delay:.0f}s: {e!r}")
+        db.commit()
+        return
+    job.status = JobStatus.done
+    job.locked_until = None
+    db.commit()
+    logger.info(f"{job.kind} job {job.id} done")
+
+
+class JobWorkerPool:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers")
+
+    def stop(self):
+        self._stop.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                job = claim_job(db)
+                if job is not None:
+                    run_job(db, job)
+                    continue
+            except Exception as e:
+                logger.error(f"Job worker error: {e!r}")
+            finally:
+                db.close()
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
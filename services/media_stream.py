@@ -0,0 +1,290 @@
+#media_stream.py
+# Streaming call mode (CALL_MODE=stream). Instead of <Gather> -> /process_speech -> <Say> round trips,
+# /answer_stream connects the call to the /media_stream WebSocket. Caller audio is transcribed as it
+# arrives and the GPT reply is streamed token by token, so each finished sentence is synthesized and
+# played while the rest of the reply is still being generated.
+#
+# Besides Twilio's own events (connected/start/media/mark/stop) the socket accepts a
+# {"event": "text", "text": "..."} frame carrying an already transcribed utterance, which is what
+# benchmarks/fake_media_stream_client.py uses to drive a call without a phone or a speech service.
+from fastapi import APIRouter, Form, Response, WebSocket, WebSocketDisconnect
+from twilio.twiml.voice_response import VoiceResponse
+from loguru import logger
+import asyncio
+import base64
+import json
+import os
+import re
+import time
+
+from services.twiliogpt import sessions, classify_turn, fast_classify, update_summary, timed, NGROK_URL
+from services.clients import async_openai_client
+from services.context import context_messages, context_transcript
+from services.events import publish
+from services.emergency import check_emergency
+from services.metrics import observe_span
+from services.model_router import model_router, attribution
+from services.tts import Synthesizer, create_synthesizer
+
+router = APIRouter()
+
+STREAM_STT = os.getenv("STREAM_STT", "azure")
+STREAM_TTS = os.getenv("STREAM_TTS", "azure")
+
+# Twilio media frames are 20ms of 8kHz mu-law audio
+FRAME_BYTES = 160
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_sentences(buffer: str):
+    # returns (finished sentences, unfinished remainder)
+    parts = SENTENCE_END.split(buffer)
+    return [p.strip() for p in parts[:-1] if p.strip()], parts[-1]
+
+
+# ---------------------------
+# Speech to text
+# ---------------------------
+class Transcriber:
+    def __init__(self, on_utterance):
+        # on_utterance(text) is called on the event loop for every finished utterance
+        self.on_utterance = on_utterance
+
+    def feed(self, audio: bytes):
+        pass
+
+    def close(self):
+        pass
+
+
+class AzureTranscriber(Transcriber):
+    def __init__(self, on_utterance):
+        import azure.cognitiveservices.speech as speechsdk
+
+        super().__init__(on_utterance)
+        loop = asyncio.get_running_loop()
+        speech_config = speechsdk.SpeechConfig(subscription=os.environ.get("SPEECH_KEY"), region=os.environ.get("SPEECH_REGION"))
+        speech_config.speech_recognition_language = "en-US"
+        stream_format = speechsdk.audio.AudioStreamFormat(
+            samples_per_second=8000, bits_per_sample=8, channels=1,
+            wave_stream_format=speechsdk.audio.AudioStreamWaveFormat.MULAW,
+        )
+        self.stream = speechsdk.audio.PushAudioInputStream(stream_format)
+        audio_config = speechsdk.audio.AudioConfig(stream=self.stream)
+        self.recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+
+        def recognized(evt):
+            if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+                # called on the SDK's thread
+                loop.call_soon_threadsafe(self.on_utterance, evt.result.text)
+
+        self.recognizer.recognized.connect(recognized)
+        self.recognizer.start_continuous_recognition_async()
+
+    def feed(self, audio):
+        self.stream.write(audio)
+
+    def close(self):
+        self.stream.close()
+        self.recognizer.stop_continuous_recognition_async()
+
+
+def create_transcriber(on_utterance) -> Transcriber:
+    if STREAM_STT == "azure":
+        return AzureTranscriber(on_utterance)
+    # "none": audio is ignored, utterances only arrive as text frames
+    return Transcriber(on_utterance)
+
+
+# ---------------------------
+# Webhooks
+# ---------------------------
+@router.post("/answer_stream")
+def answer_stream(CallSid: str = Form(...)):
+    logger.info(f"Answering call {CallSid} in stream mode")
+    response = VoiceResponse()
+    connect = response.connect()
+    stream = connect.stream(url=NGROK_URL.replace("https://", "wss://").replace("http://", "ws://") + "/media_stream")
+    stream.parameter(name="callSid", value=CallSid)
+    return Response(content=str(response), media_type="application/xml")
+
+
+class MediaStreamCall:
+    def __init__(self, websocket: WebSocket, synthesizer: Synthesizer):
+        self.websocket = websocket
+        self.synthesizer = synthesizer
+        self.stream_sid = None
+        self.session = None
+        self.utterances = asyncio.Queue()
+        self.marks_sent = 0
+        self.hung_up = False
+
+    def on_utterance(self, text):
+        self.utterances.put_nowait((text, time.perf_counter()))
+
+    async def send_audio(self, audio: bytes):
+        for i in range(0, len(audio), FRAME_BYTES):
+            await self.websocket.send_json({
+                "event": "media",
+                "streamSid": self.stream_sid,
+                "media": {"payload": base64.b64encode(audio[i:i + FRAME_BYTES]).decode()},
+            })
+        # Twilio echoes the mark back once everything before it has been played
+        self.marks_sent += 1
+        await self.websocket.send_json({"event": "mark", "streamSid": self.stream_sid, "mark": {"name": f"m{self.marks_sent}"}})
+
+    async def speak(self, text: str, heard_at: float = None):
+        try:
+            audio = await self.synthesizer.synthesize(text)
+        except Exception as e:
+            # the line is lost but the call goes on, as it did when a failed synthesis came back silent
+            logger.warning(f"Could not synthesize {text!r} for {self.session.call_sid}: {e!r}")
+            return
+        if heard_at is not None:
+            elapsed = time.perf_counter() - heard_at
+            observe_span("first_audio", elapsed, self.session.call_sid)
+            logger.info(f"Time to first audio for {self.session.call_sid}: {elapsed:.3f}s")
+        await self.send_audio(audio)
+
+    async def stream_reply(self, heard_at: float) -> str:
+        # speak the reply sentence by sentence as the tokens come in
+        reply = ""
+        buffer = ""
+        first = True
+        tags = attribution(self.session)
+        model = model_router.choose("reply", self.session.call_sid)
+        start = time.perf_counter()
+        stream = await async_openai_client().chat.completions.create(
+            model=model,
+            messages=context_messages(self.session),
+            stream=True,
+            # the last chunk carries the token counts
+            stream_options={"include_usage": True},
+        )
+        usage = None
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            token = chunk.choices[0].delta.content
+            reply += token
+            buffer += token
+            sentences, buffer = split_sentences(buffer)
+            for sentence in sentences:
+                await self.speak(sentence, heard_at if first else None)
+                first = False
+        if buffer.strip():
+            await self.speak(buffer.strip(), heard_at if first else None)
+        model_router.record("reply", model, usage, time.perf_counter() - start, **tags)
+        return reply.strip()
+
+    async def take_turn(self, text: str, heard_at: float):
+        logger.info(f"User Input ({self.session.call_sid}): {text}")
+        conversation = self.session.conversation
+        conversation.append({"role": "user", "content": text})
+
+        call_sid = self.session.call_sid
+        timings = {}
+        output = fast_classify(self.session)
+        if output is None:
+            classify_task = asyncio.create_task(timed("classifier", timings, classify_turn(context_transcript(self.session), self.session), call_sid))
+        reply_task = None
+        if output is None or not output.hang_up:
+            reply_task = asyncio.create_task(timed("reply", timings, self.stream_reply(heard_at), call_sid))
+        summary_task = asyncio.create_task(update_summary(self.session, timings))
+        emergency_task = asyncio.create_task(
+            check_emergency(self.session, text, heard_at, async_openai_client(), context_transcript(self.session))
+        )
+
+        is_hang_up = False
+        try:
+            if output is None:
+                output = await classify_task
+            is_hang_up = output.hang_up
+            if output.medication:
+                self.session.medication_updates[output.medication] = output.status
+            publish(self.session.patient_data.get("patient_id"), "turn", call_sid=self.session.call_sid,
+                    medication=output.medication, status=output.status, hang_up=output.hang_up)
+        except Exception as e:
+            logger.warning(f"Classifier error: {e}")
+
+        if is_hang_up:
+            if reply_task is not None:
+                reply_task.cancel()
+                # drop whatever part of the reply is still queued for playback
+                await self.websocket.send_json({"event": "clear", "streamSid": self.stream_sid})
+            logger.info("User requested to hang up")
+            await self.speak("Goodbye")
+            self.hung_up = True
+        else:
+            try:
+                assistant_reply = await reply_task
+                conversation.append({"role": "assistant", "content": assistant_reply})
+                logger.info(f"AI Response ({self.session.call_sid}): {assistant_reply}")
+            except Exception as e:
+                logger.info(f"OpenAI API Error: {e}")
+                await self.speak("Sorry, I have experienced a software issue.")
+
+        await summary_task
+        await emergency_task
+        sessions.save(self.session)
+        observe_span("turn", time.perf_counter() - heard_at, call_sid)
+
+    async def run_turns(self):
+        while not self.hung_up:
+            text, heard_at = await self.utterances.get()
+            await self.take_turn(text, heard_at)
+
+
+@router.websocket("/media_stream")
+async def media_stream(websocket: WebSocket):
+    await websocket.accept()
+    call = MediaStreamCall(websocket, create_synthesizer(STREAM_TTS))
+    transcriber = None
+    turns = None
+    try:
+        while True:
+            message = json.loads(await websocket.receive_text())
+            event = message.get("event")
+
+            if event == "start":
+                call.stream_sid = message["start"]["streamSid"]
+                call_sid = message["start"].get("customParameters", {}).get("callSid") or message["start"].get("callSid")
+                call.session = sessions.get(call_sid)
+                if call.session is None:
+                    logger.warning(f"No session for call {call_sid}")
+                    break
+                logger.info(f"Media stream {call.stream_sid} started for call {call_sid}")
+                transcriber = create_transcriber(call.on_utterance)
+                turns = asyncio.create_task(call.run_turns())
+                if len(call.session.conversation) == 1:
+                    publish(call.session.patient_data.get("patient_id"), "call_answered", call_sid=call_sid)
+                    await call.speak("Hello " + call.session.patient_data["first_name"] + "! This is Blue Buddy calling to check in!")
+
+            elif event == "media" and transcriber is not None:
+                transcriber.feed(base64.b64decode(message["media"]["payload"]))
+
+            elif event == "text" and call.session is not None:
+                call.on_utterance(message["text"])
+
+            elif event == "mark":
+                # once the goodbye has been played, closing the socket ends the call
+                if call.hung_up and message["mark"]["name"] == f"m{call.marks_sent}":
+                    break
+
+            elif event == "stop":
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if turns is not None:
+            turns.cancel()
+        if transcriber is not None:
+            transcriber.close()
+        if call.session is not None:
+            logger.info(f"Media stream closed for call {call.session.call_sid}")
+    try:
+        await websocket.close()
+    except Exception:
+        pass
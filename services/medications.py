@@ -0,0 +1,71 @@
+#medications.py
+# Links what the patient says about their medications during a call to medication_schedules rows.
+# The index is built with the patient context (services/patient_context.py) before the call is placed:
+# drug name and nickname -> today's dose slots. Every classifier update during the call is resolved in
+# memory, and the post_call job writes all the MedicationLog rows with one bulk insert next to the CallLog.
+from datetime import datetime, timedelta
+from typing import Optional
+
+from models import MedicationSchedule, MedicationScheduleStatus, MedicationLogStatus, Prescription
+from services.intent import match_medication
+
+# classifier status -> MedicationLog status. "need refill" says nothing about today's dose, so it isn't logged
+LOG_STATUSES = {
+    "taken": MedicationLogStatus.taken,
+    "not taking": MedicationLogStatus.skipped,
+    "delayed": MedicationLogStatus.delayed,
+    "taking later": MedicationLogStatus.delayed,
+}
+
+
+def todays_slots(now: datetime):
+    # join condition for a prescription's active medication_schedules rows on now's day
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ((MedicationSchedule.fk_prescription_id == Prescription.id)
+            & (MedicationSchedule.scheduled_time >= day_start)
+            & (MedicationSchedule.scheduled_time < day_start + timedelta(days=1))
+            & (MedicationSchedule.status == MedicationScheduleStatus.active))
+
+
+def add_to_index(index: dict, prescription_id, name, nick, schedule_id, scheduled_time):
+    # index is {"levothyroxine": {"prescription_id": 3, "slots": [[schedule_id, "2025-01-01T08:00:00"], ...]}, ...}
+    # and gets one (prescription, slot) row at a time, in scheduled_time order
+    for key in {(name or "").strip().lower(), (nick or "").strip().lower()} - {""}:
+        entry = index.setdefault(key, {"prescription_id": prescription_id, "slots": []})
+        if schedule_id is not None:
+            entry["slots"].append([schedule_id, scheduled_time.isoformat()])
+
+
+def resolve_medication(index: dict, medication: str) -> Optional[dict]:
+    # the GPT classifier returns free text, so fall back to the same fuzzy match as the local classifier
+    name = (medication or "").strip().lower()
+    if name in index:
+        return index[name]
+    match = match_medication(name.split(), list(index))
+    return index[match] if match else None
+
+
+def pick_slot(slots: list, call_time: datetime) -> Optional[int]:
+    # the most recent dose that was due by the call, or today's first one if none was due yet
+    due = [schedule_id for schedule_id, scheduled_time in slots if datetime.fromisoformat(scheduled_time) <= call_time]
+    if due:
+        return due[-1]
+    return slots[0][0] if slots else None
+
+
+def medication_log_rows(index: dict, updates: dict, patient_id: int, call_log_id: int, call_time: datetime) -> list:
+    # a name and its nickname point at the same slot, so rows are keyed by slot and the later update wins
+    rows = {}
+    for medication, status in updates.items():
+        log_status = LOG_STATUSES.get((status or "").strip().lower())
+        entry = resolve_medication(index, medication)
+        if log_status is None or entry is None:
+            continue
+        schedule_id = pick_slot(entry["slots"], call_time)
+        rows[(entry["prescription_id"], schedule_id)] = {
+            "fk_patient_id": patient_id,
+            "fk_medication_schedule_id": schedule_id,
+            "fk_call_log_id": call_log_id,
+            "status": log_status,
+        }
+    return list(rows.values())
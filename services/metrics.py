@@ -0,0 +1,186 @@
+#metrics.py
+# In-process metrics in the Prometheus text format, served from GET /metrics (main.py).
+#
+# span(stage, call_sid) / observe_span(...) time one step of a call (webhook, classifier, reply, twiml,
+# post-call summary, ...) into the span_seconds histogram and keep the last spans of each CallSid for
+# GET /metrics/calls/{call_sid}. Alongside the buckets every histogram exports p50/p95/p99 over its
+# recent samples. Counters cover OpenAI tokens and Twilio API calls; DB statements are timed through
+# engine events and the dispatcher reports how late each scheduled call went out.
+#
+# Metrics are per process: with several uvicorn workers, scrape each one.
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from sqlalchemy import event
+import threading
+import time
+
+PREFIX = "hackmt"
+# seconds, sized for webhook/LLM latencies
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+RECENT_SAMPLES = 1000
+MAX_TRACKED_CALLS = 500
+SPANS_PER_CALL = 200
+
+_lock = threading.Lock()
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        with _lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help_text = help_text
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count], plus a window of recent samples for the quantiles
+        self.series = {}
+        self.recent = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+                self.recent[key] = deque(maxlen=RECENT_SAMPLES)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+            self.recent[key].append(value)
+
+    def quantiles(self, **labels) -> dict:
+        with _lock:
+            samples = sorted(self.recent.get(tuple(sorted(labels.items())), ()))
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(len(samples) * q))] for q in QUANTILES}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        quantile_lines = [f"# HELP {self.name}_recent {self.help_text} (last {RECENT_SAMPLES} samples)",
+                          f"# TYPE {self.name}_recent summary"]
+        for key, series in self.series.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(labels)} {series[-1]}")
+            for q, value in self.quantiles(**labels).items():
+                quantile_lines.append(f"{self.name}_recent{_labels({**labels, 'quantile': q})} {value}")
+        return lines + quantile_lines
+
+
+span_seconds = Histogram("span_seconds", "Duration of one step of a call")
+http_request_seconds = Histogram("http_request_seconds", "HTTP request duration by route")
+db_statement_seconds = Histogram("db_statement_seconds", "Database statement duration")
+scheduler_lag_seconds = Histogram("scheduler_lag_seconds", "How late a scheduled call was placed after its call time")
+scheduler_last_lag_seconds = Gauge("scheduler_last_lag_seconds", "Lag of the most recently placed scheduled call")
+openai_tokens_total = Counter("openai_tokens_total", "OpenAI tokens used")
+openai_requests_total = Counter("openai_requests_total", "OpenAI requests")
+twilio_api_calls_total = Counter("twilio_api_calls_total", "Twilio REST API calls")
+patient_context_lookups_total = Counter("patient_context_lookups_total", "Patient context cache lookups by result")
+audio_cache_lookups_total = Counter("audio_cache_lookups_total", "Pre-rendered audio lookups by result")
+webhook_replays_total = Counter("webhook_replays_total", "Repeated Twilio webhooks answered without running them again")
+
+METRICS = [span_seconds, http_request_seconds, db_statement_seconds, scheduler_lag_seconds,
+           scheduler_last_lag_seconds, openai_tokens_total, openai_requests_total, twilio_api_calls_total,
+           patient_context_lookups_total, webhook_replays_total, audio_cache_lookups_total]
+
+# call_sid -> recent [stage, seconds, unix time]
+call_spans = OrderedDict()
+
+
+def observe_span(stage: str, seconds: float, call_sid: str = None):
+    span_seconds.observe(seconds, stage=stage)
+    if not call_sid:
+        return
+    with _lock:
+        spans = call_spans.pop(call_sid, None) or deque(maxlen=SPANS_PER_CALL)
+        spans.append([stage, round(seconds, 4), time.time()])
+        call_spans[call_sid] = spans
+        while len(call_spans) > MAX_TRACKED_CALLS:
+            call_spans.popitem(last=False)
+
+
+@contextmanager
+def span(stage: str, call_sid: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(stage, time.perf_counter() - start, call_sid)
+
+
+def record_openai_usage(model: str, usage, purpose: str):
+    # usage is the response's usage block (None when the API didn't return one)
+    openai_requests_total.inc(model=model, purpose=purpose)
+    if usage is None:
+        return
+    openai_tokens_total.inc(usage.prompt_tokens or 0, model=model, purpose=purpose, kind="prompt")
+    openai_tokens_total.inc(usage.completion_tokens or 0, model=model, purpose=purpose, kind="completion")
+
+
+def record_twilio_call(operation: str):
+    twilio_api_calls_total.inc(operation=operation)
+
+
+def instrument_engine(engine):
+    # times every statement on engine, labelled by the statement's first keyword
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        db_statement_seconds.observe(time.perf_counter() - start, operation=operation)
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def call_timeline(call_sid: str) -> list:
+    with _lock:
+        return [{"stage": stage, "seconds": seconds, "at": at} for stage, seconds, at in call_spans.get(call_sid, ())]
@@ -0,0 +1,224 @@
+#model_router.py
+# Picks the OpenAI model for each LLM task and records what every request cost.
+#
+# MODEL_<TASK> lists the models a task may use, preferred first, e.g. MODEL_REPLY=gpt-4o,gpt-4o-mini.
+# The structured turn classifier and the running summary default to gpt-4o-mini. Replies, emergency
+# checks and the post-call summary default to gpt-4o. Two budgets move a task down its list:
+#   MODEL_LATENCY_BUDGET_MS_<TASK>  a model whose p95 over the last MODEL_LATENCY_WINDOW_SECONDS is over
+#                                   budget is skipped until its slow samples age out
+#   MODEL_CALL_COST_BUDGET_USD      once a call has spent this much, its requests use the last model
+# Both are off (0) by default. Costs come from MODEL_PRICES (USD per 1M prompt/completion tokens).
+#
+# Every request is also written to the llm_usage table (tokens and latency, per call and turn) by a writer
+# thread, so the hot path never waits on the database. GET /usage/calls/{call_sid} and GET /usage/summary
+# read it back.
+from collections import OrderedDict, deque
+from datetime import datetime
+from sqlalchemy import select, insert, func
+from loguru import logger
+from typing import Optional
+import threading
+import queue
+import json
+import time
+import os
+
+from database import SessionLocal
+from models import LlmUsage
+from services.metrics import record_openai_usage
+
+TASKS = {
+    "classifier": "gpt-4o-mini",
+    "reply": "gpt-4o",
+    "running_summary": "gpt-4o-mini",
+    "emergency": "gpt-4o",
+    "post_call_summary": "gpt-4o",
+}
+# USD per 1M tokens, (prompt, completion)
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    **{model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES", "{}")).items()},
+}
+MODEL_LATENCY_WINDOW_SECONDS = float(os.getenv("MODEL_LATENCY_WINDOW_SECONDS", "300"))
+# fewer samples than this in the window and the model isn't judged
+MODEL_LATENCY_MIN_SAMPLES = int(os.getenv("MODEL_LATENCY_MIN_SAMPLES", "5"))
+MODEL_CALL_COST_BUDGET_USD = float(os.getenv("MODEL_CALL_COST_BUDGET_USD", "0"))
+# calls whose running cost is tracked, the oldest are dropped past this
+MODEL_MAX_TRACKED_CALLS = int(os.getenv("MODEL_MAX_TRACKED_CALLS", "5000"))
+
+
+def attribution(session) -> dict:
+    # the call_sid, turn and patient_id to record a request made during session's call under
+    if session is None:
+        return {}
+    return {"call_sid": session.call_sid, "turn": session.turns, "patient_id": session.patient_data.get("patient_id")}
+
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class ModelRouter:
+    def __init__(self, window_seconds: float = MODEL_LATENCY_WINDOW_SECONDS,
+                 call_cost_budget: float = MODEL_CALL_COST_BUDGET_USD):
+        self.tiers = {
+            task: [model.strip() for model in os.getenv(f"MODEL_{task.upper()}", default).split(",") if model.strip()]
+            for task, default in TASKS.items()
+        }
+        self.latency_budgets = {
+            task: float(os.getenv(f"MODEL_LATENCY_BUDGET_MS_{task.upper()}", "0")) / 1000 for task in TASKS
+        }
+        self.window_seconds = window_seconds
+        self.call_cost_budget = call_cost_budget
+        # (task, model) -> deque of (recorded_at, seconds)
+        self._latencies = {}
+        # call_sid -> USD spent so far, least recently used first
+        self._call_costs = OrderedDict()
+        self._lock = threading.Lock()
+        self.pending = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def latency_p95(self, task: str, model: str) -> Optional[float]:
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            samples = self._latencies.get((task, model))
+            if samples is None:
+                return None
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            if len(samples) < MODEL_LATENCY_MIN_SAMPLES:
+                return None
+            latencies = sorted(seconds for _, seconds in samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def call_cost(self, call_sid: str) -> float:
+        with self._lock:
+            return self._call_costs.get(call_sid, 0.0)
+
+    def choose(self, task: str, call_sid: str = None) -> str:
+        tiers = self.tiers[task]
+        if call_sid and self.call_cost_budget and self.call_cost(call_sid) >= self.call_cost_budget:
+            return tiers[-1]
+        budget = self.latency_budgets[task]
+        if not budget:
+            return tiers[0]
+        for model in tiers:
+            p95 = self.latency_p95(task, model)
+            if p95 is None or p95 <= budget:
+                return model
+        return tiers[-1]
+
+    def record(self, task: str, model: str, usage, seconds: float, call_sid: str = None, turn: int = None,
+               patient_id: int = None):
+        # usage is the response's usage block (None when the API didn't return one)
+        record_openai_usage(model, usage, task)
+        prompt_tokens = (usage.prompt_tokens or 0) if usage is not None else 0
+        completion_tokens = (usage.completion_tokens or 0) if usage is not None else 0
+        with self._lock:
+            self._latencies.setdefault((task, model), deque()).append((time.monotonic(), seconds))
+            if call_sid:
+                cost = self._call_costs.pop(call_sid, 0.0) + request_cost(model, prompt_tokens, completion_tokens)
+                self._call_costs[call_sid] = cost
+                while len(self._call_costs) > MODEL_MAX_TRACKED_CALLS:
+                    self._call_costs.popitem(last=False)
+        self.pending.put({
+            "call_sid": call_sid, "fk_patient_id": patient_id, "turn": turn, "task": task, "model": model,
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "latency_ms": round(seconds * 1000, 1), "created_at": datetime.utcnow(),
+        })
+
+    def end_call(self, call_sid: str):
+        with self._lock:
+            self._call_costs.pop(call_sid, None)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._write, name="llm-usage-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.pending.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _write(self):
+        # batches whatever queued up while the last insert ran; what is queued at stop is still written
+        while True:
+            batch = [self.pending.get()]
+            while not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            rows = [row for row in batch if row is not None]
+            if rows:
+                db = SessionLocal()
+                try:
+                    db.execute(insert(LlmUsage), rows)
+                    db.commit()
+                except Exception as e:
+                    logger.error(f"Could not write {len(rows)} LLM usage rows: {e!r}")
+                finally:
+                    db.close()
+            if self._stop.is_set() and self.pending.empty():
+                return
+
+
+model_router = ModelRouter()
+
+
+def call_usage_query(call_sid: str):
+    return (
+        select(LlmUsage.turn, LlmUsage.task, LlmUsage.model, LlmUsage.prompt_tokens, LlmUsage.completion_tokens,
+               LlmUsage.latency_ms)
+        .where(LlmUsage.call_sid == call_sid)
+        .order_by(LlmUsage.id)
+    )
+
+
+def call_usage(call_sid: str, rows) -> dict:
+    # per turn and whole-call totals. A turn's requests run concurrently, so its slowest request
+    # rather than the sum is what the caller waited on
+    turns = {}
+    totals = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    for row in rows:
+        cost = request_cost(row.model, row.prompt_tokens, row.completion_tokens)
+        turn = turns.setdefault(row.turn, {"turn": row.turn, "requests": [], "prompt_tokens": 0,
+                                           "completion_tokens": 0, "cost_usd": 0.0, "slowest_ms": 0.0})
+        turn["requests"].append({"task": row.task, "model": row.model, "prompt_tokens": row.prompt_tokens,
+                                 "completion_tokens": row.completion_tokens, "latency_ms": row.latency_ms})
+        turn["slowest_ms"] = max(turn["slowest_ms"], row.latency_ms)
+        for summary in (turn, totals):
+            summary["prompt_tokens"] += row.prompt_tokens
+            summary["completion_tokens"] += row.completion_tokens
+            summary["cost_usd"] += cost
+        totals["requests"] += 1
+    for summary in (*turns.values(), totals):
+        summary["cost_usd"] = round(summary["cost_usd"], 6)
+    return {"call_sid": call_sid, **totals, "turns": list(turns.values())}
+
+
+def usage_summary_query(since: datetime):
+    return (
+        select(LlmUsage.task, LlmUsage.model, func.count().label("requests"),
+               func.sum(LlmUsage.prompt_tokens).label("prompt_tokens"),
+               func.sum(LlmUsage.completion_tokens).label("completion_tokens"),
+               func.avg(LlmUsage.latency_ms).label("avg_latency_ms"), func.max(LlmUsage.latency_ms).label("max_latency_ms"),
+               func.count(func.distinct(LlmUsage.call_sid)).label("calls"))
+        .where(LlmUsage.created_at >= since)
+        .group_by(LlmUsage.task, LlmUsage.model)
+        .order_by(LlmUsage.task, LlmUsage.model)
+    )
+
+
+def usage_summary(rows) -> list:
+    # one entry per (task, model) with its cost and per-request averages, for tuning the routes above
+    return [
+        {"task": row.task, "model": row.model, "requests": row.requests, "calls": row.calls,
+         "prompt_tokens": row.prompt_tokens, "completion_tokens": row.completion_tokens,
+         "avg_latency_ms": round(row.avg_latency_ms, 1), "max_latency_ms": row.max_latency_ms,
+         "cost_usd": round(request_cost(row.model, row.prompt_tokens, row.completion_tokens), 6),
+         "cost_per_request_usd": round(request_cost(row.model, row.prompt_tokens, row.completion_tokens) / row.requests, 6)}
+        for row in rows
+    ]
@@ -0,0 +1,174 @@
+#patient_context.py
+# What a call needs to know about the patient, read from the database instead of the /make_call payload:
+# name, bio, phone numbers, prescriptions, today's dose slots (the medication index, see
+# services/medications.py) and the follow-up topics from their last call. build_patient_contexts reads
+# any number of patients in one statement.
+#
+# Contexts are cached per patient. An entry is dropped when a transaction that wrote to the patient's
+# rows commits (bump_patient_versions in models.py notes the patient on the connection), when the day
+# changes (today's slots), and after PATIENT_CONTEXT_TTL_SECONDS so writes made by other processes show up.
+# The dispatcher prewarms the patients due in its next window, so placing a call reads nothing from the
+# database.
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select, event
+from sqlalchemy.engine import Engine
+from typing import Optional
+import threading
+import time
+import os
+
+from database import SessionLocal
+from models import Patient, Prescription, MedicationSchedule, Caregiver, CallLog
+from services.medications import todays_slots, add_to_index
+from services.metrics import patient_context_lookups_total
+
+PATIENT_CONTEXT_TTL_SECONDS = int(os.getenv("PATIENT_CONTEXT_TTL_SECONDS", "300"))
+PATIENT_CONTEXT_MAX_ENTRIES = int(os.getenv("PATIENT_CONTEXT_MAX_ENTRIES", "5000"))
+
+
+def context_query(patient_ids: list, now: datetime):
+    # one row per (prescription, today's slot), with the patient, caregiver and last follow-ups repeated
+    caregiver_number = (
+        select(Caregiver.phone_number).where(Caregiver.fk_patient_id == Patient.id)
+        .order_by(Caregiver.id).limit(1).correlate(Patient).scalar_subquery()
+    )
+    # through ix_call_logs_patient_call_time
+    last_follow_up = (
+        select(CallLog.follow_up).where(CallLog.fk_patient_id == Patient.id)
+        .order_by(CallLog.call_time.desc()).limit(1).correlate(Patient).scalar_subquery()
+    )
+    return (
+        select(
+            Patient.id, Patient.first_name, Patient.last_name, Patient.phone_number, Patient.bio, Patient.version,
+            caregiver_number.label("caregiver_number"), last_follow_up.label("follow_up"),
+            Prescription.id.label("prescription_id"), Prescription.name, Prescription.nick,
+            MedicationSchedule.id.label("schedule_id"), MedicationSchedule.scheduled_time,
+        )
+        .outerjoin(Prescription, Prescription.fk_patient_id == Patient.id)
+        .outerjoin(MedicationSchedule, todays_slots(now))
+        .where(Patient.id.in_(patient_ids))
+        .order_by(Patient.id, Prescription.id, MedicationSchedule.scheduled_time)
+    )
+
+
+def build_patient_contexts(db, patient_ids, now: datetime = None) -> dict:
+    # patient_id -> {"patient_data": {...}, "medication_index": {...}, "version": n}; unknown ids are left out
+    now = now or datetime.utcnow()
+    contexts = {}
+    for row in db.execute(context_query(list(patient_ids), now)):
+        context = contexts.get(row.id)
+        if context is None:
+            context = contexts[row.id] = {
+                "patient_data": {
+                    "patient_id": row.id,
+                    "first_name": row.first_name,
+                    "last_name": row.last_name,
+                    "phone_number": row.phone_number,
+                    "caregiver_number": row.caregiver_number or "",
+                    "bio": row.bio or "",
+                    "follow_up_topics": row.follow_up or "",
+                    "prescriptions": {"ids": [], "names": []},
+                },
+                "medication_index": {},
+                "version": row.version,
+            }
+        prescriptions = context["patient_data"]["prescriptions"]
+        if row.prescription_id is not None and row.prescription_id not in prescriptions["ids"]:
+            prescriptions["ids"].append(row.prescription_id)
+            prescriptions["names"].append(row.name)
+        if row.prescription_id is not None:
+            add_to_index(context["medication_index"], row.prescription_id, row.name, row.nick,
+                         row.schedule_id, row.scheduled_time)
+    return contexts
+
+
+def call_request(context: dict, call_time: datetime) -> dict:
+    # the same fields the dashboard posts to /make_call
+    return {**context["patient_data"], "hour": str(call_time.hour), "minute": str(call_time.minute)}
+
+
+class PatientContextCache:
+    def __init__(self, ttl_seconds: int = PATIENT_CONTEXT_TTL_SECONDS, max_entries: int = PATIENT_CONTEXT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # patient_id -> (expires_at, day, context)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation, so a build that overlapped one isn't cached
+        self._invalidations = 0
+
+    def get(self, patient_id: int, now: datetime = None) -> Optional[dict]:
+        # cached context or None, never touches the database
+        day = (now or datetime.utcnow()).date()
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None or entry[0] < time.time() or entry[1] != day:
+                return None
+            self._entries.move_to_end(patient_id)
+            return entry[2]
+
+    def load(self, db, patient_ids, now: datetime = None) -> dict:
+        # contexts for patient_ids, reading only the ones that aren't cached (in one query)
+        now = now or datetime.utcnow()
+        contexts = {}
+        missing = []
+        for patient_id in dict.fromkeys(patient_ids):
+            context = self.get(patient_id, now)
+            if context is None:
+                missing.append(patient_id)
+            else:
+                contexts[patient_id] = context
+        patient_context_lookups_total.inc(len(contexts), result="hit")
+        if not missing:
+            return contexts
+        patient_context_lookups_total.inc(len(missing), result="miss")
+        with self._lock:
+            invalidations = self._invalidations
+        built = build_patient_contexts(db, missing, now)
+        with self._lock:
+            if invalidations == self._invalidations:
+                for patient_id, context in built.items():
+                    self._entries[patient_id] = (time.time() + self.ttl_seconds, now.date(), context)
+                    self._entries.move_to_end(patient_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return {**contexts, **built}
+
+    def context(self, patient_id: int, now: datetime = None) -> Optional[dict]:
+        # cached context, or read it with a session of its own on a miss; None for an unknown patient
+        context = self.get(patient_id, now)
+        if context is not None:
+            patient_context_lookups_total.inc(result="hit")
+            return context
+        db = SessionLocal()
+        try:
+            return self.load(db, [patient_id], now).get(patient_id)
+        finally:
+            db.close()
+
+    def invalidate(self, patient_ids):
+        with self._lock:
+            self._invalidations += 1
+            for patient_id in patient_ids:
+                self._entries.pop(patient_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+
+patient_contexts = PatientContextCache()
+
+
+@event.listens_for(Engine, "commit")
+def invalidate_on_commit(conn):
+    patient_ids = conn.info.pop("changed_patients", None)
+    if patient_ids:
+        patient_contexts.invalidate(patient_ids)
+
+
+@event.listens_for(Engine, "rollback")
+def forget_on_rollback(conn):
+    conn.info.pop("changed_patients", None)
@@ -0,0 +1,189 @@
+#post_call.py
+# Post-call work, run by the job workers (services/jobs.py) after /call_ended has queued it:
+# summarize the call, extract follow-up topics, flag emergencies and write the CallLog and its MedicationLogs.
+# Calls nobody answered only get a missed CallLog and a retry (scheduler/retry_policy.py), no summary.
+from pydantic import BaseModel
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+from loguru import logger
+import time
+
+from database import SessionLocal
+from models import CallScheduleStatus, CallLog, MedicationLog, Patient
+from routers.routes import build_call_log, CallLogCreate
+from services.jobs import register_handler
+from services.medications import medication_log_rows
+from services.adherence import record_call_adherence
+from services.events import publish
+from services.emergency import alert_dispatcher, PRIORITY_NOTICE
+from services.clients import openai_client
+from services.metrics import span
+from services.model_router import model_router
+from scheduler.retry_policy import retry_policy, CallOutcome
+
+
+class CallSummary(BaseModel):
+    summary: str
+    follow_up_topics: str
+    is_emergency: bool
+
+
+def summarize_call(transcript: str, call_sid: str = None, patient_id: int = None) -> CallSummary:
+    prompt = f"""
+    Please briefly summarize the following conversation between a medical assistant and an elderly patient,
+    and provide a short comma separated list of follow-up keyword topics that the medical assistant should discuss with the patient
+    in their next phone call. If the patient has an emergency concern (extreme pain, suicide, refusal to take medicine,
+    falls, heart attack, etc.), please note that as true/false and the primary healthcare provider will be contacted immediately.
+    Conversation:
+    {transcript}
+    """
+    model = model_router.choose("post_call_summary")
+    start = time.perf_counter()
+    gpt_response = openai_client().beta.chat.completions.parse(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format=CallSummary
+    )
+    model_router.record("post_call_summary", model, gpt_response.usage, time.perf_counter() - start,
+                        call_sid=call_sid, patient_id=patient_id)
+    return gpt_response.choices[0].message.parsed
+
+
+def call_logged(call_sid: str) -> bool:
+    db = SessionLocal()
+    try:
+        return db.execute(select(CallLog.id).where(CallLog.call_sid == call_sid)).first() is not None
+    finally:
+        db.close()
+
+
+def resolve_patient_id(patient_data: dict):
+    # dashboard /make_call payloads carry no patient_id, the patient is found by the number that was dialed.
+    # None when nobody (or more than one patient) has that number
+    if patient_data.get("patient_id") is not None:
+        return patient_data["patient_id"]
+    if not patient_data.get("phone_number"):
+        return None
+    db = SessionLocal()
+    try:
+        patient_ids = db.execute(
+            select(Patient.id).where(Patient.phone_number == patient_data["phone_number"]).limit(2)
+        ).scalars().all()
+    finally:
+        db.close()
+    return patient_ids[0] if len(patient_ids) == 1 else None
+
+
+def add_call_log(db, call_log) -> bool:
+    # False when the call already has a log (uq_call_logs_call_sid), db is rolled back then
+    db.add(call_log)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        logger.warning(f"Call {call_log.call_sid} already has a call log, skipping the duplicate job")
+        return False
+    return True
+
+
+def process_call(payload: dict):
+    # a second job for the same call (a repeated /call_ended) stops here, before paying for GPT
+    if call_logged(payload["call_sid"]):
+        logger.warning(f"Call {payload['call_sid']} already has a call log, skipping the duplicate job")
+        return
+    payload["patient_data"]["patient_id"] = resolve_patient_id(payload["patient_data"])
+    if payload["patient_data"]["patient_id"] is None and not payload["patient_data"].get("caregiver_number"):
+        # nowhere to log the call and nobody to alert, the summary would be paid for and thrown away
+        logger.warning(f"Call {payload['call_sid']} matches no patient, not summarizing or logging it")
+        return
+    # each finished step is kept in payload, so a retry after a failed DB write doesn't pay for GPT again
+    if "summary" not in payload:
+        with span("post_call_summary", payload["call_sid"]):
+            output = summarize_call(payload["context"], payload["call_sid"], payload["patient_data"].get("patient_id"))
+        payload["summary"] = output.model_dump()
+    output = CallSummary(**payload["summary"])
+
+    logger.info("Call summary: " + output.summary)
+    logger.info("Follow-up topics: " + str(output.follow_up_topics))
+    logger.info("Is emergency: " + str(output.is_emergency))
+    logger.info("Medication updates: " + str(payload["medication_updates"]))
+    alerts = payload.get("alerts") or []
+    if output.is_emergency:
+        logger.warning(f"Emergency flagged on call {payload['call_sid']}")
+        if not alerts and "alert_sent" not in payload:
+            # nothing fired during the call, tell the caregiver now at normal priority
+            alert_dispatcher.submit({
+                "call_sid": payload["call_sid"],
+                "patient_id": payload["patient_data"].get("patient_id"),
+                "to": payload["patient_data"].get("caregiver_number") or "",
+                "body": f"Blue Buddy alert for {payload['patient_data'].get('first_name', 'your patient')}: {output.summary}",
+                "reason": output.summary,
+            }, priority=PRIORITY_NOTICE)
+            payload["alert_sent"] = True
+
+    # Build call log payload
+    call_log_data = {
+        "patient_id": payload["patient_data"].get("patient_id"),
+        "call_time": datetime.fromisoformat(payload["call_time"]),
+        "call_status": CallScheduleStatus.confirmed,
+        "call_sid": payload["call_sid"],
+        "transcription": payload["transcription"],
+        "summary": output.summary,
+        "alert": "; ".join(alert["reason"] for alert in alerts) or ("Emergency flagged during call" if output.is_emergency else ""),
+        "follow_up": output.follow_up_topics,
+    }
+    if call_log_data["patient_id"] is None:
+        # an ad-hoc call to a number no patient has. The summary was still needed, it is how an emergency
+        # nobody caught during the call reaches the caregiver, but there is no patient to log it under
+        logger.warning(f"Call {payload['call_sid']} matches no patient, not writing a call log")
+        return
+    db = SessionLocal()
+    try:
+        with span("post_call_db_write", payload["call_sid"]):
+            call_log = build_call_log(CallLogCreate(**call_log_data))
+            if not add_call_log(db, call_log):
+                return
+            # every medication update from the call in one insert, resolved against the index built at call start
+            rows = medication_log_rows(payload.get("medication_index") or {}, payload["medication_updates"],
+                                       call_log_data["patient_id"], call_log.id, call_log_data["call_time"])
+            if rows:
+                db.execute(insert(MedicationLog), rows)
+                record_call_adherence(db, call_log.id)
+            retry_policy.record_outcome(db, call_log_data["patient_id"], payload["call_sid"], CallOutcome.answered)
+            db.commit()
+    finally:
+        db.close()
+    publish(call_log_data["patient_id"], "call_summarized", call_sid=payload["call_sid"], summary=output.summary,
+            follow_up=output.follow_up_topics, alert=call_log_data["alert"], is_emergency=output.is_emergency or bool(alerts))
+    logger.info(call_log_data)
+
+
+def process_missed_call(payload: dict):
+    outcome = CallOutcome(payload["outcome"])
+    patient_data = payload["patient_data"]
+    patient_id = resolve_patient_id(patient_data)
+    db = SessionLocal()
+    try:
+        if patient_id is not None:
+            call_log = build_call_log(CallLogCreate(
+                patient_id=patient_id,
+                call_time=datetime.fromisoformat(payload["call_time"]),
+                call_status=CallScheduleStatus.missed,
+                call_sid=payload["call_sid"],
+                summary=f"Call not answered ({outcome.value.replace('_', ' ')})",
+                # the context reads follow-ups from the latest call log, keep them for the next attempt
+                follow_up=patient_data.get("follow_up_topics") or "",
+            ))
+            if not add_call_log(db, call_log):
+                return
+        retry_at = retry_policy.record_outcome(db, patient_id, payload["call_sid"], outcome)
+        db.commit()
+    finally:
+        db.close()
+    publish(patient_id, "call_missed", call_sid=payload["call_sid"], outcome=outcome.value,
+            retry_at=retry_at.isoformat() if retry_at else None)
+
+
+register_handler("post_call", process_call)
+register_handler("missed_call", process_missed_call)
@@ -0,0 +1,141 @@
+#sessions.py
+# Per-call state for the voice bot, keyed by Twilio's CallSid.
+#
+# SESSION_BACKEND=memory (default) keeps sessions in the worker process with TTL/LRU eviction.
+# SESSION_BACKEND=sqlite stores them in SESSION_DB_PATH so the Twilio webhooks for one call
+# can land on any uvicorn worker.
+from collections import OrderedDict
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from loguru import logger
+import threading
+import sqlite3
+import time
+import os
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "7200"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "2000"))
+
+
+class CallSession(BaseModel):
+    call_sid: str
+    patient_data: dict = Field(default_factory=dict)
+    conversation: List[dict] = Field(default_factory=list)
+    medication_updates: dict = Field(default_factory=dict)
+    # medication name/nickname -> today's dose slots, see services/medications.py
+    medication_index: dict = Field(default_factory=dict)
+    # emergency alerts raised during the call, see services/emergency.py
+    alerts: List[dict] = Field(default_factory=list)
+    # rolling summary of the older turns, see services/context.py
+    summary: str = ""
+    summarized_count: int = 0
+    # AnsweredBy from answering machine detection (/call_amd), empty until it reports
+    answered_by: str = ""
+    # the last /process_speech request handled and its TwiML, replayed if Twilio retries it
+    last_turn_key: str = ""
+    last_turn_twiml: str = ""
+
+    @property
+    def turns(self) -> int:
+        # patient utterances so far
+        return sum(1 for message in self.conversation if message["role"] == "user")
+
+
+class SessionStore:
+    def get(self, call_sid: str) -> Optional[CallSession]:
+        raise NotImplementedError
+
+    def save(self, session: CallSession) -> None:
+        raise NotImplementedError
+
+    def delete(self, call_sid: str) -> None:
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS, max_entries: int = SESSION_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # call_sid -> (expires_at, serialized session), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, call_sid):
+        with self._lock:
+            entry = self._sessions.get(call_sid)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at < time.time():
+                del self._sessions[call_sid]
+                return None
+            self._sessions.move_to_end(call_sid)
+        # sessions are stored serialized so callers never share a mutable object
+        return CallSession.model_validate_json(data)
+
+    def save(self, session):
+        data = session.model_dump_json()
+        with self._lock:
+            self._sessions[session.call_sid] = (time.time() + self.ttl_seconds, data)
+            self._sessions.move_to_end(session.call_sid)
+            while len(self._sessions) > self.max_entries:
+                evicted, _ = self._sessions.popitem(last=False)
+                logger.warning(f"Evicted call session {evicted} (store is full)")
+
+    def delete(self, call_sid):
+        with self._lock:
+            self._sessions.pop(call_sid, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str = "./sessions.db", ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+    def _conn(self):
+        # one connection per thread, sqlite3 connections can't be shared across threads. Nothing is opened
+        # until the first use, and a forked worker opens its own instead of reusing its parent's
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS call_sessions ("
+                "call_sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_call_sessions_expires_at ON call_sessions (expires_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, call_sid):
+        row = self._conn().execute(
+            "SELECT data FROM call_sessions WHERE call_sid = ? AND expires_at >= ?",
+            (call_sid, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        return CallSession.model_validate_json(row[0])
+
+    def save(self, session):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO call_sessions (call_sid, data, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(call_sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+            (session.call_sid, session.model_dump_json(), now + self.ttl_seconds),
+        )
+        conn.execute("DELETE FROM call_sessions WHERE expires_at < ?", (now,))
+
+    def delete(self, call_sid):
+        self._conn().execute("DELETE FROM call_sessions WHERE call_sid = ?", (call_sid,))
+
+
+def create_session_store() -> SessionStore:
+    backend = os.getenv("SESSION_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.getenv("SESSION_DB_PATH", "./sessions.db"))
+    if backend != "memory":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    return InMemorySessionStore()
@@ -0,0 +1,52 @@
+#tts.py
+# Text to speech backends, shared by the media stream (services/media_stream.py) and the pre-rendered
+# audio cache (services/audio_cache.py). Every backend returns 8kHz mono mu-law, which is what Twilio
+# media streams carry and what <Play> accepts inside a WAV file.
+import asyncio
+import os
+
+MULAW_SILENCE = b"\xff"
+
+
+class Synthesizer:
+    # identifies the voice in cache keys, audio rendered by another voice must not be reused
+    voice = ""
+
+    async def synthesize(self, text: str) -> bytes:
+        # returns 8kHz mono mu-law audio
+        raise NotImplementedError
+
+
+class AzureSynthesizer(Synthesizer):
+    def __init__(self):
+        import azure.cognitiveservices.speech as speechsdk
+
+        speech_config = speechsdk.SpeechConfig(subscription=os.environ.get("SPEECH_KEY"), region=os.environ.get("SPEECH_REGION"))
+        self.voice = os.getenv("AZURE_VOICE", "en-US-JennyNeural")
+        speech_config.speech_synthesis_voice_name = self.voice
+        speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Raw8Khz8BitMonoMULaw)
+        self.synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        self.completed = speechsdk.ResultReason.SynthesizingAudioCompleted
+
+    async def synthesize(self, text):
+        result = await asyncio.to_thread(lambda: self.synthesizer.speak_text_async(text).get())
+        # a canceled synthesis (bad key, throttling, network) comes back with no audio rather than raising
+        if result.reason != self.completed:
+            details = getattr(result, "cancellation_details", None)
+            raise RuntimeError(f"Speech synthesis failed ({result.reason}): {getattr(details, 'error_details', '')}")
+        return result.audio_data
+
+
+class FakeSynthesizer(Synthesizer):
+    # silence, roughly as long as the text would take to say, for local runs without a speech service
+    voice = "fake"
+
+    async def synthesize(self, text):
+        return MULAW_SILENCE * (len(text) * 480)
+
+
+def create_synthesizer(backend: str) -> Synthesizer:
+    # "azure" or "fake"
+    if backend == "azure":
+        return AzureSynthesizer()
+    return FakeSynthesizer()
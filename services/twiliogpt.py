@@ -3,55 +3,59 @@ from fastapi import APIRouter, Form, Request, Response, HTTPException, Depends
 from loguru import logger
 from dotenv import load_dotenv
 import os
-from sqlalchemy.orm import Session
-from sqlalchemy.testing import db
-from twilio.rest import Client
+from sqlalchemy.ext.asyncio import AsyncSession
 from twilio.twiml.voice_response import VoiceResponse
-import openai
 from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import List, Optional
+import asyncio
 import json
-
-from database import get_db
-from models import CallScheduleStatus
-from routers.routes import create_call_log, CallLogCreate
+import time
+
+from database import get_async_db
+from services.sessions import CallSession, create_session_store
+from services.context import context_messages, context_transcript, render_transcript, needs_summary, summarize_older_turns
+from services.jobs import enqueue_job_async
+from services.intent import detect_intent, medication_names, intent_stats
+from services.patient_context import patient_contexts
+from services.events import publish
+from services.emergency import check_emergency, alert_stats
+from services.metrics import span, observe_span, record_twilio_call, webhook_replays_total
+from services.idempotency import ReplayCache, turn_key
+from services.audio_cache import audio_cache, say_or_play
+from services.model_router import model_router, attribution
+from services.clients import async_openai_client, twilio_client
+from scheduler.retry_policy import call_outcome, CallOutcome
 
 load_dotenv()
 
-logger.add(f"./services/logs/twiliogpt_{datetime.now().strftime('%Y-%m-%d_%H_%M')}.log", rotation="10MB")
-
 router = APIRouter()
-# init gpt client
-openai_client = openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-
-# array to store messages
-conversation = []
-
-follow_up_topics = "Nephew's piano concert, back pain, medication refills"
+# the OpenAI and Twilio clients are created on first use (services/clients.py)
 
-# "name" : "status"
-medications = {
-    "levothyroxine": "taken",
-    "ibuprofen": "not",
-    "amlodipine" : "delayed",
-    "trazodone" : "taking later",
-    "metformin" : "need refill",
-}
+# per-call conversation state, keyed by CallSid
+sessions = create_session_store()
+# /process_speech results by turn, so a retried webhook doesn't run the turn again (services/idempotency.py)
+turn_replays = ReplayCache("process_speech")
+call_end_replays = ReplayCache("call_ended")
 
-medication_updates = {}
+TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
+AI_VOICE = os.getenv("AI_VOICE")
 
-TWILIO_ACCOUNT_SID = os.environ["TWILIO_ACCOUNT_SID"]
-TWILIO_AUTH_TOKEN = os.environ["TWILIO_AUTH_TOKEN"]
-TWILIO_PHONE_NUMBER = os.environ["TWILIO_PHONE_NUMBER"]
-AI_VOICE = os.environ["AI_VOICE"]
+NGROK_URL = os.getenv("NGROK_URL", "")
 
-NGROK_URL = os.environ["NGROK_URL"]
+# "gather" answers with <Gather>/<Say> round trips, "stream" connects the call to the
+# media stream WebSocket in services/media_stream.py
+CALL_MODE = os.getenv("CALL_MODE", "gather")
 
-patient_data = None
+# answering machine detection, run asynchronously so the greeting isn't held up; a call that reaches
+# voicemail is hung up on and retried (scheduler/retry_policy.py)
+CALL_MACHINE_DETECTION = os.getenv("CALL_MACHINE_DETECTION", "1") == "1"
 
-# init twilio client
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+# lines played from pre-rendered audio when it's ready (services/audio_cache.py), the greeting per patient
+GREETING = "Hello {first_name}! This is Blue Buddy calling to check in!"
+GOODBYE = "Goodbye"
+SOFTWARE_ERROR = "Sorry, I have experienced a software issue."
+audio_cache.preload(GOODBYE, SOFTWARE_ERROR)
 
 class CallRequest(BaseModel):
     first_name: str
@@ -63,18 +67,39 @@ class CallRequest(BaseModel):
     bio: str
     hour: str
     minute: str
+    patient_id: Optional[int] = None
  
 
 @router.post("/make_call")
 def make_call(call_request: CallRequest):
-    global patient_data
-
     patient_data = call_request.model_dump()
 
     logger.info(patient_data)
 
-    patient_data["follow_up_topics"] = "Nephew's piano concert, back pain, medication refills"
+    # for a known patient, prescriptions, bio and follow-up topics come from the database (cached)
+    if call_request.patient_id is not None:
+        context = patient_contexts.context(call_request.patient_id)
+        if context is None:
+            raise HTTPException(status_code=404, detail="Patient not found")
+        patient_data.update(context["patient_data"])
+
+    place_call(patient_data)
+    return f"Calling {patient_data['first_name']} at {patient_data['phone_number']}"
+
+def load_medication_index(patient_id: Optional[int]) -> dict:
+    # from the patient context cache, which the dispatcher prewarms; a failure only means updates
+    # can't be linked to today's doses
+    if patient_id is None:
+        return {}
+    try:
+        context = patient_contexts.context(patient_id)
+    except Exception as e:
+        logger.warning(f"Could not build the medication index for patient {patient_id}: {e!r}")
+        return {}
+    return context["medication_index"] if context else {}
 
+def place_call(patient_data: dict) -> str:
+    # dial the patient and start their session, returns the CallSid
     logger.info("Placing call")
     override_phone = os.getenv("PATIENT_PHONE_NUMBER")
 
@@ -90,33 +115,62 @@ def make_call(call_request: CallRequest):
     remimd them they should call their doctor or 9-1-1 for emergencies, but do not call emergency services.
     Ask them one-by-one about their medications after checking in with the patient's personal life,
     and if they are taking them as prescribed.
-    Medications: {patient_data["prescriptions"]}
+    Medications: {", ".join(medication_names(patient_data)) or "none on file"}
     """
 
-    if follow_up_topics:
+    if patient_data.get("bio"):
+        prompt += f"""
+        About them: {patient_data["bio"]}"""
+
+    if patient_data.get("follow_up_topics"):
         prompt += f"""
         Here is a list of follow up topics from the previous phone call.
         Spend some time discussing these briefly to be more personable at the beginning of the call:
         {patient_data["follow_up_topics"]}"""
 
-    conversation.append({"role": "system", "content": prompt})
-
-    twilio_client.calls.create(
-        to=patient_data["phone_number"],
-        from_=TWILIO_PHONE_NUMBER,
-        url=f"{NGROK_URL}/answer",
-        status_callback=f"{NGROK_URL}/call_ended"
-    )
-    return f"Calling {patient_data['first_name']} at {patient_data['phone_number']}"
+    # rendered while the phone rings
+    audio_cache.prepare(GREETING.format(first_name=patient_data["first_name"]))
+
+    machine_detection = {}
+    if CALL_MACHINE_DETECTION:
+        machine_detection = {"machine_detection": "Enable", "async_amd": "true",
+                             "async_amd_status_callback": f"{NGROK_URL}/call_amd"}
+    with span("twilio_calls_create"):
+        call = twilio_client().calls.create(
+            to=patient_data["phone_number"],
+            from_=TWILIO_PHONE_NUMBER,
+            url=f"{NGROK_URL}/answer_stream" if CALL_MODE == "stream" else f"{NGROK_URL}/answer",
+            status_callback=f"{NGROK_URL}/call_ended",
+            **machine_detection
+        )
+    record_twilio_call("calls.create")
+    sessions.save(CallSession(
+        call_sid=call.sid,
+        patient_data=patient_data,
+        conversation=[{"role": "system", "content": prompt}],
+        medication_index=load_medication_index(patient_data.get("patient_id")),
+    ))
+    publish(patient_data.get("patient_id"), "call_placed", call_sid=call.sid)
+    logger.info(f"Call {call.sid} placed")
+    return call.sid
 
 @router.post("/answer")
-def answer_call():
+def answer_call(CallSid: str = Form(...)):
 
     logger.info("answer")
+    start_time = time.perf_counter()
 
     response = VoiceResponse()
 
-    conv_len = len(conversation)
+    session = sessions.get(CallSid)
+    if session is None:
+        logger.warning(f"No session for call {CallSid}")
+        say_or_play(response, SOFTWARE_ERROR, AI_VOICE)
+        response.hangup()
+        return Response(content=str(response), media_type="application/xml")
+
+    patient_data = session.patient_data
+    conv_len = len(session.conversation)
     
     logger.info("Answering call or responding")
     logger.info("Conversation length is "+ str(conv_len))
@@ -124,17 +178,22 @@ def answer_call():
     
     # if len(conversation) == 1, this is the first TTS of the call, therefore it should greet the user
     if conv_len == 1:
-        response.say("Hello " + patient_data["first_name"] + "! This is Blue Buddy calling to check in!", voice=AI_VOICE)
+        say_or_play(response, GREETING.format(first_name=patient_data["first_name"]), AI_VOICE)
+        publish(patient_data.get("patient_id"), "call_answered", call_sid=CallSid)
         
+    # the turn number in the action URL makes each turn's request key unique, even when the patient
+    # says the same thing twice
     response.gather(
         input="speech",
-        action="/process_speech",
+        action=f"/process_speech?seq={session.turns}",
         timeout=5,
         speech_timeout="auto",
         barge_in=True
     )
-    print(str(response))
-    return Response(content=str(response), media_type="application/xml")
+    with span("twiml", CallSid):
+        twiml = str(response)
+    observe_span("answer_webhook", time.perf_counter() - start_time, CallSid)
+    return Response(content=twiml, media_type="application/xml")
 
 class ProcessResponse(BaseModel):
     hang_up: bool
@@ -142,15 +201,95 @@ class ProcessResponse(BaseModel):
     status: str    
 
 
+async def timed(stage: str, timings: dict, coro, call_sid: str = None):
+    # await coro and record how long it took under timings[stage] and in the span_seconds metric
+    start_time = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - start_time
+        timings[stage] = round(elapsed, 3)
+        observe_span(stage, elapsed, call_sid)
+
+async def classify_turn(transcript: str, session=None) -> ProcessResponse:
+    prompt = f"""
+    Based on the following conversation, determine the following:
+    1) if the user explicitly requests to end the call and if it is appropriate to hang up here. 
+    Return 'true' or 'false' only.
+    2) if the user is asked about the medicaiton they are taking, output which one medication they are 
+    referring to and the status (taken/not taking/delayed/taking later/need refill).
+    
+    Conversation: 
+    {transcript}
+    """
+    tags = attribution(session)
+    model = model_router.choose("classifier", tags.get("call_sid"))
+    start = time.perf_counter()
+    gpt_response = await async_openai_client().beta.chat.completions.parse(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format=ProcessResponse
+    )
+    model_router.record("classifier", model, gpt_response.usage, time.perf_counter() - start, **tags)
+    return gpt_response.choices[0].message.parsed
+
+def fast_classify(session) -> Optional[ProcessResponse]:
+    # classify the latest utterance locally, None means it needs the GPT classifier
+    *earlier, utterance = session.conversation
+    last_prompt = next((m["content"] for m in reversed(earlier) if m["role"] == "assistant"), "")
+    names = list(session.medication_index) or medication_names(session.patient_data)
+    result = detect_intent(utterance["content"], names, last_prompt)
+    return ProcessResponse(**result) if result else None
+
+async def generate_reply(messages: list, session=None) -> str:
+    tags = attribution(session)
+    model = model_router.choose("reply", tags.get("call_sid"))
+    start = time.perf_counter()
+    chatgpt_response = await async_openai_client().chat.completions.create(
+        model=model,
+        messages=messages
+    )
+    model_router.record("reply", model, chatgpt_response.usage, time.perf_counter() - start, **tags)
+    return chatgpt_response.choices[0].message.content
+
+async def update_summary(session, timings: dict):
+    # fold turns that left the verbatim window into the running summary, a failure just retries next turn
+    if not needs_summary(session):
+        return
+    try:
+        await timed("summary", timings, summarize_older_turns(session, async_openai_client()), session.call_sid)
+    except Exception as e:
+        logger.warning(f"Summary update failed for {session.call_sid}: {e}")
 
 @router.post("/process_speech")
-async def process_speech(request: Request):
+async def process_speech(request: Request, seq: Optional[int] = None):
     logger.info("Processing user input")
 
-    response = VoiceResponse()
     # speech_result is a string and can be used as such
     form_date = await request.form()
-    speech_result = form_date.get("SpeechResult")
+    speech_result = form_date.get("SpeechResult") or ""
+    call_sid = form_date.get("CallSid")
+
+    # a retried request gets the first one's TwiML instead of running the turn (and GPT) again
+    key = turn_key(call_sid, seq, speech_result)
+    twiml, replayed = await turn_replays.run(key, lambda: take_turn(call_sid, speech_result, key))
+    if replayed:
+        logger.info(f"Replayed turn {key}")
+    return Response(content=twiml, media_type="application/xml")
+
+async def take_turn(call_sid: str, speech_result: str, key: str) -> str:
+    response = VoiceResponse()
+    session = sessions.get(call_sid)
+    if session is None:
+        logger.warning(f"No session for call {call_sid}")
+        say_or_play(response, SOFTWARE_ERROR, AI_VOICE)
+        response.hangup()
+        return str(response)
+    if session.last_turn_key == key:
+        # the turn already finished, on another worker or before a restart
+        webhook_replays_total.inc(webhook="process_speech", source="session")
+        return session.last_turn_twiml
+    conversation = session.conversation
 
     logger.warning("Speech Result: " + speech_result)
     
@@ -158,56 +297,49 @@ async def process_speech(request: Request):
     logger.info("User Input:", speech_result)
     conversation.append({"role": "user", "content": speech_result})
     
-    import time
-    start_time = time.time()
-    
+    turn_start = time.perf_counter()
+    timings = {}
+
+    # obvious turns are classified locally; otherwise the GPT classifier and the next reply only depend
+    # on the conversation so far, so run them together and the caller waits for the slower of the two
+    # instead of both. Turns that fall out of the verbatim window are summarized alongside them.
+    output = fast_classify(session)
+    if output is None:
+        classify_task = asyncio.create_task(timed("classifier", timings, classify_turn(context_transcript(session), session), call_sid))
+    reply_task = None
+    if output is None or not output.hang_up:
+        reply_task = asyncio.create_task(timed("reply", timings, generate_reply(context_messages(session), session), call_sid))
+    summary_task = asyncio.create_task(update_summary(session, timings))
+    # the alert is sent from inside the task as soon as it fires, not after the reply
+    emergency_task = asyncio.create_task(
+        check_emergency(session, speech_result, turn_start, async_openai_client(), context_transcript(session))
+    )
+
     is_hang_up = False
-    
     try:
-
-        prompt = f"""
-        Based on the following conversation, determine the following:
-        1) if the user explicitly requests to end the call and if it is appropriate to hang up here. 
-        Return 'true' or 'false' only.
-        2) if the user is asked about the medicaiton they are taking, output which one medication they are 
-        referring to and the status (taken/not taking/delayed/taking later/need refill).
-        
-        Conversation: 
-        {conversation}
-        """
-        gpt_response = openai_client.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            response_format=ProcessResponse
-        )
-        output = gpt_response.choices[0].message.parsed
+        if output is None:
+            output = await classify_task
         is_hang_up = output.hang_up
-        
-        medication_name = output.medication
-        medication_status = output.status
-        medication_updates[medication_name] = medication_status
-        
-        logger.info("GPT response took " + str(time.time() - start_time) + " seconds")
-    except Exception as e:   
-        print(e)
-        is_hang_up = False
+        if output.medication:
+            session.medication_updates[output.medication] = output.status
+        publish(session.patient_data.get("patient_id"), "turn", call_sid=call_sid, medication=output.medication,
+                status=output.status, hang_up=output.hang_up)
+    except Exception as e:
+        logger.warning(f"Classifier error: {e}")
 
-    # if "hang up" is included in the speech_result, exit the function/end the call
+    # if the user wants to hang up, the generated reply is not needed
     if is_hang_up:
+        if reply_task is not None:
+            reply_task.cancel()
         logger.info("User requested to hang up")
-        response.say("Goodbye", voice=AI_VOICE)
+        say_or_play(response, GOODBYE, AI_VOICE)
         response.hangup()
-        # route to call_ended
-        response.redirect("/call_ended")
+        await summary_task
+        await emergency_task
+        return finish_turn(session, key, response, turn_start, timings)
 
     try:
-        # generate next response from OpenAI
-        chatgpt_response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=conversation
-        )
-
-        assistant_reply = chatgpt_response.choices[0].message.content
+        assistant_reply = await reply_task
 
         # update conversation and console
         conversation.append({"role": "assistant", "content": assistant_reply})
@@ -217,61 +349,101 @@ async def process_speech(request: Request):
 
     except Exception as e:
         logger.info("OpenAI API Error:", e)
-        response.say("Sorry, I have experienced a software issue.")
+        say_or_play(response, SOFTWARE_ERROR, AI_VOICE)
+
+    await summary_task
+    await emergency_task
 
     # return to the answer_call function, which will continue the conversation
     response.redirect("/answer")
 
-    return Response(content=str(response), media_type="application/xml")
+    return finish_turn(session, key, response, turn_start, timings)
+
+def finish_turn(session, key: str, response: VoiceResponse, turn_start: float, timings: dict) -> str:
+    # renders the TwiML and saves it with the session, so a retry of this turn can be replayed from it
+    call_sid = session.call_sid
+    with span("twiml", call_sid):
+        twiml = str(response)
+    session.last_turn_key = key
+    session.last_turn_twiml = twiml
+    sessions.save(session)
+    elapsed = time.perf_counter() - turn_start
+    timings["turn"] = round(elapsed, 3)
+    observe_span("turn", elapsed, call_sid)
+    logger.info(f"Turn timings for {call_sid}: {timings}")
+    return twiml
+
+@router.get("/intent_stats")
+def get_intent_stats():
+    # how many turns the local classifier answered vs. sent to GPT
+    total = intent_stats["hits"] + intent_stats["misses"]
+    return {**intent_stats, "hit_rate": intent_stats["hits"] / total if total else 0.0}
+
+@router.get("/alert_stats")
+def get_alert_stats():
+    # turns screened for emergencies, how many went to GPT, alerts sent and utterance-to-alert latency
+    latencies = sorted(alert_stats["latencies_ms"])
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+    return {**{k: v for k, v in alert_stats.items() if k != "latencies_ms"},
+            "latency_ms_p50": percentile(0.5), "latency_ms_p95": percentile(0.95)}
+
+@router.post("/call_amd")
+async def call_amd(CallSid: str = Form(...), AnsweredBy: str = Form("")):
+    # answering machine detection result, hang up on voicemail so the retry policy can call again later
+    logger.info(f"Call {CallSid} answered by {AnsweredBy}")
+    session = sessions.get(CallSid)
+    if session is None:
+        return Response(status_code=204)
+    session.answered_by = AnsweredBy
+    sessions.save(session)
+    if call_outcome("completed", AnsweredBy, True) == CallOutcome.voicemail:
+        await asyncio.to_thread(lambda: twilio_client().calls(CallSid).update(status="completed"))
+        record_twilio_call("calls.update")
+    return Response(status_code=204)
 
-class CallLog(BaseModel):
-    summary: str
-    follow_up_topics: str
-    is_emergency: bool
-    
 @router.api_route("/call_ended", methods=["GET", "POST"])
-def call_ended(db: Session = Depends(get_db)):
-    # Once the call ends, prompt ChatGPT to generate a short summary of the call for the 'response' key of the db
-    logger.info("Call ended")
-    if len(conversation) > 1:
-        
-        prompt = f"""
-        Please briefly summarize the following conversation between a medical assistant and an elderly patient,
-        and provide a short comma separated list of follow-up keyword topics that the medical assistant should discuss with the patient
-        in their next phone call. If the patient has an emergency concern (extreme pain, suicide, refusal to take medicine,
-        falls, heart attack, etc.), please note that as true/false and the primary healthcare provider will be contacted immediately.
-        Conversation:
-        {conversation}
-        """
-        
-        gpt_response = openai_client.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            response_format=CallLog
-        )
-        
-        output = gpt_response.choices[0].message.parsed
-
-        
-        logger.info("Call summary: " + output.summary)
-        logger.info("Follow-up topics: " + str(output.follow_up_topics))
-        logger.info("Is emergency: " + str(output.is_emergency))
-        logger.info("Medication updates: " + str(medication_updates))
-        output = gpt_response.choices[0].message.parsed
-        logger.info("Call summary: " + output.summary)
-        # Build call log payload
-        call_log_data = {
-            "patient_id": patient_data.get("patient_id", 1),  # or use the correct patient_id
-            "call_time": datetime.utcnow(),
-            "call_status": CallScheduleStatus.pending,  # or adjust based on output
-            "transcription": "",  # set if you have transcription text
-            "summary": output.summary,
-            "alert": "",  # set if needed
-            "follow_up": output.follow_up_topics,
-        }
-        new_log = create_call_log(CallLogCreate(**call_log_data), db)
-
-        logger.info(call_log_data)
-        conversation.clear()
-    
-    return "Summary completed"
+async def call_ended(CallSid: Optional[str] = Form(None), CallStatus: Optional[str] = Form(None),
+                     AnsweredBy: Optional[str] = Form(None), db: AsyncSession = Depends(get_async_db)):
+    # Once the call ends, queue the summary and call log write for the job workers (services/post_call.py)
+    # so Twilio's status callback is answered right away
+    logger.info(f"Call ended: {CallStatus}")
+    session = sessions.get(CallSid) if CallSid else None
+    if session is None:
+        logger.warning(f"No session for call {CallSid}")
+        return "Summary completed"
+    # a repeat of this callback waits for (or is answered from) the first one instead of queueing the
+    # post-call job again; the unique call_sid on call_logs catches one that reaches another worker
+    async def handle():
+        with span("call_ended_webhook", CallSid):
+            await end_session(session, db, CallStatus, AnsweredBy)
+        return "Summary completed"
+    result, _ = await call_end_replays.run(CallSid, handle)
+    return result
+
+async def end_session(session, db: AsyncSession, call_status: Optional[str] = None, answered_by: Optional[str] = None):
+    outcome = call_outcome(call_status, answered_by or session.answered_by, session.turns > 0)
+    if outcome != CallOutcome.answered:
+        # nothing to summarize, log the missed call and let the retry policy book another attempt
+        await enqueue_job_async(db, "missed_call", {
+            "call_sid": session.call_sid,
+            "call_time": datetime.utcnow().isoformat(),
+            "patient_data": session.patient_data,
+            "outcome": outcome.value,
+        })
+    else:
+        await enqueue_job_async(db, "post_call", {
+            "call_sid": session.call_sid,
+            "call_time": datetime.utcnow().isoformat(),
+            "patient_data": session.patient_data,
+            # the running summary already covers the older turns, only the recent ones are sent verbatim
+            "context": context_transcript(session),
+            "transcription": render_transcript(session.conversation),
+            "medication_updates": session.medication_updates,
+            "medication_index": session.medication_index,
+            "alerts": session.alerts,
+        })
+    model_router.end_call(session.call_sid)
+    publish(session.patient_data.get("patient_id"), "call_ended", call_sid=session.call_sid,
+            outcome=outcome.value, medication_updates=session.medication_updates)
+
+    sessions.delete(session.call_sid)
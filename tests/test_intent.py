@@ -0,0 +1,33 @@
+from services.intent import detect_intent
+
+HANG_UP = {"hang_up": True, "medication": "", "status": ""}
+
+
+def test_goodbye_hangs_up():
+    for utterance in ["okay goodbye", "bye bye", "talk to you later", "Okay, I have to go.", "I need to go now",
+                      "that's all for today"]:
+        assert detect_intent(utterance, []) == HANG_UP, utterance
+
+
+def test_negated_or_held_off_goodbye_falls_back():
+    for utterance in ["I don't want to hang up yet", "wait don't hang up", "not bye yet"]:
+        assert detect_intent(utterance, []) is None, utterance
+
+
+def test_closing_phrase_mid_sentence_falls_back():
+    for utterance in ["I have to go to the doctor tomorrow", "I need to go to the pharmacy later today",
+                      "That's all I took today"]:
+        assert detect_intent(utterance, ["metformin"]) is None, utterance
+
+
+def test_single_medication_status():
+    assert detect_intent("yes I took my levothyroxine", ["levothyroxine", "metformin"]) == \
+        {"hang_up": False, "medication": "levothyroxine", "status": "taken"}
+
+
+def test_several_medications_fall_back():
+    names = ["levothyroxine", "metformin", "thyroid pill"]
+    for utterance in ["I haven't taken my metformin but I took levothyroxine",
+                      "I took the levothyroxine and the metformin",
+                      "my thyroid pill is the levothyroxine, I took it"]:
+        assert detect_intent(utterance, names) is None, utterance